@@ -0,0 +1,58 @@
+"""Django settings and helpers shared by the benchmark scripts"""
+
+import json
+from os.path import abspath, dirname
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import django
+from django.conf import settings
+
+
+def setup_django(database_name=':memory:'):
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': database_name,
+            }
+        },
+        INSTALLED_APPS=(
+            'django.contrib.contenttypes',
+            'popolo',
+            'popolo_sources',
+        ),
+        MIDDLEWARE_CLASSES=[],
+        SECRET_KEY='this-is-just-for-benchmarks-so-not-that-secret',
+    )
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+class FileResponse(object):
+
+    """A fake requests response whose body is read from a file"""
+
+    status_code = 200
+    headers = {}
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @property
+    def content(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def iter_content(self, chunk_size=1):
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def raise_for_status(self):
+        pass
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Measure how PopoloSourceImporter scales with the size of a source
+
+For each size, this generates synthetic Popolo JSON with that many
+top-level objects (see popolo_generator.py) and runs
+update_from_source on it, with requests.get faked to read the
+generated file, in four scenarios:
+
+* cold: the first import, into an empty database
+* unchanged: importing exactly the same data again
+* churn: importing the data with 5% of the objects changed
+* deletions: importing the data with 20% of the objects removed
+
+For the "unchanged" scenario the source's stored content digest is
+cleared first, so that the import isn't skipped entirely. The wall
+time, number of database queries and peak memory allocated (as
+measured by tracemalloc, which slows things down; use --no-memory to
+turn it off) are reported for each one, and can be written to a JSON
+file with --output and compared with an earlier run with --compare.
+For example:
+
+    ./benchmarks/import_scaling.py --sizes 1000,10000 --output results.json
+"""
+
+from __future__ import division, print_function
+
+import argparse
+from contextlib import contextmanager
+import json
+import platform
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from common import FileResponse, setup_django
+
+setup_django()
+
+import django
+from django.db.backends.utils import CursorWrapper
+from mock import patch
+
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import PopoloSource
+
+from popolo_generator import churn, delete_fraction, generate_popolo
+
+
+def scenario_data(data):
+    """Yield the scenario name and Popolo JSON data for each scenario"""
+    yield 'cold', data
+    yield 'unchanged', data
+    churned = churn(data, 0.05)
+    yield 'churn', churned
+    yield 'deletions', delete_fraction(churned, 0.2)
+
+
+@contextmanager
+def count_queries():
+    """Count the queries run, without keeping a log of them all"""
+    counter = {'queries': 0}
+    original_execute = CursorWrapper.execute
+    original_executemany = CursorWrapper.executemany
+
+    def execute(self, *args, **kwargs):
+        counter['queries'] += 1
+        return original_execute(self, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        counter['queries'] += 1
+        return original_executemany(self, *args, **kwargs)
+
+    with patch.object(CursorWrapper, 'execute', execute), \
+            patch.object(CursorWrapper, 'executemany', executemany):
+        yield counter
+
+
+def measure_update(importer, filename, measure_memory):
+    importer.popolo_source.content_digest = ''
+    with patch('popolo_sources.importer.requests.get',
+               return_value=FileResponse(filename)):
+        if measure_memory:
+            tracemalloc.start()
+        with count_queries() as counter:
+            start = time.time()
+            importer.update_from_source()
+            wall_time = time.time() - start
+        peak_memory = None
+        if measure_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return {
+        'wall_time': wall_time,
+        'queries': counter['queries'],
+        'peak_memory': peak_memory,
+    }
+
+
+def run_benchmarks(size, measure_memory, importer_kwargs):
+    popolo_source = PopoloSource.objects.create(
+        url='http://example.com/benchmark-{0}.json'.format(size))
+    importer = PopoloSourceImporter(popolo_source, **importer_kwargs)
+    results = []
+    for scenario, data in scenario_data(generate_popolo(size)):
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            f.write(json.dumps(data).encode('utf-8'))
+            f.flush()
+            result = measure_update(importer, f.name, measure_memory)
+        result.update({'size': size, 'scenario': scenario})
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def format_memory(peak_memory):
+    if peak_memory is None:
+        return '-'
+    return '{0:.1f} MiB'.format(peak_memory / 2 ** 20)
+
+
+def print_result(result, baseline=None):
+    line = '{size:>8} {scenario:<10} {wall_time:>9.2f}s {queries:>9} ' \
+        '{memory:>11}'.format(
+            memory=format_memory(result['peak_memory']), **result)
+    if baseline:
+        line += '   time x{0:.2f}, queries x{1:.2f}'.format(
+            result['wall_time'] / (baseline['wall_time'] or 1),
+            result['queries'] / (baseline['queries'] or 1))
+    print(line)
+
+
+def compare(results, baseline_results):
+    """Print each result alongside its ratio to the baseline's"""
+    baseline = {
+        (r['size'], r['scenario']): r for r in baseline_results}
+    print('\nCompared with the baseline:')
+    for result in results:
+        print_result(
+            result, baseline.get((result['size'], result['scenario'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', default='1000',
+        help='Comma-separated numbers of objects (default: 1000)')
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument(
+        '--compare', help='Compare with results from an earlier --output')
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--preload-identifiers', action='store_true')
+    parser.add_argument('--skip-unchanged', action='store_true')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--set-based-deletions', action='store_true')
+    args = parser.parse_args()
+    measure_memory = tracemalloc is not None and not args.no_memory
+    importer_kwargs = {
+        'preload_identifiers': args.preload_identifiers,
+        'skip_unchanged': args.skip_unchanged,
+        'streaming': args.streaming,
+        'set_based_deletions': args.set_based_deletions,
+    }
+    print('{0:>8} {1:<10} {2:>10} {3:>9} {4:>11}'.format(
+        'size', 'scenario', 'time', 'queries', 'peak memory'))
+    results = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results += run_benchmarks(size, measure_memory, importer_kwargs)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'importer_kwargs': importer_kwargs,
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""Generate deterministic, synthetic Popolo JSON for benchmarks
+
+generate_popolo(n) returns Popolo JSON data with roughly n top-level
+objects, split between the collections in proportions similar to a
+real legislature's data: mostly people and their memberships, with
+fewer posts, areas and organizations. The same arguments always give
+the same data.
+
+churn and delete_fraction return modified copies of that data, to
+simulate changes between one version of a source and the next.
+"""
+
+from __future__ import division
+
+import copy
+import random
+
+
+# The proportion of top-level objects in each collection:
+COLLECTION_RATIOS = (
+    ('areas', 0.05),
+    ('organizations', 0.02),
+    ('posts', 0.08),
+    ('persons', 0.35),
+    ('memberships', 0.50),
+)
+
+GENDERS = ('female', 'male', 'other')
+CONTACT_TYPES = ('email', 'twitter', 'phone', 'facebook')
+
+
+def collection_sizes(total_objects):
+    return {
+        collection: max(1, int(round(total_objects * ratio)))
+        for collection, ratio in COLLECTION_RATIOS}
+
+
+def make_area(rng, i, parent_id):
+    area = {
+        'id': 'area-{0}'.format(i),
+        'name': 'Area {0}'.format(i),
+        'identifier': 'gss:E{0:08d}'.format(i),
+        'classification': 'constituency' if parent_id else 'region',
+    }
+    if parent_id:
+        area['parent_id'] = parent_id
+    return area
+
+
+def make_organization(rng, i, parent_id):
+    organization = {
+        'id': 'org-{0}'.format(i),
+        'name': 'Organization {0}'.format(i),
+        'classification': 'party' if parent_id else 'legislature',
+        'identifiers': [
+            {'scheme': 'wikidata', 'identifier': 'Q{0}'.format(1000 + i)},
+        ],
+        'links': [
+            {'url': 'https://example.org/orgs/{0}'.format(i),
+             'note': 'website'},
+        ],
+    }
+    if parent_id:
+        organization['parent_id'] = parent_id
+    return organization
+
+
+def make_post(rng, i, organization_id, area_id):
+    return {
+        'id': 'post-{0}'.format(i),
+        'label': 'Member for Area {0}'.format(area_id),
+        'role': 'Member',
+        'organization_id': organization_id,
+        'area_id': area_id,
+    }
+
+
+def make_person(rng, i):
+    given_name = 'Given{0}'.format(rng.randint(0, 500))
+    family_name = 'Family{0}'.format(i)
+    return {
+        'id': 'person-{0}'.format(i),
+        'name': '{0} {1}'.format(given_name, family_name),
+        'given_name': given_name,
+        'family_name': family_name,
+        'sort_name': '{0}, {1}'.format(family_name, given_name),
+        'gender': rng.choice(GENDERS),
+        'birth_date': '{0}-{1:02d}-{2:02d}'.format(
+            rng.randint(1940, 1995), rng.randint(1, 12), rng.randint(1, 28)),
+        'biography': 'Biography of person {0}. '.format(i) * rng.randint(1, 5),
+        'identifiers': [
+            {'scheme': 'wikidata', 'identifier': 'Q{0}'.format(100000 + i)},
+        ],
+        'contact_details': [
+            {'type': contact_type,
+             'value': '{0}-{1}@example.org'.format(contact_type, i)}
+            for contact_type in rng.sample(CONTACT_TYPES, rng.randint(0, 2))
+        ],
+        'links': [
+            {'url': 'https://example.org/people/{0}'.format(i),
+             'note': 'homepage'},
+        ],
+    }
+
+
+def make_membership(rng, i, person_id, organization_id, post_id):
+    membership = {
+        'id': 'membership-{0}'.format(i),
+        'person_id': person_id,
+        'organization_id': organization_id,
+        'role': 'Member',
+        'start_date': '{0}-05-07'.format(rng.randint(1990, 2015)),
+    }
+    if post_id:
+        membership['post_id'] = post_id
+    return membership
+
+
+def generate_popolo(total_objects, seed=0):
+    """Return Popolo JSON data with about total_objects top-level objects"""
+    rng = random.Random(seed)
+    sizes = collection_sizes(total_objects)
+    # A few top-level areas, with the rest as their children:
+    regions = max(1, sizes['areas'] // 10)
+    areas = [
+        make_area(rng, i, None if i < regions else
+                  'area-{0}'.format(rng.randrange(regions)))
+        for i in range(sizes['areas'])]
+    # The first organization is the legislature, and the rest are
+    # parties within it:
+    organizations = [
+        make_organization(rng, i, 'org-0' if i else None)
+        for i in range(sizes['organizations'])]
+    posts = [
+        make_post(
+            rng, i, 'org-0',
+            areas[rng.randrange(len(areas))]['id'])
+        for i in range(sizes['posts'])]
+    persons = [make_person(rng, i) for i in range(sizes['persons'])]
+    memberships = []
+    for i in range(sizes['memberships']):
+        person_id = persons[i % len(persons)]['id']
+        if i % 2:
+            # A party membership:
+            organization_id = organizations[
+                rng.randrange(len(organizations))]['id']
+            post_id = None
+        else:
+            # A membership of the legislature, for a post:
+            organization_id = 'org-0'
+            post_id = posts[rng.randrange(len(posts))]['id']
+        memberships.append(make_membership(
+            rng, i, person_id, organization_id, post_id))
+    return {
+        'areas': areas,
+        'organizations': organizations,
+        'posts': posts,
+        'persons': persons,
+        'memberships': memberships,
+    }
+
+
+def churn(data, fraction, seed=1):
+    """Return a copy of data with a fraction of its objects changed"""
+    rng = random.Random(seed)
+    data = copy.deepcopy(data)
+    for collection, objects in sorted(data.items()):
+        for o in rng.sample(objects, int(len(objects) * fraction)):
+            if collection == 'persons':
+                o['biography'] = o['biography'] + ' Updated.'
+                o['links'].append({
+                    'url': 'https://example.org/updated/{0}'.format(o['id']),
+                    'note': 'updated'})
+            elif collection == 'memberships':
+                o['end_date'] = '2017-05-03'
+            elif collection == 'posts':
+                o['label'] = o['label'] + ' (updated)'
+            else:
+                o['name'] = o['name'] + ' (updated)'
+    return data
+
+
+def delete_fraction(data, fraction, seed=2):
+    """Return a copy of data with a fraction of its objects removed
+
+    People, posts and memberships are removed; removing a person or
+    post also removes the memberships that refer to them. Areas and
+    organizations are left alone, since other objects depend on
+    them."""
+    rng = random.Random(seed)
+    data = copy.deepcopy(data)
+    removed = {}
+    for collection in ('persons', 'posts', 'memberships'):
+        objects = data[collection]
+        removed[collection] = set(
+            o['id'] for o in rng.sample(objects, int(len(objects) * fraction)))
+        data[collection] = [
+            o for o in objects if o['id'] not in removed[collection]]
+    data['memberships'] = [
+        m for m in data['memberships']
+        if m['person_id'] not in removed['persons'] and
+        m.get('post_id') not in removed['posts']]
+    return data
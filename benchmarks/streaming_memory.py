@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Compare peak memory use of streaming and non-streaming imports
+
+This generates a Popolo JSON file with many people (each with a
+long biography, so that the file is large relative to the number of
+objects), then imports it with PopoloSourceImporter in each mode,
+reporting the peak memory allocated during the import as measured
+by tracemalloc. Run it from the root of the repository with, for
+example:
+
+    ./benchmarks/streaming_memory.py --people 2000 --biography-length 20000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import tempfile
+import tracemalloc
+
+from common import FileResponse, setup_django
+
+setup_django()
+
+from mock import patch
+
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import PopoloSource
+
+
+def write_popolo_json(f, people, biography_length):
+    data = {
+        'organizations': [{'id': 'commons', 'name': 'House of Commons'}],
+        'persons': [
+            {
+                'id': 'person-{0}'.format(i),
+                'name': 'Person {0}'.format(i),
+                'biography': 'x' * biography_length,
+            }
+            for i in range(people)
+        ],
+        'memberships': [
+            {
+                'person_id': 'person-{0}'.format(i),
+                'organization_id': 'commons',
+            }
+            for i in range(people)
+        ],
+    }
+    f.write(json.dumps(data).encode('utf-8'))
+    f.flush()
+
+
+def measure(filename, **importer_kwargs):
+    popolo_source = PopoloSource.objects.create(
+        url='http://example.com/benchmark.json')
+    importer = PopoloSourceImporter(popolo_source, **importer_kwargs)
+    with patch('popolo_sources.importer.requests.get',
+               return_value=FileResponse(filename)):
+        tracemalloc.start()
+        importer.update_from_source()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--people', type=int, default=1000)
+    parser.add_argument('--biography-length', type=int, default=10000)
+    args = parser.parse_args()
+    with tempfile.NamedTemporaryFile(suffix='.json') as f:
+        write_popolo_json(f, args.people, args.biography_length)
+        size = f.tell()
+        print('Popolo JSON size: {0:.1f} MiB'.format(size / 2.0 ** 20))
+        for label, kwargs in (
+                ('Non-streaming', {}),
+                ('Streaming', {'streaming': True})):
+            peak = measure(f.name, **kwargs)
+            print('{0} import peak memory: {1:.1f} MiB'.format(
+                label, peak / 2.0 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""A read-through cache of the IDs of the objects live in each source
+
+Filtering by source ("people from this source that haven't been
+deleted from it") otherwise means a query on LinkToPopoloSource every
+time. live_object_ids caches the IDs of the live objects for each
+source and content type, in Django's cache framework, as a compressed
+sorted array. The entries for a source are versioned, and the
+version is changed whenever the source is updated, so they never
+need to be deleted explicitly.
+
+The cache used is the one named by the POPOLO_SOURCES_CACHE setting,
+or 'default' if that isn't set. For the invalidation to work across
+processes it must be a shared cache, such as memcached or Redis.
+"""
+
+from array import array
+from bisect import bisect_left
+import uuid
+import zlib
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from popolo_sources.models import LinkToPopoloSource
+
+
+# Above this many IDs, filter_queryset uses a subquery instead:
+MAX_IDS_IN_FILTER = 300
+
+
+def _encode_ids(object_ids):
+    if hasattr(object_ids, 'tobytes'):
+        return zlib.compress(object_ids.tobytes())
+    return zlib.compress(object_ids.tostring())
+
+
+def _decode_ids(data):
+    object_ids = array(str('L'))
+    if hasattr(object_ids, 'frombytes'):
+        object_ids.frombytes(zlib.decompress(data))
+    else:
+        object_ids.fromstring(zlib.decompress(data))
+    return object_ids
+
+
+class LiveObjectIdCache(object):
+
+    """A cache of the sorted IDs of each source's live objects
+
+    hits and misses count the lookups of ID arrays in this process."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'POPOLO_SOURCES_CACHE', 'default')]
+
+    def version_key(self, popolo_source):
+        return 'popolo_sources:live_ids_version:{0}'.format(popolo_source.id)
+
+    def get_version(self, popolo_source):
+        key = self.version_key(popolo_source)
+        version = self.cache.get(key)
+        if version is None:
+            # If another process sets it first, use theirs:
+            self.cache.add(key, uuid.uuid4().hex, None)
+            version = self.cache.get(key)
+        return version
+
+    def invalidate(self, popolo_source):
+        """Make any cached IDs for popolo_source out of date"""
+        self.cache.set(
+            self.version_key(popolo_source), uuid.uuid4().hex, None)
+
+    def get_ids(self, popolo_source, model):
+        """Return a sorted array of the IDs of model's live objects"""
+        content_type = ContentType.objects.get_for_model(model)
+        key = 'popolo_sources:live_ids:{0}:{1}:{2}'.format(
+            popolo_source.id, content_type.id,
+            self.get_version(popolo_source))
+        data = self.cache.get(key)
+        if data is not None:
+            self.hits += 1
+            return _decode_ids(data)
+        self.misses += 1
+        object_ids = array(
+            str('L'),
+            LinkToPopoloSource.objects.filter(
+                popolo_source=popolo_source,
+                content_type=content_type,
+                deleted_from_source=False).order_by(
+                    'object_id').values_list(
+                        'object_id', flat=True).iterator())
+        self.cache.set(key, _encode_ids(object_ids), self.timeout)
+        return object_ids
+
+    def contains(self, popolo_source, popolo_object):
+        """Is popolo_object live in popolo_source?"""
+        object_ids = self.get_ids(popolo_source, type(popolo_object))
+        i = bisect_left(object_ids, popolo_object.pk)
+        return i < len(object_ids) and object_ids[i] == popolo_object.pk
+
+    def filter_queryset(self, queryset, popolo_source):
+        """Restrict queryset to the objects live in popolo_source
+
+        If there are lots of them, this filters with a subquery on
+        LinkToPopoloSource instead, since a long list of IDs would be
+        slower (and too long for SQLite)."""
+        object_ids = self.get_ids(popolo_source, queryset.model)
+        if len(object_ids) <= MAX_IDS_IN_FILTER:
+            return queryset.filter(pk__in=list(object_ids))
+        live_objects = LinkToPopoloSource.objects.live_objects(
+            popolo_source, queryset.model)
+        return queryset.filter(pk__in=live_objects.values('pk'))
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+
+live_object_ids = LiveObjectIdCache()
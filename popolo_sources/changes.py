@@ -0,0 +1,145 @@
+"""A persistent log of what each update of a source changed
+
+If a PopoloSourceImporter has record_changes set (it defaults to the
+POPOLO_SOURCES_RECORD_CHANGES setting), each update creates an
+ImportRun, and every object that's created, updated, disappears or
+reappears during it gets an ObjectChange. Those are written in bulk,
+in the same transactions as the import, so consumers like search
+indexes can catch up after a restart by reading the changes since
+the last run they saw:
+
+    for change in changes_since(last_run_id):
+        ...
+
+Objects whose Popolo JSON is the same as last time aren't recorded.
+An object can still have more than one change in a run, for example
+an area that's given inline, differently, in several posts. Old
+changes can be removed with prune_changes.
+"""
+
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils import timezone
+
+from popolo_sources.models import ImportRun, ObjectChange
+
+
+# A run that hasn't finished after this long is assumed to have been
+# abandoned (say, because the process running it was killed), so
+# doesn't hold up the runs after it:
+ABANDONED_AFTER = timedelta(hours=12)
+
+
+class ChangeLog(object):
+
+    """An observer that records the changes in an import as ObjectChanges
+
+    They're buffered, and written with bulk_create when there are
+    chunk_size of them or flush() is called. Created, updated and
+    reappeared objects are added by the link_creator (whose
+    change_log this must be set as), since only it knows what each
+    object's link was before it's written; this observer itself only
+    adds the objects that disappear."""
+
+    def __init__(self, import_run, link_creator, chunk_size=500):
+        self.import_run = import_run
+        self.link_creator = link_creator
+        self.chunk_size = chunk_size
+        self.pending = []
+
+    def add(self, collection, django_object, change):
+        self.pending.append(ObjectChange(
+            import_run=self.import_run,
+            content_type=self.link_creator.collection_to_content_type[
+                collection],
+            object_id=django_object.id,
+            change=change))
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def notify(self, collection, django_object, created, popolo_data):
+        pass
+
+    def notify_deleted(self, collection, django_object):
+        self.add(collection, django_object, 'disappeared')
+
+    def flush(self):
+        if self.pending:
+            ObjectChange.objects.bulk_create(self.pending)
+            self.pending = []
+
+
+def readable_runs(since=0, popolo_source=None):
+    """Return a queryset of the finished ImportRuns after the one given
+
+    since is an ImportRun ID. Runs are only included up to the first
+    one that's still in progress, so that a consumer that remembers
+    the last run it read never skips one that finishes later."""
+    runs = ImportRun.objects.filter(pk__gt=since)
+    if popolo_source is not None:
+        runs = runs.filter(popolo_source=popolo_source)
+    first_in_progress = runs.filter(
+        finished_at__isnull=True,
+        started_at__gt=timezone.now() - ABANDONED_AFTER,
+    ).order_by('pk').values_list('pk', flat=True).first()
+    runs = runs.filter(finished_at__isnull=False)
+    if first_in_progress is not None:
+        runs = runs.filter(pk__lt=first_in_progress)
+    return runs.order_by('pk')
+
+
+def changes_in_run(import_run, batch_size=1000):
+    """Yield the ObjectChanges in an ImportRun, in the order they were made
+
+    They're read batch_size at a time, each batch with a query from
+    where the last one ended."""
+    last_id = 0
+    while True:
+        batch = list(ObjectChange.objects.filter(
+            import_run=import_run, pk__gt=last_id).order_by(
+                'pk')[:batch_size])
+        for change in batch:
+            # Save a query for the run and content type of each
+            # (get_for_id is cached):
+            change.import_run = import_run
+            change.content_type = ContentType.objects.get_for_id(
+                change.content_type_id)
+            yield change
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].pk
+
+
+def changes_since(since=0, popolo_source=None, batch_size=1000):
+    """Yield the ObjectChanges in the readable runs after since
+
+    See readable_runs for which runs those are, and changes_in_run
+    for how they're read."""
+    for import_run in readable_runs(since, popolo_source):
+        for change in changes_in_run(import_run, batch_size):
+            yield change
+
+
+def prune_changes(before, batch_size=300):
+    """Delete the runs that finished before the datetime, and their changes
+
+    Runs that were abandoned (see ABANDONED_AFTER) before it are
+    deleted too, since they'll never finish. The changes are deleted batch_size at a time, so that no one
+    query or transaction gets too big (and the IDs in each DELETE
+    stay under SQLite's limit on parameters). This returns the number
+    of changes deleted."""
+    runs = ImportRun.objects.filter(
+        Q(finished_at__lt=before) |
+        Q(finished_at__isnull=True, started_at__lt=before - ABANDONED_AFTER))
+    deleted = 0
+    while True:
+        change_ids = list(ObjectChange.objects.filter(
+            import_run__in=runs).values_list('pk', flat=True)[:batch_size])
+        if not change_ids:
+            break
+        ObjectChange.objects.filter(pk__in=change_ids).delete()
+        deleted += len(change_ids)
+    runs.delete()
+    return deleted
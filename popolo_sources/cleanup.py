@@ -0,0 +1,159 @@
+"""Purging links that have been deleted from their sources for a while
+
+When an object disappears from a source, its LinkToPopoloSource is
+kept (with deleted_from_source set) in case it reappears. Those links
+would otherwise build up forever, so purge_deleted_links deletes the
+ones that were marked as deleted before some time:
+
+    purge_deleted_links(timezone.now() - timedelta(days=90))
+
+They're deleted in small batches, each in its own short transaction
+and holding its source's lock, optionally at a limited rate so that
+imports running at the same time aren't held up. With delete_orphans,
+the django-popolo objects that no source links to once a batch's
+links are gone are deleted too.
+"""
+
+from collections import defaultdict
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import router, transaction
+from django.db.models.deletion import Collector
+
+from popolo_sources.importer import _batches
+from popolo_sources.models import LinkToPopoloSource, PopoloSource
+
+
+class RateLimiter(object):
+
+    """Sleeps as needed to keep to an average of at most rate rows a second
+
+    Call wait(count) after handling each count rows. If rate is None,
+    it never sleeps."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.started = time.time()
+        self.count = 0
+
+    def wait(self, count):
+        if not self.rate:
+            return
+        self.count += count
+        delay = self.started + self.count / float(self.rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _is_linked(model, object_ids):
+    return LinkToPopoloSource.objects.filter(
+        content_type=ContentType.objects.get_for_model(model),
+        object_id__in=object_ids).exists()
+
+
+def _cascades_to_linked_objects(popolo_object):
+    # Deleting a django-popolo object can delete others too (say, a
+    # person's memberships), which might still be linked to a source.
+    collector = Collector(using=router.db_for_write(popolo_object.__class__))
+    collector.collect([popolo_object])
+    for model, instances in collector.data.items():
+        object_ids = [i.pk for i in instances if i is not popolo_object]
+        for batch in _batches(object_ids):
+            if _is_linked(model, batch):
+                return True
+    for queryset in collector.fast_deletes:
+        if _is_linked(queryset.model, queryset.values('pk')):
+            return True
+    return False
+
+
+def delete_orphaned_objects(content_type, object_ids):
+    """Delete the objects with those IDs that no source links to
+
+    An object is left alone if deleting it would also delete another
+    object that's still linked to a source. This returns the number
+    of objects deleted (not counting those deleted by cascading)."""
+    model_class = content_type.model_class()
+    if model_class is None:
+        return 0
+    linked = set(LinkToPopoloSource.objects.filter(
+        content_type=content_type,
+        object_id__in=object_ids).values_list('object_id', flat=True))
+    deleted = 0
+    for popolo_object in model_class.objects.filter(
+            pk__in=[i for i in object_ids if i not in linked]):
+        if _cascades_to_linked_objects(popolo_object):
+            continue
+        popolo_object.delete()
+        deleted += 1
+    return deleted
+
+
+def _delete_batch(popolo_source, before, batch_size, delete_orphans):
+    with transaction.atomic():
+        links = list(LinkToPopoloSource.objects.filter(
+            popolo_source=popolo_source,
+            deleted_from_source=True,
+            deleted_at__lt=before,
+        ).order_by('pk').values_list(
+            'pk', 'content_type_id', 'object_id')[:batch_size])
+        if not links:
+            return 0, 0
+        LinkToPopoloSource.objects.filter(
+            pk__in=[link[0] for link in links]).delete()
+        objects_deleted = 0
+        if delete_orphans:
+            content_type_to_object_ids = defaultdict(list)
+            for _, content_type_id, object_id in links:
+                content_type_to_object_ids[content_type_id].append(object_id)
+            for content_type_id, object_ids in \
+                    content_type_to_object_ids.items():
+                objects_deleted += delete_orphaned_objects(
+                    ContentType.objects.get_for_id(content_type_id),
+                    object_ids)
+        return len(links), objects_deleted
+
+
+def purge_deleted_links(before, batch_size=300, max_rate=None,
+                        delete_orphans=False):
+    """Delete the links that were marked as deleted before the datetime
+
+    The links are deleted batch_size at a time, each batch in its own
+    transaction, and if max_rate is given this sleeps between batches
+    to delete at most that many links a second on average. If
+    delete_orphans is True, the objects of each batch's links that no
+    other link refers to are deleted with them (see
+    delete_orphaned_objects). Objects that were never linked to a
+    source are left alone.
+
+    An import that's running has already read the links of its
+    source, so each batch is deleted while holding the source's lock
+    (see PopoloSource.acquire_lock), and the links of a source that's
+    being updated are left for next time. This returns the number of
+    links and the number of objects deleted."""
+    rate_limiter = RateLimiter(max_rate)
+    links_deleted = objects_deleted = 0
+    source_ids = LinkToPopoloSource.objects.filter(
+        deleted_from_source=True,
+        deleted_at__lt=before,
+    ).order_by('popolo_source').values_list(
+        'popolo_source', flat=True).distinct()
+    for popolo_source in PopoloSource.objects.filter(
+            pk__in=list(source_ids)).order_by('pk'):
+        while True:
+            # The lock is only held for one batch at a time, so that
+            # the source's updates aren't held up for long:
+            if not popolo_source.acquire_lock():
+                break
+            try:
+                links, objects = _delete_batch(
+                    popolo_source, before, batch_size, delete_orphans)
+            finally:
+                popolo_source.release_lock()
+            links_deleted += links
+            objects_deleted += objects
+            if not links:
+                break
+            rate_limiter.wait(links)
+    return links_deleted, objects_deleted
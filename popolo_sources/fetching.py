@@ -0,0 +1,166 @@
+"""Fetching many sources concurrently, separately from importing them
+
+When lots of small sources are updated, most of the time is spent
+waiting for HTTP responses. update_with_concurrent_fetches fetches
+sources in a pool of threads, sharing a requests Session so that
+connections are reused, and passes the decoded responses through a
+bounded queue to the calling thread, which does all the database
+work. That way the import never waits on the network unless there's
+nothing fetched yet, and memory use is bounded by the queue size.
+"""
+
+from collections import namedtuple
+import threading
+import traceback
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.utils.six.moves import queue
+
+
+class UpdateResult(namedtuple('UpdateResult', ['importer', 'report', 'error'])):
+
+    """The result of updating from one importer's source
+
+    report is the ImportReport, or None if there was an error, in
+    which case error is the formatted traceback."""
+
+    @property
+    def updated(self):
+        if self.report is None:
+            return None
+        return bool(self.report)
+
+
+def make_session(pool_size=10, retries=3, backoff_factor=0.5):
+    """Return a requests Session with a connection pool and retries
+
+    Failed connections and responses with a 5xx status are retried up
+    to retries times, waiting backoff_factor * (2 ** (retry - 1))
+    seconds between attempts."""
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _fetch_worker(importers_queue, fetched_queue, stop, force):
+    while not stop.is_set():
+        importer = importers_queue.get()
+        if importer is None:
+            return
+        try:
+            fetched = importer.fetch(force=force)
+        except Exception:
+            fetched_queue.put((importer, None, traceback.format_exc()))
+        else:
+            fetched_queue.put((importer, fetched, None))
+
+
+def _close_fetched(item):
+    fetched = item[1]
+    if fetched is not None:
+        fetched.close()
+
+
+def _next_fetched(fetched_queue, stop):
+    # Wait for the next fetched source, unless stop is set first, in
+    # which case return None:
+    if stop is None:
+        return fetched_queue.get()
+    while not stop.is_set():
+        try:
+            item = fetched_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if stop.is_set():
+            _close_fetched(item)
+            return None
+        return item
+    return None
+
+
+def update_with_concurrent_fetches(
+        importers, concurrency=4, queue_size=None, force=False, stop=None,
+        before_import=None):
+    """Update from each importer's source, fetching them concurrently
+
+    importers should be PopoloSourceImporter instances, which will
+    usually share a Session from make_session and have a timeout
+    set. Up to concurrency sources are fetched at once, and at most
+    queue_size fetched sources (by default, the same as concurrency)
+    wait to be imported. The imports are all run in the calling
+    thread, in the order the fetches finish.
+
+    This yields an UpdateResult for each importer. An error in one
+    source doesn't stop the others being updated. If stop is given,
+    it's a threading.Event; once it's set, no more sources are
+    imported, and this returns without results for the rest.
+
+    If before_import is given, it's called with each importer whose
+    source was fetched, just before it's imported (say, to lock the
+    source). If it returns False, that source is skipped, and there's
+    no result for it; if it raises an exception, that's the source's
+    error."""
+    importers = list(importers)
+    if not importers:
+        return
+    concurrency = min(concurrency, len(importers))
+    importers_queue = queue.Queue()
+    for importer in importers:
+        importers_queue.put(importer)
+    for i in range(concurrency):
+        importers_queue.put(None)
+    fetched_queue = queue.Queue(maxsize=queue_size or concurrency)
+    stop_fetching = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_fetch_worker,
+            args=(importers_queue, fetched_queue, stop_fetching, force))
+        for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for i in range(len(importers)):
+            item = _next_fetched(fetched_queue, stop)
+            if item is None:
+                return
+            importer, fetched, error = item
+            if error is not None:
+                yield UpdateResult(importer, None, error)
+                continue
+            try:
+                if before_import is not None and not before_import(importer):
+                    continue
+                report = importer.update_from_fetched(fetched, force=force)
+            except Exception:
+                yield UpdateResult(importer, None, traceback.format_exc())
+            else:
+                yield UpdateResult(importer, report, None)
+            finally:
+                fetched.close()
+    finally:
+        # If we stopped early, make sure no worker is left blocked on
+        # a full queue, and clean up anything that was fetched.
+        stop_fetching.set()
+        while any(thread.is_alive() for thread in threads):
+            try:
+                _close_fetched(fetched_queue.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        while not fetched_queue.empty():
+            _close_fetched(fetched_queue.get())
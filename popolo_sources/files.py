@@ -0,0 +1,136 @@
+"""Sources in local files, and sources compressed with gzip, bz2 or xz
+
+A source whose URL starts with file:// is read from the local
+filesystem by LocalFileResponse, which looks enough like a requests
+response for the importer to treat it in the same way. Whether it's
+read from a file or over HTTP, a source that's compressed is detected
+by its first few bytes and decompressed as it's read, so the
+compressed and decompressed forms are never both in memory at once
+when streaming.
+"""
+
+import bz2
+from email.utils import formatdate
+import hashlib
+import itertools
+import mmap
+import os
+import zlib
+
+from django.utils.six.moves.urllib.parse import urlsplit
+from django.utils.six.moves.urllib.request import url2pathname
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# The magic numbers at the start of each compressed format:
+MAGIC_NUMBERS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+MAGIC_LENGTH = max(len(magic) for magic, _ in MAGIC_NUMBERS)
+
+
+def is_file_url(url):
+    return urlsplit(url).scheme == 'file'
+
+
+def compression_format(first_bytes):
+    """Return 'gzip', 'bz2' or 'xz' if the bytes look compressed, or None"""
+    for magic, compression in MAGIC_NUMBERS:
+        if first_bytes.startswith(magic):
+            return compression
+
+
+def make_decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'xz':
+        if lzma is None:
+            raise ImportError(
+                "Decompressing xz sources needs the lzma module, which "
+                "is only in Python 3")
+        return lzma.LZMADecompressor()
+    raise Exception("Unknown compression: '{0}'".format(compression))
+
+
+def decompress_chunks(chunks):
+    """Yield the chunks of bytes, decompressed if they're compressed"""
+    chunks = iter(chunks)
+    first = b''
+    for chunk in chunks:
+        first += chunk
+        if len(first) >= MAGIC_LENGTH:
+            break
+    chunks = itertools.chain([first], chunks)
+    compression = compression_format(first)
+    if compression is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    decompressor = make_decompressor(compression)
+    for chunk in chunks:
+        decompressed = decompressor.decompress(chunk)
+        if decompressed:
+            yield decompressed
+    if compression == 'gzip':
+        yield decompressor.flush()
+
+
+def decompress_content(content):
+    """Return the bytes, decompressed if they're compressed"""
+    if compression_format(content[:MAGIC_LENGTH]) is None:
+        return content
+    return b''.join(decompress_chunks([content]))
+
+
+class LocalFileResponse(object):
+
+    """The contents of a file:// URL, in place of a requests response
+
+    It has ETag and Last-Modified headers based on the file's size
+    and modification time, so that an unchanged file can be skipped
+    without reading it."""
+
+    status_code = 200
+
+    def __init__(self, url):
+        self.path = url2pathname(urlsplit(url).path)
+        stat = os.stat(self.path)
+        self.headers = {
+            'ETag': '"{0}-{1}"'.format(stat.st_size, stat.st_mtime),
+            'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+        }
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    @property
+    def content(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @property
+    def compressed(self):
+        with open(self.path, 'rb') as f:
+            return compression_format(f.read(MAGIC_LENGTH)) is not None
+
+    def map(self):
+        """Memory-map the file, returning the map and its SHA-256 digest
+
+        This means that an uncompressed file can be parsed in place,
+        rather than being copied to a temporary file first."""
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped, hashlib.sha256(mapped).hexdigest()
@@ -1,108 +1,1404 @@
+from array import array
+import binascii
 from collections import defaultdict
+from contextlib import contextmanager
+import hashlib
+import io
+import itertools
+import json
+import sys
 
 import requests
 
+from django.conf import settings
+from django.utils import six, timezone
+
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models, transaction
+from django.db.models import Case, Max, Value, When
 
 from popolo.importers.popolo_json import NEW_COLLECTIONS, PopoloJSONImporter
-from popolo_sources.models import LinkToPopoloSource
+from popolo_sources.cache import live_object_ids
+from popolo_sources.changes import ChangeLog
+from popolo_sources.files import (
+    decompress_content, is_file_url, LocalFileResponse)
+from popolo_sources.models import (
+    ImportCheckpoint, ImportRun, LinkToPopoloSource)
+from popolo_sources.reports import ImportReport
+from popolo_sources.signals import import_finished
+from popolo_sources.streaming import (
+    check_streaming_available, spool_response, StreamedPopoloData)
+
+
+def popolo_content_hash(popolo_data, events=None):
+    """Return a stable hash of an object's Popolo JSON data
+
+    events maps the IDs of the source's events to their data. A
+    membership's dates can come from its legislative period, so that
+    event's data is included in the hash of a membership that has
+    one."""
+    period_id = popolo_data.get('legislative_period_id')
+    if events and period_id in events:
+        popolo_data = [popolo_data, events[period_id]]
+    canonical = json.dumps(popolo_data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# The most objects to refer to by ID in a single query, which keeps
+# queries well under SQLite's limit on the number of parameters:
+MAX_IDS_PER_QUERY = 300
+
+
+def _batches(iterable, size=MAX_IDS_PER_QUERY):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _digest(content_hash):
+    """Return the bytes of a hex content hash"""
+    return binascii.unhexlify(content_hash)
+
+
+def generate_membership_id(membership_data):
+    # This must match the ID that PopoloJSONImporter.update_membership
+    # generates for memberships with no 'id' in the Popolo JSON.
+    new_id = ''
+    new_id += membership_data.get('legislative_period_id', 'missing') + "_"
+    new_id += membership_data.get('organization_id', 'missing') + "_"
+    new_id += membership_data.get('area_id', 'missing') + "_"
+    new_id += membership_data.get('role', 'missing') + "_"
+    new_id += membership_data.get('on_behalf_of_id', 'missing') + "_"
+    new_id += membership_data.get('person_id', 'missing')
+    return new_id
 
 
 class LinkCreator(object):
 
-    def __init__(self, popolo_source):
+    """An observer that records which objects came from a PopoloSource
+
+    Rather than writing a LinkToPopoloSource row for every object as
+    it's notified, links are buffered and written in chunks: new links
+    with bulk_create, and links to objects that have reappeared in the
+    source or whose content hash has changed with one UPDATE per
+    content type. The links that already exist for the source are
+    loaded with a single query per collection, the first time that
+    collection's are needed after reset() is called, so an import
+    that only updates some collections doesn't load the others.
+
+    Until they're flushed, newly created objects aren't findable by
+    the query in get_existing_django_object, so get_pending can be
+    used to look them up by their collection and ID.
+
+    If generation is set, every link to an object that's notified
+    (including with notify_unchanged) is stamped with it as its
+    import_generation, so that links that weren't seen in an import
+    can be found afterwards with a query.
+
+    The content hashes include the data of the events in events (see
+    popolo_content_hash), which should be set after reset() for each
+    import.
+
+    If change_log is set, each object that's notified is added to it
+    as created, updated or reappeared, as found from its link before
+    it's written. Objects whose content hash hasn't changed (and
+    repeated notifications of the same object) aren't added."""
+
+    def __init__(self, popolo_source, chunk_size=500):
         self.popolo_source = popolo_source
+        self.chunk_size = chunk_size
+        # get_by_natural_key is cached, so creating many importers
+        # doesn't mean querying for the content types every time:
         self.collection_to_content_type = {
-            collection: ContentType.objects.get(
-                app_label='popolo', model=collection)
+            collection: ContentType.objects.get_by_natural_key(
+                'popolo', collection)
             for collection in NEW_COLLECTIONS}
+        self.generation = None
+        self.change_log = None
+        self.reset()
+
+    def reset(self):
+        # A mapping from the ID of each content type whose links have
+        # been loaded to a mapping from object_id to a tuple of the
+        # deleted_from_source and content hash of each existing link.
+        # The hashes are kept as 32-byte digests, which take much less
+        # memory than their hex, since there's one for every object
+        # in the collection.
+        self.existing_links = {}
+        self.events = {}
+        self.pending_new = {}
+        self.pending_updates = defaultdict(dict)
+        self.pending_seen = defaultdict(set)
+        self.pending_count = 0
+        # The number of objects in each collection whose links were
+        # marked as deleted from the source, but which are back:
+        self.reappeared = defaultdict(int)
+
+    def get_existing_links(self, content_type):
+        links = self.existing_links.get(content_type.id)
+        if links is None:
+            links = self.existing_links[content_type.id] = {
+                object_id: (deleted, _digest(content_hash))
+                for object_id, deleted, content_hash
+                in LinkToPopoloSource.objects.filter(
+                    popolo_source=self.popolo_source,
+                    content_type=content_type).values_list(
+                        'object_id', 'deleted_from_source', 'content_hash')
+            }
+        return links
+
+    def content_hash(self, popolo_data):
+        return popolo_content_hash(popolo_data, self.events)
+
+    def get_pending(self, collection, popolo_id):
+        """Return an object whose link hasn't been written yet, or None"""
+        pending = self.pending_new.get((collection, popolo_id))
+        if pending is not None:
+            return pending[0]
+
+    def is_unchanged(self, collection, django_object, content_hash):
+        """Is there a live link to django_object with that content hash?"""
+        content_type = self.collection_to_content_type[collection]
+        existing = self.get_existing_links(content_type).get(django_object.id)
+        return existing == (False, _digest(content_hash))
 
     def notify(self, collection, django_object, created, popolo_data):
-        LinkToPopoloSource.objects.update_or_create(
-            content_type=self.collection_to_content_type[collection],
-            object_id=django_object.id,
-            popolo_source=self.popolo_source,
-            defaults={'deleted_from_source': False})
+        content_type = self.collection_to_content_type[collection]
+        content_hash = self.content_hash(popolo_data)
+        existing = self.get_existing_links(content_type).get(django_object.id)
+        if existing is None:
+            pending_key = (collection, popolo_data['id'])
+            if pending_key in self.pending_new:
+                return
+            self.pending_new[pending_key] = (django_object, content_hash)
+            change = 'created'
+        elif existing != (False, _digest(content_hash)):
+            updates = self.pending_updates[content_type]
+            if updates.get(django_object.id) == content_hash:
+                return
+            if existing[0] and django_object.id not in updates:
+                self.reappeared[collection] += 1
+                change = 'reappeared'
+            else:
+                change = 'updated'
+            updates[django_object.id] = content_hash
+        else:
+            self.notify_unchanged(collection, django_object, popolo_data)
+            return
+        if self.change_log is not None:
+            self.change_log.add(collection, django_object, change)
+        self.add_pending()
+
+    def notify_unchanged(self, collection, django_object, popolo_data):
+        if self.generation is None:
+            return
+        content_type = self.collection_to_content_type[collection]
+        seen = self.pending_seen[content_type]
+        if django_object.id in seen:
+            return
+        seen.add(django_object.id)
+        self.add_pending()
+
+    def add_pending(self):
+        self.pending_count += 1
+        if self.pending_count >= self.chunk_size:
+            self.flush()
 
     def notify_deleted(self, collection, django_object):
         pass
 
+    def flush(self):
+        """Write any buffered links to the database"""
+        if not self.pending_count:
+            return
+        LinkToPopoloSource.objects.bulk_create(
+            LinkToPopoloSource(
+                content_type=self.collection_to_content_type[collection],
+                object_id=django_object.id,
+                popolo_source=self.popolo_source,
+                deleted_from_source=False,
+                content_hash=content_hash,
+                import_generation=self.generation or 0)
+            for (collection, _), (django_object, content_hash)
+            in self.pending_new.items())
+        for (collection, _), (django_object, content_hash) \
+                in self.pending_new.items():
+            content_type = self.collection_to_content_type[collection]
+            self.existing_links[content_type.id][django_object.id] = \
+                (False, _digest(content_hash))
+        generation_update = {}
+        if self.generation is not None:
+            generation_update['import_generation'] = self.generation
+        for content_type, object_id_to_hash in self.pending_updates.items():
+            for object_ids in _batches(object_id_to_hash):
+                LinkToPopoloSource.objects.filter(
+                    popolo_source=self.popolo_source,
+                    content_type=content_type,
+                    object_id__in=object_ids).update(
+                        deleted_from_source=False,
+                        deleted_at=None,
+                        content_hash=Case(
+                            *[When(object_id=object_id,
+                                   then=Value(object_id_to_hash[object_id]))
+                              for object_id in object_ids],
+                            output_field=models.CharField()),
+                        **generation_update)
+            for object_id, content_hash in object_id_to_hash.items():
+                self.existing_links[content_type.id][object_id] = \
+                    (False, _digest(content_hash))
+        for content_type, object_ids in self.pending_seen.items():
+            for batch in _batches(object_ids):
+                LinkToPopoloSource.objects.filter(
+                    popolo_source=self.popolo_source,
+                    content_type=content_type,
+                    object_id__in=batch).update(**generation_update)
+        self.pending_new = {}
+        self.pending_updates = defaultdict(dict)
+        self.pending_seen = defaultdict(set)
+        self.pending_count = 0
+
+
+def _sorted_ids(object_ids):
+    """Return the distinct object IDs as a sorted array"""
+    result = array(str('L'))
+    previous = None
+    for object_id in sorted(object_ids):
+        if object_id != previous:
+            result.append(object_id)
+            previous = object_id
+    return result
+
+
+def _sorted_difference(a, b):
+    """Return the IDs in sorted array a that aren't in sorted array b"""
+    result = array(str('L'))
+    j, len_b = 0, len(b)
+    for object_id in a:
+        while j < len_b and b[j] < object_id:
+            j += 1
+        if j == len_b or b[j] != object_id:
+            result.append(object_id)
+    return result
+
 
 class CurrentObjectsTracker(object):
 
+    """An observer that records the IDs of the objects seen in an import
+
+    The IDs are appended to an array for each collection, which takes
+    a few bytes per object rather than a tuple and a set entry."""
+
     def __init__(self):
-        self.seen = set()
+        self.seen = defaultdict(lambda: array(str('L')))
 
     def notify(self, collection, django_object, created, popolo_data):
-        self.seen.add((type(django_object), django_object.id))
+        self.seen[collection].append(django_object.id)
+
+    def notify_unchanged(self, collection, django_object, popolo_data):
+        self.seen[collection].append(django_object.id)
 
     def notify_deleted(self, collection, django_object):
         pass
 
+    def merge(self, other):
+        """Add the IDs seen by another tracker to those seen by this one"""
+        for collection, seen in other.seen.items():
+            self.seen[collection].extend(seen)
+
+    def unseen(self, collection, existing_object_ids):
+        """Return the IDs in the sorted array that weren't seen
+
+        The IDs seen in that collection are discarded afterwards."""
+        seen = self.seen.pop(collection, None)
+        if not seen:
+            return existing_object_ids
+        return _sorted_difference(existing_object_ids, _sorted_ids(seen))
+
+
+@contextmanager
+def _no_transaction():
+    yield
+
+
+class IdentifierIndex(object):
+
+    """An in-memory map from Popolo JSON IDs to objects from one source
+
+    This is loaded with a single query per collection at the start of
+    an import, and kept up to date as it's notified of newly created
+    objects, so that get_existing_django_object doesn't need to query
+    the database for every object in the source. Only the collections
+    that the importer updates are loaded (so each worker of a
+    parallel import only holds its own collection); objects in the
+    others are looked up as they're referred to."""
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.reset()
+
+    def reset(self):
+        self.loaded = False
+        self.collection_to_index = {}
+
+    def load(self):
+        for collection in self.importer.tracked_collections:
+            index = defaultdict(list)
+            objects = self.importer.get_source_objects_with_identifiers(
+                collection)
+            for django_object in objects:
+                index[django_object.popolo_identifier].append(django_object)
+            self.collection_to_index[collection] = index
+        self.loaded = True
+
+    def covers(self, collection):
+        return self.loaded and collection in self.collection_to_index
+
+    def get(self, collection, popolo_id):
+        index = self.collection_to_index[collection]
+        return index.get(six.text_type(popolo_id), [])
+
+    def notify(self, collection, django_object, created, popolo_data):
+        if created and self.covers(collection):
+            index = self.collection_to_index[collection]
+            index[six.text_type(popolo_data['id'])].append(django_object)
+
+    def notify_deleted(self, collection, django_object):
+        pass
+
+
+class ChunkCommitter(object):
+
+    """An observer that commits an import every chunk_size objects
+
+    While it's active (between begin() and end()) the import runs in
+    a transaction.atomic block which is closed and reopened after
+    every chunk_size top-level objects. If there's no transaction
+    already open, that commits each chunk to the database; inside an
+    outer transaction each chunk is a savepoint instead. The
+    before_commit callback is called before each chunk is closed,
+    so that any buffered writes can be included in it."""
+
+    def __init__(self, chunk_size, before_commit):
+        self.chunk_size = chunk_size
+        self.before_commit = before_commit
+        self.atomic = None
+        self.count = 0
+
+    def begin(self):
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        self.count = 0
+
+    def end(self, exc_type=None, exc_value=None, traceback=None):
+        atomic, self.atomic = self.atomic, None
+        if atomic is None:
+            # It was already ended, by a commit that failed:
+            return
+        if exc_type is None:
+            try:
+                self.before_commit()
+            except:
+                # Otherwise the connection would be left inside the
+                # transaction for good:
+                atomic.__exit__(*sys.exc_info())
+                raise
+        atomic.__exit__(exc_type, exc_value, traceback)
+
+    def notify(self, collection, django_object, created, popolo_data):
+        if self.atomic is None:
+            return
+        self.count += 1
+        if self.count >= self.chunk_size:
+            self.end()
+            self.begin()
+
+    def notify_deleted(self, collection, django_object):
+        pass
+
+
+# The top-level key in Popolo JSON for each collection:
+COLLECTION_KEYS = {
+    'area': 'areas',
+    'organization': 'organizations',
+    'post': 'posts',
+    'person': 'persons',
+    'membership': 'memberships',
+}
+
+
+class _Concatenation(object):
+
+    # Iterables joined together, which can be iterated over more than
+    # once, and added to more iterables (as PopoloJSONImporter does
+    # with inline memberships) without making a list. If transform is
+    # given, each item is passed through it.
+
+    def __init__(self, iterables, transform=None):
+        self.iterables = iterables
+        self.transform = transform
+
+    def __iter__(self):
+        items = itertools.chain.from_iterable(self.iterables)
+        if self.transform is None:
+            return items
+        return (self.transform(item) for item in items)
+
+    def __add__(self, other):
+        return _Concatenation([self, other])
+
+    def __radd__(self, other):
+        return _Concatenation([other, self])
+
+
+class _InlineMemberships(object):
+
+    def __init__(self, persons):
+        self.persons = persons
+
+    def __iter__(self):
+        for person_data in self.persons:
+            for membership_data in person_data.get('memberships', []):
+                yield membership_data
+
+
+class _InlineAreas(object):
+
+    # The areas given inline in the collections that are left out of
+    # a CollectionsSubset, which would otherwise never be seen (and so
+    # would be marked as deleted).
+
+    def __init__(self, data, collections):
+        self.data = data
+        self.collections = collections
+
+    def __iter__(self):
+        excluded = [
+            self.data.get(COLLECTION_KEYS[collection], [])
+            for collection in ('organization', 'post', 'membership')
+            if collection not in self.collections]
+        if 'membership' not in self.collections:
+            excluded.append(_InlineMemberships(self.data.get('persons', [])))
+        for object_data in itertools.chain.from_iterable(excluded):
+            area_data = object_data.get('area')
+            if area_data:
+                yield area_data
+
+
+def _without_memberships(person_data):
+    if 'memberships' in person_data:
+        person_data = dict(person_data)
+        del person_data['memberships']
+    return person_data
+
+
+def _area_as_reference(object_data):
+    # Replace any inline area (including those of inline memberships)
+    # with a reference to it by ID, so that it's looked up rather than
+    # updated:
+    if object_data.get('area'):
+        object_data = dict(object_data)
+        object_data['area_id'] = object_data.pop('area')['id']
+    if object_data.get('memberships'):
+        object_data = dict(object_data)
+        object_data['memberships'] = [
+            _area_as_reference(m) for m in object_data['memberships']]
+    return object_data
+
+
+class CollectionsSubset(object):
+
+    """A view of Popolo JSON data with only some of its collections
+
+    The other collections look empty. Memberships given inline in
+    persons are kept if memberships are included but persons aren't,
+    and dropped if persons are included but memberships aren't. If
+    areas are included, those given inline in the other collections
+    are added to them; if not, inline areas are just referred to by
+    their IDs."""
+
+    def __init__(self, data, collections):
+        self.data = data
+        self.collections = collections
+
+    def get(self, key, default=None):
+        if key not in COLLECTION_KEYS.values():
+            return self.data.get(key, default)
+        included_keys = [COLLECTION_KEYS[c] for c in self.collections]
+        if key not in included_keys:
+            return []
+        iterables = [self.data.get(key, [])]
+        if key == 'memberships' and 'person' not in self.collections:
+            iterables.append(_InlineMemberships(self.data.get('persons', [])))
+        elif key == 'areas':
+            iterables.append(_InlineAreas(self.data, self.collections))
+        transform = None
+        if key == 'persons' and 'membership' not in self.collections:
+            transform = _without_memberships
+        elif 'area' not in self.collections:
+            transform = _area_as_reference
+        return _Concatenation(iterables, transform)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+
+class _ReferenceMap(object):
+
+    # PopoloJSONImporter looks up the objects that others refer to in
+    # dicts of the objects it has imported so far. When only some
+    # collections are being imported, this stands in for such a dict,
+    # and falls back to finding the object among those already in the
+    # source.
+
+    def __init__(self, importer, collection, objects):
+        self.importer = importer
+        self.collection = collection
+        self.objects = objects
+
+    def __getitem__(self, popolo_id):
+        try:
+            return self.objects[popolo_id]
+        except KeyError:
+            return self.importer.get_referenced_object(
+                self.collection, popolo_id)
+
 
-def _group_by_model_class(model_and_object_id_tuples):
-    class_to_object_ids = defaultdict(set)
-    for mc, object_id in model_and_object_id_tuples:
-        class_to_object_ids[mc].add(object_id)
-    for model_class, object_ids in class_to_object_ids.items():
-        yield model_class, object_ids
+class FetchedSource(object):
+
+    """A response fetched from a source, ready to be imported
+
+    not_modified is True if the server said the source wasn't
+    modified. response is None if the source was read from a
+    snapshot rather than fetched. data is the decoded Popolo JSON, or
+    None if the content is the same as when the source was last
+    imported. report is the ImportReport that the update will be
+    recorded in."""
+
+    def __init__(self, response, report, source_file=None):
+        self.response = response
+        self.not_modified = response is None
+        self.report = report
+        self.source_file = source_file
+        self.content_digest = None
+        self.data = None
+
+    def close(self):
+        if self.source_file is not None:
+            self.source_file.close()
 
 
 class PopoloSourceImporter(PopoloJSONImporter):
 
     def __init__(self, popolo_source, *args, **kwargs):
+        link_chunk_size = kwargs.pop('link_chunk_size', 500)
+        preload_identifiers = kwargs.pop('preload_identifiers', False)
+        streaming = kwargs.pop('streaming', False)
+        atomic = kwargs.pop('atomic', False)
+        commit_every = kwargs.pop('commit_every', None)
+        skip_unchanged = kwargs.pop('skip_unchanged', False)
+        session = kwargs.pop('session', None)
+        timeout = kwargs.pop('timeout', None)
+        set_based_deletions = kwargs.pop('set_based_deletions', False)
+        observer_batch_size = kwargs.pop('observer_batch_size', 500)
+        snapshot_store = kwargs.pop('snapshot_store', None)
+        collections = kwargs.pop('collections', None)
+        checkpoint = kwargs.pop('checkpoint', False)
+        workers = kwargs.pop('workers', None)
+        count_queries = kwargs.pop('count_queries', False)
+        record_changes = kwargs.pop(
+            'record_changes',
+            getattr(settings, 'POPOLO_SOURCES_RECORD_CHANGES', False))
         super(PopoloSourceImporter, self).__init__(*args, **kwargs)
+        # If checkpoint is set, the progress of an import is saved in
+        # an ImportCheckpoint as each chunk is committed, and if the
+        # import is interrupted, the next import of the same content
+        # carries on from there. The objects seen before the
+        # interruption have to be remembered in the database, so
+        # this turns on set_based_deletions.
+        if checkpoint:
+            if not commit_every:
+                raise Exception("checkpoint needs commit_every to be set")
+            if collections is not None:
+                raise Exception("checkpoint can't be used with collections")
+            set_based_deletions = True
+        self.checkpoint = checkpoint
+        self.import_checkpoint = None
+        self.position = 0
+        self.resume_position = 0
+        self.last_collection = ''
         self.popolo_source = popolo_source
-        self.add_observer(LinkCreator(popolo_source))
+        self.link_creator = LinkCreator(
+            popolo_source, chunk_size=link_chunk_size)
+        self.add_observer(self.link_creator)
+        # If preload_identifiers is set, all the objects from this
+        # source are looked up by their IDs in memory during an
+        # import, rather than with a query for each object.
+        self.identifier_index = None
+        if preload_identifiers:
+            self.identifier_index = IdentifierIndex(self)
+            self.add_observer(self.identifier_index)
+        # If streaming is set, the source is downloaded to a temporary
+        # file and parsed incrementally, rather than being decoded
+        # into memory all at once.
+        if streaming:
+            check_streaming_available()
+        self.streaming = streaming
+        # If atomic is set, the whole of update_from_source runs in
+        # one transaction. If commit_every is set, the import itself is
+        # committed in chunks of that many objects (or, inside another
+        # transaction, each chunk is a savepoint). Either way, objects
+        # are only marked as deleted from the source if the whole
+        # import succeeded.
+        self.atomic = atomic
+        self.chunk_committer = None
+        if commit_every:
+            self.chunk_committer = ChunkCommitter(
+                commit_every, before_commit=self.before_chunk_commit)
+            self.add_observer(self.chunk_committer)
+        # If skip_unchanged is set, objects whose Popolo JSON is
+        # identical to the last time they were imported from this
+        # source aren't updated at all. Observers are told about them
+        # with notify_unchanged, if they implement it, rather than
+        # with notify.
+        self.skip_unchanged = skip_unchanged
+        self.skipping_unchanged = False
+        # The collection, ID and object (or None) of the object that
+        # was last looked up to see if it's unchanged:
+        self.looked_up = None
+        # The source is fetched with session, if it's given, which
+        # lets connections be reused across sources; timeout is
+        # passed on to requests.
+        self.session = session
+        self.timeout = timeout
+        # If count_queries is set, the report of each update includes
+        # the number of queries in each phase. That routes every query
+        # through Django's debug cursor, so it's off by default.
+        self.count_queries = count_queries
+        # If set_based_deletions is set, the objects seen in an import
+        # are recorded by stamping their links with a new import
+        # generation, rather than by keeping them in memory, and the
+        # links that weren't stamped are marked as deleted with one
+        # UPDATE per content type.
+        self.set_based_deletions = set_based_deletions
+        # Observers added with add_batch_observer are notified of
+        # imported and deleted objects in groups of up to
+        # observer_batch_size, rather than one at a time.
+        self.batch_observers = []
+        self.observer_batch_size = observer_batch_size
+        self.pending_notifications = defaultdict(list)
+        # If snapshot_store is set, every fetched source is saved in
+        # it, so that it can be imported again later with
+        # update_from_snapshot.
+        self.snapshot_store = snapshot_store
+        # If collections is set, only those collections are imported,
+        # and only objects in them can be marked as deleted. Objects
+        # in other collections that are referred to are looked up
+        # among those already imported from the source.
+        if collections is not None:
+            collections = tuple(collections)
+            for collection in collections:
+                if collection not in NEW_COLLECTIONS:
+                    raise Exception(
+                        "Unknown collection '{0}'".format(collection))
+        self.collections = collections
+        self.referenced_objects = {}
+        # If workers is set, update_from_data imports the collections
+        # in that many threads, each with its own database connection;
+        # see popolo_sources.parallel. Those can't share a transaction
+        # or the position of a checkpoint.
+        if workers:
+            if atomic:
+                raise Exception("workers can't be used with atomic")
+            if checkpoint:
+                raise Exception("workers can't be used with checkpoint")
+        self.workers = workers
+        # If record_changes is set, each update is recorded as an
+        # ImportRun, with an ObjectChange for every object that's
+        # changed; see popolo_sources.changes.
+        self.record_changes = record_changes
+        self.change_log = None
+
+    @property
+    def tracked_collections(self):
+        """The collections that this importer updates"""
+        if self.collections is None:
+            return NEW_COLLECTIONS
+        return [c for c in NEW_COLLECTIONS if c in self.collections]
+
+    def get_referenced_object(self, collection, popolo_id):
+        key = (collection, popolo_id)
+        if key not in self.referenced_objects:
+            existing = self.get_existing_django_object(collection, popolo_id)
+            if existing is None:
+                raise KeyError(popolo_id)
+            self.referenced_objects[key] = existing
+        return self.referenced_objects[key]
+
+    def make_worker_importer(self, collection, observers=()):
+        """Return an importer for one collection, for a parallel import
+
+        It has the same options as this one, and is also given the
+        observers and this importer's batch observers."""
+        commit_every = None
+        if self.chunk_committer is not None:
+            commit_every = self.chunk_committer.chunk_size
+        worker = self.__class__(
+            self.popolo_source,
+            collections=[collection],
+            link_chunk_size=self.link_creator.chunk_size,
+            preload_identifiers=self.identifier_index is not None,
+            commit_every=commit_every,
+            skip_unchanged=self.skip_unchanged,
+            set_based_deletions=self.set_based_deletions,
+            observer_batch_size=self.observer_batch_size)
+        worker.skipping_unchanged = self.skipping_unchanged
+        for observer in observers:
+            worker.add_observer(observer)
+        for observer in self.batch_observers:
+            worker.add_batch_observer(observer)
+        if self.change_log is not None:
+            worker.change_log = ChangeLog(
+                self.change_log.import_run, worker.link_creator,
+                chunk_size=self.change_log.chunk_size)
+            worker.link_creator.change_log = worker.change_log
+            worker.add_observer(worker.change_log)
+        return worker
+
+    def add_batch_observer(self, observer):
+        """Add an observer to be notified of objects in batches
+
+        Rather than notify and notify_deleted, the observer should
+        implement notify_batch(collection, items), where items is a
+        list of (django_object, created, popolo_data) tuples, and
+        notify_deleted_batch(collection, django_objects)."""
+        self.batch_observers.append(observer)
+
+    def notify_observers(self, collection, django_object, created, popolo_data):
+        super(PopoloSourceImporter, self).notify_observers(
+            collection, django_object, created, popolo_data)
+        if not self.batch_observers:
+            return
+        pending = self.pending_notifications[collection]
+        pending.append((django_object, created, popolo_data))
+        if len(pending) >= self.observer_batch_size:
+            self.flush_notifications()
+
+    def flush_notifications(self):
+        """Send any buffered notifications to the batch observers"""
+        for collection, items in self.pending_notifications.items():
+            for observer in self.batch_observers:
+                observer.notify_batch(collection, items)
+        self.pending_notifications = defaultdict(list)
+
+    def flush_buffers(self):
+        self.link_creator.flush()
+        self.flush_notifications()
+        if self.change_log is not None:
+            self.change_log.flush()
+
+    def before_chunk_commit(self):
+        self.flush_buffers()
+        if self.import_checkpoint is not None:
+            self.save_checkpoint()
+
+    def load_checkpoint(self, content_digest):
+        """Return the ImportCheckpoint for importing content_digest
+
+        If an import of the same content was interrupted, its
+        checkpoint is returned, so that the import can be resumed.
+        Otherwise the checkpoint is for a new import generation,
+        starting from the beginning."""
+        try:
+            checkpoint = ImportCheckpoint.objects.get(
+                popolo_source=self.popolo_source)
+            if checkpoint.content_digest == content_digest:
+                return checkpoint
+        except ImportCheckpoint.DoesNotExist:
+            checkpoint = ImportCheckpoint(popolo_source=self.popolo_source)
+        checkpoint.content_digest = content_digest
+        checkpoint.import_generation = self.next_import_generation()
+        checkpoint.collection = ''
+        checkpoint.position = 0
+        return checkpoint
+
+    def save_checkpoint(self):
+        checkpoint = self.import_checkpoint
+        # Objects that were skipped because they'd already been
+        # imported before an interruption still count:
+        if self.position > checkpoint.position:
+            checkpoint.position = self.position
+            checkpoint.collection = self.last_collection
+        checkpoint.save()
+
+    def notify_observers_of_deleted_objects(self, collection, popolo_objects):
+        """Notify observers of an iterable of deleted objects, in chunks"""
+        for chunk in _batches(popolo_objects, self.observer_batch_size):
+            for observer in self.observers:
+                for popolo_object in chunk:
+                    observer.notify_deleted(collection, popolo_object)
+            for observer in self.batch_observers:
+                observer.notify_deleted_batch(collection, chunk)
 
     def get_existing_objects(self, deleted):
-        model_and_object_id_tuples = set()
-        for collection in NEW_COLLECTIONS:
-            ct = ContentType.objects.get(app_label='popolo', model=collection)
-            model_class = ct.model_class()
-            for ltps in LinkToPopoloSource.objects.filter(
+        """Return a sorted array of the linked object IDs per collection"""
+        collection_to_object_ids = {}
+        for collection in self.tracked_collections:
+            content_type = self.link_creator.collection_to_content_type[
+                collection]
+            collection_to_object_ids[collection] = array(
+                str('L'),
+                LinkToPopoloSource.objects.filter(
                     deleted_from_source=deleted,
                     popolo_source=self.popolo_source,
-                    content_type=ct):
-                model_and_object_id_tuples.add(
-                    (model_class, ltps.object_id)
-                )
-        return model_and_object_id_tuples
-
-    def mark_as_deleted(self, model_and_object_id_tuples):
-        iterator = _group_by_model_class(model_and_object_id_tuples)
-        for model_class, object_ids in iterator:
-            content_type = ContentType.objects.get_for_model(model_class)
-            LinkToPopoloSource.objects.filter(
+                    content_type=content_type).order_by(
+                        'object_id').values_list(
+                            'object_id', flat=True).iterator())
+        return collection_to_object_ids
+
+    def mark_as_deleted(self, collection_to_object_ids):
+        for collection, object_ids in collection_to_object_ids.items():
+            content_type = self.link_creator.collection_to_content_type[
+                collection]
+            for batch in _batches(object_ids):
+                LinkToPopoloSource.objects.filter(
+                    popolo_source=self.popolo_source,
+                    content_type=content_type,
+                    object_id__in=batch).update(
+                        deleted_from_source=True,
+                        deleted_at=timezone.now())
+
+    def notify_observers_of_deletions(self, collection_to_object_ids):
+        for collection, object_ids in collection_to_object_ids.items():
+            model_class = self.link_creator.collection_to_content_type[
+                collection].model_class()
+            self.notify_observers_of_deleted_objects(
+                collection,
+                (popolo_object
+                 for batch in _batches(object_ids)
+                 for popolo_object in model_class.objects.filter(
+                     pk__in=batch).iterator()))
+
+    def next_import_generation(self):
+        latest = LinkToPopoloSource.objects.filter(
+            popolo_source=self.popolo_source).aggregate(
+                latest=Max('import_generation'))['latest']
+        return (latest or 0) + 1
+
+    def mark_unseen_as_deleted(self, generation):
+        """Mark live links not seen in the generation's import as deleted
+
+        Each one is stamped with the generation, so that they can be
+        found by notify_observers_of_unseen_deletions. This returns
+        the number of links marked in each collection."""
+        counts = {}
+        for collection in self.tracked_collections:
+            content_type = self.link_creator.collection_to_content_type[
+                collection]
+            counts[collection] = LinkToPopoloSource.objects.filter(
                 popolo_source=self.popolo_source,
                 content_type=content_type,
-                object_id__in=object_ids).update(
-                    deleted_from_source=True)
-
-    def notify_observers_of_deletions(self, model_and_object_id_tuples):
-        iterator = _group_by_model_class(model_and_object_id_tuples)
-        for model_class, object_ids in iterator:
-            collection = model_class.__name__.lower()
-            for popolo_object in model_class.objects.filter(pk__in=object_ids):
-                for observer in self.observers:
-                    observer.notify_deleted(collection, popolo_object)
+                deleted_from_source=False,
+                import_generation__lt=generation).update(
+                    deleted_from_source=True,
+                    deleted_at=timezone.now(),
+                    import_generation=generation)
+        return counts
 
-    def update_from_source(self):
-        # Save the objects we knew about before the update:
-        existing_live_objects = self.get_existing_objects(False)
-        existing_deleted_objects = self.get_existing_objects(True)
-        # And set up a tracker to see what's now in the source:
-        tracker = CurrentObjectsTracker()
-        self.add_observer(tracker)
-        # Then do the update:
-        r = requests.get(self.popolo_source.url)
+    def notify_observers_of_unseen_deletions(self, generation):
+        for collection in self.tracked_collections:
+            content_type = self.link_creator.collection_to_content_type[
+                collection]
+            deleted_object_ids = LinkToPopoloSource.objects.filter(
+                popolo_source=self.popolo_source,
+                content_type=content_type,
+                deleted_from_source=True,
+                import_generation=generation).values('object_id')
+            model_class = content_type.model_class()
+            self.notify_observers_of_deleted_objects(
+                collection,
+                model_class.objects.filter(
+                    pk__in=deleted_object_ids).iterator())
+
+    def notify_observers_unchanged(self, collection, django_object, data):
+        for observer in self.observers:
+            notify_unchanged = getattr(observer, 'notify_unchanged', None)
+            if notify_unchanged is not None:
+                notify_unchanged(collection, django_object, data)
+
+    def update_unless_unchanged(self, collection, update, data, *args):
+        """Update an object, unless it can be skipped
+
+        An object is skipped if it was imported before an interrupted
+        import was, or if skip_unchanged is in effect and it's still
+        live in this source with the same content hash as the last
+        time it was imported."""
+        position = self.position
+        self.position += 1
+        self.last_collection = collection
+        if position < self.resume_position:
+            # This was imported before the import was interrupted:
+            existing = self.get_existing_django_object(
+                collection, data['id'])
+            if existing is not None:
+                return data['id'], existing
+        if self.skipping_unchanged:
+            existing = self.get_existing_django_object(collection, data['id'])
+            if existing is not None and self.link_creator.is_unchanged(
+                    collection, existing, self.link_creator.content_hash(data)):
+                self.notify_observers_unchanged(collection, existing, data)
+                return data['id'], existing
+            # update() would otherwise look the object up again:
+            self.looked_up = (collection, data['id'], existing)
+        try:
+            return update(data, *args)
+        finally:
+            self.looked_up = None
+
+    def update_area(self, area_data):
+        return self.update_unless_unchanged(
+            'area',
+            super(PopoloSourceImporter, self).update_area,
+            area_data)
+
+    def update_organization(self, org_data, area):
+        return self.update_unless_unchanged(
+            'organization',
+            super(PopoloSourceImporter, self).update_organization,
+            org_data, area)
+
+    def update_post(self, post_data, area, org_id_to_django_object):
+        if self.collections is not None:
+            org_id_to_django_object = _ReferenceMap(
+                self, 'organization', org_id_to_django_object)
+        return self.update_unless_unchanged(
+            'post',
+            super(PopoloSourceImporter, self).update_post,
+            post_data, area, org_id_to_django_object)
+
+    def update_person(self, person_data):
+        return self.update_unless_unchanged(
+            'person',
+            super(PopoloSourceImporter, self).update_person,
+            person_data)
+
+    def update_membership(self, membership_data, *args):
+        # Memberships without an ID in the Popolo JSON are given one
+        # by update_membership; we need it before then to find the
+        # existing membership.
+        if 'id' not in membership_data:
+            membership_data['id'] = generate_membership_id(membership_data)
+        if self.collections is not None:
+            area, org_map, post_map, person_map = args
+            args = (
+                area,
+                _ReferenceMap(self, 'organization', org_map),
+                _ReferenceMap(self, 'post', post_map),
+                _ReferenceMap(self, 'person', person_map),
+            )
+        return self.update_unless_unchanged(
+            'membership',
+            super(PopoloSourceImporter, self).update_membership,
+            membership_data, *args)
+
+    def import_from_export_json_data(self, data):
+        # The links to the source are buffered by the LinkCreator, and
+        # notifications to batch observers are buffered too, so make
+        # sure they're all sent before returning:
+        self.link_creator.reset()
+        self.link_creator.events = {
+            event_data['id']: event_data
+            for event_data in data.get('events', [])}
+        self.pending_notifications = defaultdict(list)
+        self.referenced_objects = {}
+        self.position = 0
+        if self.collections is not None:
+            data = CollectionsSubset(data, self.collections)
+        if self.identifier_index is not None:
+            self.identifier_index.load()
+        if self.chunk_committer is not None:
+            self.chunk_committer.begin()
+        try:
+            super(PopoloSourceImporter, self).import_from_export_json_data(
+                data)
+            if self.chunk_committer is not None:
+                self.chunk_committer.end()
+            else:
+                self.flush_buffers()
+        except:
+            if self.chunk_committer is not None:
+                self.chunk_committer.end(*sys.exc_info())
+            raise
+        finally:
+            if self.identifier_index is not None:
+                self.identifier_index.reset()
+
+    def fetch_source(self, force=False):
+        """Fetch the source, returning None if it's not been modified
+
+        Unless force is True, the request is made conditional on the
+        ETag and Last-Modified headers from the last import. A file://
+        URL is read from the local filesystem instead."""
+        if is_file_url(self.popolo_source.url):
+            r = LocalFileResponse(self.popolo_source.url)
+            if not force and self.popolo_source.etag == r.headers['ETag']:
+                return None
+            return r
+        headers = {}
+        if not force:
+            if self.popolo_source.etag:
+                headers['If-None-Match'] = self.popolo_source.etag
+            if self.popolo_source.last_modified:
+                headers['If-Modified-Since'] = self.popolo_source.last_modified
+        get = requests.get if self.session is None else self.session.get
+        r = get(
+            self.popolo_source.url,
+            headers=headers,
+            stream=self.streaming,
+            timeout=self.timeout)
+        if r.status_code == 304 and not force:
+            return None
         r.raise_for_status()
-        self.import_from_export_json_data(r.json())
-        # Now after importing, we can find those objects that no
-        # longer exist in the source and mark them as such.
-        disappeared = existing_live_objects - tracker.seen
-        self.mark_as_deleted(disappeared)
-        self.notify_observers_of_deletions(disappeared)
+        return r
+
+    def fetch(self, force=False):
+        """Fetch and decode the source, returning a FetchedSource
+
+        This doesn't use the database, so it can be run in a different
+        thread from update_from_fetched. If the server says the source
+        hasn't been modified, the FetchedSource has no response. If
+        the content of the source is identical to that of the last
+        import, it has no data, unless force is True. If only some
+        collections are being updated, it's always fetched, since the
+        last import may not have included them."""
+        if self.collections is not None:
+            force = True
+        report = ImportReport(
+            self.popolo_source, count_queries=self.count_queries)
+        with report.phase('fetch'):
+            r = self.fetch_source(force=force)
+            source_file = None
+            if r is not None:
+                if self.streaming:
+                    if isinstance(r, LocalFileResponse) and not r.compressed:
+                        source_file, content_digest = r.map()
+                    else:
+                        source_file, content_digest = spool_response(r)
+                else:
+                    content = r.content
+        fetched = FetchedSource(r, report, source_file)
+        if r is None:
+            return fetched
+        try:
+            with report.phase('decode'):
+                if self.streaming:
+                    fetched.content_digest = content_digest
+                else:
+                    content = decompress_content(content)
+                    fetched.content_digest = \
+                        hashlib.sha256(content).hexdigest()
+                if force or fetched.content_digest != \
+                        self.popolo_source.content_digest:
+                    if self.streaming:
+                        fetched.data = StreamedPopoloData(source_file)
+                    else:
+                        fetched.data = json.loads(content.decode('utf-8'))
+            if self.snapshot_store is not None:
+                with report.phase('save_snapshot'):
+                    if self.streaming:
+                        source_file.seek(0)
+                        content_file = source_file
+                    else:
+                        content_file = io.BytesIO(content)
+                    self.snapshot_store.save(
+                        self.popolo_source, fetched.content_digest,
+                        content_file)
+        except:
+            fetched.close()
+            raise
+        return fetched
+
+    def fetch_snapshot(self, content_digest=None):
+        """Read a snapshot of the source, returning a FetchedSource
+
+        This uses the snapshot with the given digest, or otherwise
+        the most recent one. There's no network access, and the data
+        is always decoded, even if it's the same as the last import."""
+        if self.snapshot_store is None:
+            raise Exception("This importer has no snapshot_store")
+        snapshot = self.snapshot_store.get(self.popolo_source, content_digest)
+        report = ImportReport(
+            self.popolo_source, count_queries=self.count_queries)
+        with report.phase('decode'):
+            snapshot_file = snapshot.open()
+            fetched = FetchedSource(None, report, snapshot_file)
+            fetched.not_modified = False
+            fetched.content_digest = snapshot.content_digest
+            try:
+                if self.streaming:
+                    fetched.data = StreamedPopoloData(snapshot_file)
+                else:
+                    fetched.data = json.loads(
+                        snapshot_file.read().decode('utf-8'))
+            except:
+                fetched.close()
+                raise
+        return fetched
+
+    def record_fetched_source(self, response, content_digest):
+        """Store the validators and digest of an imported response
+
+        If response is None (because the data came from a snapshot)
+        the validators are cleared, so that the next fetch isn't
+        conditional on a response that wasn't imported."""
+        headers = {} if response is None else response.headers
+        self.popolo_source.etag = headers.get('ETag', '')
+        self.popolo_source.last_modified = headers.get('Last-Modified', '')
+        self.popolo_source.content_digest = content_digest
+        self.popolo_source.save(
+            update_fields=['etag', 'last_modified', 'content_digest'])
+
+    def update_from_source(self, force=False):
+        """Update from the source, returning an ImportReport
+
+        The import is skipped if the server says the source hasn't
+        been modified, or if its content is identical to that of the
+        last import, in which case the report is false. If force is
+        True, it's always fetched and imported, and no objects are
+        skipped as unchanged."""
+        fetched = self.fetch(force=force)
+        try:
+            return self.update_from_fetched(fetched, force=force)
+        finally:
+            fetched.close()
+
+    def plan(self, from_snapshot=False):
+        """Work out what updating from the source would change
+
+        This returns an ImportPlan, without writing anything to the
+        database. The source is always fetched, unless from_snapshot
+        is True, in which case its latest snapshot is used."""
+        if from_snapshot:
+            fetched = self.fetch_snapshot()
+        else:
+            fetched = self.fetch(force=True)
+        try:
+            return self.plan_from_data(fetched.data)
+        finally:
+            fetched.close()
+
+    def plan_from_data(self, data):
+        """Return an ImportPlan of what importing data would change"""
+        # This is imported here since popolo_sources.plans depends on
+        # this module:
+        from popolo_sources.plans import ImportPlanner
+        return ImportPlanner(self).plan(data)
+
+    def update_from_snapshot(self, content_digest=None, force=False):
+        """Update from a snapshot of the source, returning an ImportReport
+
+        See fetch_snapshot for which snapshot is used. force has the
+        same effect on skipping unchanged objects as it does for
+        update_from_source."""
+        fetched = self.fetch_snapshot(content_digest)
+        try:
+            return self.update_from_fetched(fetched, force=force)
+        finally:
+            fetched.close()
+
+    def resume(self):
+        """Resume an interrupted import from its snapshot
+
+        This needs checkpoint and a snapshot_store, and imports the
+        snapshot of the content that was being imported when the
+        import was interrupted, so it carries on with the same data
+        even if the source has changed since. It returns an
+        ImportReport."""
+        try:
+            checkpoint = ImportCheckpoint.objects.get(
+                popolo_source=self.popolo_source)
+        except ImportCheckpoint.DoesNotExist:
+            msg = "There's no interrupted import of {0} to resume"
+            raise Exception(msg.format(repr(self.popolo_source)))
+        return self.update_from_snapshot(checkpoint.content_digest)
+
+    def update_from_fetched(self, fetched, force=False):
+        """Update from a FetchedSource, returning an ImportReport"""
+        self.skipping_unchanged = self.skip_unchanged and not force
+        report = fetched.report
+        with report.counting_queries():
+            if fetched.not_modified:
+                report.skipped_reason = 'not modified'
+            elif fetched.data is None:
+                report.skipped_reason = 'content unchanged'
+                # Remember any new validators, so that next time the
+                # server has a chance to tell us nothing's changed:
+                with report.phase('record_fetched_source'):
+                    self.record_fetched_source(
+                        fetched.response, fetched.content_digest)
+            else:
+                try:
+                    with self.update_transaction():
+                        self.update_from_data(
+                            fetched.data, report, fetched.content_digest)
+                        # After a partial update the other collections
+                        # may still be out of date, so the next full
+                        # update mustn't be skipped:
+                        if self.collections is None:
+                            with report.phase('record_fetched_source'):
+                                self.record_fetched_source(
+                                    fetched.response, fetched.content_digest)
+                finally:
+                    # Even a failed import may have committed some
+                    # changes to the links, if commit_every is set:
+                    live_object_ids.invalidate(self.popolo_source)
+                report.updated = True
+        import_finished.send(
+            sender=self.__class__,
+            popolo_source=self.popolo_source,
+            report=report)
+        return report
+
+    def update_transaction(self):
+        """Return the context manager that update_from_source runs in"""
+        if self.atomic:
+            return transaction.atomic()
+        return _no_transaction()
+
+    def update_from_data(self, data, report=None, content_digest=None):
+        """Import data and mark objects that are missing from it as deleted
+
+        The phases of the update and the objects affected are
+        recorded in report, if it's given. If checkpoint is set,
+        content_digest identifies the data, so that an interrupted
+        import of it can be resumed; if record_changes is set, it's
+        recorded on the ImportRun."""
+        if report is None:
+            report = ImportReport(
+                self.popolo_source, count_queries=self.count_queries)
+        with self.recording_changes(content_digest):
+            generation = None
+            tracker = None
+            checkpoint = None
+            if self.checkpoint and content_digest is not None:
+                with report.phase('load_checkpoint'):
+                    checkpoint = self.load_checkpoint(content_digest)
+                generation = checkpoint.import_generation
+                self.resume_position = checkpoint.position
+                report.resumed_from = checkpoint.position or None
+                self.import_checkpoint = checkpoint
+            elif self.set_based_deletions:
+                with report.phase('next_import_generation'):
+                    generation = self.next_import_generation()
+            if self.set_based_deletions:
+                self.link_creator.generation = generation
+                observers = [report]
+            else:
+                # Save the objects we knew about before the update:
+                with report.phase('get_existing_objects'):
+                    existing_live_objects = self.get_existing_objects(False)
+                # And set up a tracker to see what's now in the source:
+                tracker = CurrentObjectsTracker()
+                observers = [tracker, report]
+            # Any workers are given the observers that were added with
+            # add_observer:
+            own_observers = (
+                self.link_creator, self.identifier_index,
+                self.chunk_committer, self.change_log)
+            added_observers = [
+                o for o in self.observers if o not in own_observers]
+            for observer in observers:
+                self.add_observer(observer)
+            try:
+                # Then do the update:
+                with report.phase('import'):
+                    if self.workers:
+                        from popolo_sources.parallel import import_in_parallel
+                        workers_tracker, workers_report = import_in_parallel(
+                            self, data, self.workers, generation,
+                            added_observers)
+                        if tracker is not None:
+                            tracker.merge(workers_tracker)
+                        report.add_counts(workers_report)
+                    else:
+                        self.import_from_export_json_data(data)
+            finally:
+                self.link_creator.generation = None
+                self.import_checkpoint = None
+                self.resume_position = 0
+                for observer in observers:
+                    self.observers.remove(observer)
+            for collection, count in self.link_creator.reappeared.items():
+                report.count(collection, 'reappeared', count)
+            # Now after importing, we can find those objects that no
+            # longer exist in the source and mark them as such.
+            with transaction.atomic():
+                if self.set_based_deletions:
+                    with report.phase('mark_as_deleted'):
+                        counts = self.mark_unseen_as_deleted(generation)
+                    with report.phase('notify_observers_of_deletions'):
+                        self.notify_observers_of_unseen_deletions(generation)
+                        self.flush_change_log()
+                    for collection, count in counts.items():
+                        if count:
+                            report.count(collection, 'disappeared', count)
+                    if checkpoint is not None and checkpoint.pk is not None:
+                        checkpoint.delete()
+                else:
+                    disappeared = {
+                        collection: tracker.unseen(collection, object_ids)
+                        for collection, object_ids
+                        in existing_live_objects.items()}
+                    with report.phase('mark_as_deleted'):
+                        self.mark_as_deleted(disappeared)
+                    with report.phase('notify_observers_of_deletions'):
+                        self.notify_observers_of_deletions(disappeared)
+                        self.flush_change_log()
+                    for collection, object_ids in disappeared.items():
+                        if object_ids:
+                            report.count(
+                                collection, 'disappeared', len(object_ids))
+
+    @contextmanager
+    def recording_changes(self, content_digest=None):
+        """Record what's changed in this block, if record_changes is set
+
+        An ImportRun is created, and a ChangeLog observes the import
+        until the end of the block, when the run is marked as
+        finished."""
+        if not self.record_changes:
+            yield
+            return
+        import_run = ImportRun.objects.create(
+            popolo_source=self.popolo_source,
+            content_digest=content_digest or '')
+        self.change_log = ChangeLog(
+            import_run, self.link_creator,
+            chunk_size=self.link_creator.chunk_size)
+        self.link_creator.change_log = self.change_log
+        self.add_observer(self.change_log)
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self.observers.remove(self.change_log)
+            self.change_log = None
+            self.link_creator.change_log = None
+            # If the failure has left a transaction to be rolled back,
+            # the run will be rolled back with it:
+            if succeeded or not (
+                    connection.in_atomic_block and connection.get_rollback()):
+                ImportRun.objects.filter(pk=import_run.pk).update(
+                    finished_at=timezone.now(), succeeded=succeeded)
+
+    def flush_change_log(self):
+        if self.change_log is not None:
+            self.change_log.flush()
 
     # We need to override this so that we only consider something an
     # existing object if it's from the same PopoloSource, as well as
@@ -113,11 +1409,75 @@ class PopoloSourceImporter(PopoloJSONImporter):
             raise Exception("Unknown collection '{collection}'".format(
                 collection=popit_collection
             ))
+        if self.looked_up is not None \
+                and self.looked_up[:2] == (popit_collection, popit_id):
+            return self.looked_up[2]
+        pending = self.link_creator.get_pending(popit_collection, popit_id)
+        if pending is not None:
+            return pending
         model_class = self.get_popolo_model_class(popit_collection)
+        if self.identifier_index is not None \
+                and self.identifier_index.covers(popit_collection):
+            matching_objects = self.identifier_index.get(
+                popit_collection, popit_id)
+        else:
+            matching_objects = list(self.get_source_objects_with_identifiers(
+                popit_collection, popit_id))
+        count = len(matching_objects)
+        if not count:
+            return None
+        if count > 1:
+            msg = "Unexpectedly found more than 1 objects matching " \
+                "{source}, collection '{collection}' and ID '{popit_id}' - " \
+                "found {count} instead."
+            raise model_class.MultipleObjectsReturned(msg.format(
+                source=self.popolo_source,
+                collection=popit_collection,
+                popit_id=popit_id,
+                count=count,
+            ))
+        return matching_objects[0]
+
+    def get_source_identifiers(self, collection):
+        """Yield the Popolo JSON ID and object ID of each object in collection
+
+        This is like get_source_objects_with_identifiers, but doesn't
+        load the objects themselves."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                '''
+SELECT pi.identifier, pi.object_id
+    FROM popolo_identifier pi,
+         django_content_type ct,
+         popolo_sources_linktopopolosource ltps
+    WHERE pi.content_type_id = ct.id AND
+          pi.scheme = '{id_prefix}{collection}' AND
+          ct.app_label = 'popolo' AND
+          ct.model = %s AND
+          ltps.content_type_id = ct.id AND
+          ltps.object_id = pi.object_id AND
+          ltps.popolo_source_id = %s
+'''.format(id_prefix=self.id_prefix, collection=collection),
+                [collection, self.popolo_source.id])
+            for row in cursor.fetchall():
+                yield row
+
+    def get_source_objects_with_identifiers(self, collection, popit_id=None):
+        """Return objects in collection from this source with their IDs
+
+        Each object returned has a popolo_identifier attribute with
+        its ID in the Popolo JSON. If popit_id is given, only objects
+        with that ID are returned."""
+        model_class = self.get_popolo_model_class(collection)
+        params = [collection, self.popolo_source.id]
+        identifier_condition = ''
+        if popit_id is not None:
+            identifier_condition = 'pi.identifier = %s AND'
+            params.insert(0, popit_id)
         # Expressing this in the Django ORM is too painful for me.
-        raw_qs = model_class.objects.raw(
+        return model_class.objects.raw(
             '''
-SELECT po.*
+SELECT po.*, pi.identifier AS popolo_identifier
     FROM popolo_{collection} po,
          popolo_identifier pi,
             django_content_type ct,
@@ -125,27 +1485,15 @@ SELECT po.*
     WHERE po.id = pi.object_id AND
           pi.content_type_id = ct.id AND
           pi.scheme = '{id_prefix}{collection}' AND
-          pi.identifier = %s AND
+          {identifier_condition}
           ct.app_label = 'popolo' AND
           ct.model = %s AND
           ltps.content_type_id = ct.id AND
           ltps.object_id = po.id AND
           ltps.popolo_source_id = %s
-'''.format(id_prefix=self.id_prefix, collection=popit_collection),
-            [popit_id, popit_collection, self.popolo_source.id]
+'''.format(
+                id_prefix=self.id_prefix,
+                collection=collection,
+                identifier_condition=identifier_condition),
+            params
         )
-        matching_objects = list(raw_qs)
-        count = len(matching_objects)
-        if not count:
-            return None
-        if count > 1:
-            msg = "Unexpectedly found more than 1 objects matching " \
-                "{source}, collection '{collection}' and ID '{popit_id}' - " \
-                "found {count} instead."
-            raise model_class.MultipleObjectsReturned(msg.format(
-                source=self.popolo_source,
-                collection=popit_collection,
-                popit_id=popit_id,
-                count=count,
-            ))
-        return matching_objects[0]
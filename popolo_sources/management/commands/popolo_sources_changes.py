@@ -0,0 +1,50 @@
+from __future__ import print_function, unicode_literals
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from popolo_sources.changes import changes_in_run, readable_runs
+from popolo_sources.models import PopoloSource
+
+
+class Command(BaseCommand):
+
+    help = 'Print the objects changed by updates after a given import run'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', type=int, default=0,
+            help='Only print changes from import runs after the one '
+            'with this ID')
+        parser.add_argument(
+            '--source', type=int,
+            help='Only print changes to the source with this ID')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Read this many changes from the database at a time')
+
+    def handle(self, *args, **options):
+        popolo_source = None
+        if options['source'] is not None:
+            try:
+                popolo_source = PopoloSource.objects.get(pk=options['source'])
+            except PopoloSource.DoesNotExist:
+                raise CommandError('Source not found')
+        runs = list(readable_runs(options['since'], popolo_source))
+        # Each line is tab-separated: the import run ID, the source
+        # ID, the change, the content type and the object ID.
+        for import_run in runs:
+            for change in changes_in_run(import_run, options['batch_size']):
+                print('\t'.join(str(v) for v in (
+                    import_run.id,
+                    import_run.popolo_source_id,
+                    change.change,
+                    '{0.app_label}.{0.model}'.format(change.content_type),
+                    change.object_id)))
+        # That includes runs that didn't change anything, so that
+        # they're not read again:
+        last_run_id = runs[-1].id if runs else options['since']
+        print(
+            "Read the changes up to import run {0}".format(last_run_id),
+            file=sys.stderr)
@@ -0,0 +1,29 @@
+from __future__ import print_function, unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from popolo_sources.changes import prune_changes
+
+
+class Command(BaseCommand):
+
+    help = 'Delete the recorded changes of old import runs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, required=True,
+            help='Delete import runs that finished (or were abandoned) '
+            'more than this many days ago, with their changes')
+        parser.add_argument(
+            '--batch-size', type=int, default=300,
+            help='Delete this many changes at a time')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError("--days can't be negative")
+        before = timezone.now() - timedelta(days=options['days'])
+        deleted = prune_changes(before, options['batch_size'])
+        print("Deleted {0} changes".format(deleted))
@@ -0,0 +1,44 @@
+from __future__ import print_function, unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from popolo_sources.cleanup import purge_deleted_links
+
+
+class Command(BaseCommand):
+
+    help = 'Delete links to objects that were deleted from their sources ' \
+        'long ago'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, required=True,
+            help='Delete links that were marked as deleted more than this '
+            'many days ago')
+        parser.add_argument(
+            '--batch-size', type=int, default=300,
+            help='Delete this many links at a time, each batch in its own '
+            'transaction')
+        parser.add_argument(
+            '--max-rate', type=float,
+            help='Delete at most this many links a second on average')
+        parser.add_argument(
+            '--delete-orphans', action='store_true',
+            help='Also delete the objects of those links that no other '
+            'source links to')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError("--days can't be negative")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        before = timezone.now() - timedelta(days=options['days'])
+        links_deleted, objects_deleted = purge_deleted_links(
+            before, options['batch_size'], options['max_rate'],
+            options['delete_orphans'])
+        print("Deleted {0} links".format(links_deleted))
+        if options['delete_orphans']:
+            print("Deleted {0} orphaned objects".format(objects_deleted))
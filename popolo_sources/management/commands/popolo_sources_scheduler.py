@@ -0,0 +1,113 @@
+from __future__ import print_function, unicode_literals
+
+import signal
+import sys
+import threading
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, reset_queries
+from django.utils import timezone
+
+from popolo_sources.fetching import make_session
+from popolo_sources.scheduling import (
+    due_sources, record_update_result, seconds_until_next_due)
+
+from .popolo_sources_update import update_sources_with_concurrent_fetches
+
+
+class Command(BaseCommand):
+
+    help = 'Keep running, updating each source when its update interval ' \
+        'has passed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fetch-jobs', type=int, default=4,
+            help='Fetch this many sources at once, importing each in '
+            'turn as it arrives')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Look for at most this many due sources at a time')
+        parser.add_argument(
+            '--poll-interval', type=float, default=60,
+            help='Check for new or rescheduled sources at least this '
+            'often, in seconds')
+        parser.add_argument(
+            '--timeout', type=float, default=60,
+            help='The timeout in seconds for fetching a source')
+        parser.add_argument(
+            '--retries', type=int, default=3,
+            help='How many times to retry fetching a source')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Update the sources that are due, then exit')
+
+    def handle(self, *args, **options):
+        if options['fetch_jobs'] < 1:
+            raise CommandError("--fetch-jobs must be at least 1")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            print(
+                "Stopping once any import that's running has finished",
+                file=sys.stderr)
+            stop.set()
+
+        previous_handlers = {
+            signum: signal.signal(signum, request_stop)
+            for signum in (signal.SIGINT, signal.SIGTERM)}
+        # The session is kept for as long as the scheduler runs, so
+        # that connections to each host are reused between updates:
+        session = make_session(
+            pool_size=options['fetch_jobs'], retries=options['retries'])
+        try:
+            while not stop.is_set():
+                # Don't keep a connection that's been closed by the
+                # database, or a growing list of queries with DEBUG on:
+                close_old_connections()
+                reset_queries()
+                try:
+                    self.update_due_sources(session, stop, options)
+                    if options['once']:
+                        break
+                    wait = seconds_until_next_due(options['poll_interval'])
+                except Exception:
+                    if options['once']:
+                        raise
+                    # Say, the database has restarted. The scheduler
+                    # has to keep running, so it tries again later
+                    # with a new connection:
+                    print(
+                        "Updating the due sources failed, so trying again "
+                        "in {0} seconds:\n{1}".format(
+                            options['poll_interval'], traceback.format_exc()),
+                        file=sys.stderr)
+                    close_old_connections()
+                    wait = options['poll_interval']
+                stop.wait(wait)
+        finally:
+            session.close()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def update_due_sources(self, session, stop, options):
+        # Only sources that were due when this started are updated, so
+        # that one with a very short interval can't keep this going:
+        now = timezone.now()
+        while not stop.is_set():
+            sources = list(due_sources(now)[:options['batch_size']])
+            if not sources:
+                return
+            results = update_sources_with_concurrent_fetches(
+                sources, options['fetch_jobs'], session=session, stop=stop,
+                timeout=options['timeout'])
+            for ps, result in zip(sources, results):
+                if result is None:
+                    continue
+                record_update_result(ps, result)
+                print("{0}: {1}, next update at {2}".format(
+                    repr(ps), result, ps.next_update_at.isoformat()))
+            sys.stdout.flush()
@@ -1,12 +1,23 @@
 from __future__ import print_function, unicode_literals
 
+from multiprocessing.pool import ThreadPool
 import re
+import sys
+import traceback
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from django.utils.six.moves.urllib.parse import urlsplit
 
+from popolo.importers.popolo_json import NEW_COLLECTIONS
+
+from popolo_sources.fetching import (
+    make_session, update_with_concurrent_fetches)
 from popolo_sources.models import PopoloSource
 from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.signals import import_finished
+from popolo_sources.snapshots import SnapshotStore
 
 
 REQUIRED_ARG = 'POPOLO-JSON-URL | POPOLO-SOURCE-ID'
@@ -17,7 +28,7 @@ def is_url(s):
         split_url = urlsplit(s)
     except ValueError:
         return False
-    return split_url.scheme in ('http', 'https')
+    return split_url.scheme in ('http', 'https', 'file')
 
 
 def get_source(source_arg):
@@ -38,33 +49,302 @@ def create_source(source_arg):
     return PopoloSource.objects.create(url=source_arg)
 
 
+LOCKED = 'skipped, since it is already being updated'
+
+
+def report_failure(ps, formatted_traceback):
+    print(
+        "Updating {0} failed:\n{1}".format(repr(ps), formatted_traceback),
+        file=sys.stderr)
+
+
+def update_source(ps, force=False, from_snapshot=False, **importer_kwargs):
+    """Update a single source, returning a short description of the result
+
+    Failures are reported rather than raised, so that one source
+    failing doesn't stop any others from being updated. If
+    from_snapshot is True, the source is updated from its latest
+    snapshot rather than fetched."""
+    if not ps.acquire_lock():
+        return LOCKED
+    try:
+        importer = PopoloSourceImporter(ps, **importer_kwargs)
+        if from_snapshot:
+            report = importer.update_from_snapshot(force=force)
+        else:
+            report = importer.update_from_source(force=force)
+        if report:
+            return 'updated'
+        return 'unchanged'
+    except Exception:
+        report_failure(ps, traceback.format_exc())
+        return 'failed'
+    finally:
+        ps.release_lock()
+
+
+def update_sources_with_concurrent_fetches(
+        sources, fetch_jobs, force=False, retries=3, session=None, stop=None,
+        **importer_kwargs):
+    """Update sources, fetching them concurrently but importing in turn
+
+    This returns a short description of the result for each source.
+    Each source is only locked once it's been fetched, while it's
+    imported, so sources that are waiting to be fetched can still be
+    updated by others. If session isn't given, one is made (and closed
+    afterwards). If stop is given, it's a threading.Event; once it's
+    set, no more sources are imported, and the result for each of
+    those is None."""
+    results = {}
+    locked = set()
+    own_session = session is None
+    if own_session:
+        session = make_session(pool_size=fetch_jobs, retries=retries)
+
+    def lock(importer):
+        ps = importer.popolo_source
+        if not ps.acquire_lock():
+            results[ps.id] = LOCKED
+            return False
+        locked.add(ps.id)
+        return True
+
+    updates = None
+    try:
+        importers = [
+            PopoloSourceImporter(ps, session=session, **importer_kwargs)
+            for ps in sources]
+        updates = update_with_concurrent_fetches(
+            importers, concurrency=fetch_jobs, force=force, stop=stop,
+            before_import=lock)
+        for result in updates:
+            ps = result.importer.popolo_source
+            if ps.id in locked:
+                ps.release_lock()
+                locked.remove(ps.id)
+            if result.error is not None:
+                report_failure(ps, result.error)
+                results[ps.id] = 'failed'
+            else:
+                results[ps.id] = 'updated' if result.updated else 'unchanged'
+    finally:
+        if updates is not None:
+            updates.close()
+        for ps in sources:
+            if ps.id in locked:
+                ps.release_lock()
+        if own_session:
+            session.close()
+    return [results.get(ps.id) for ps in sources]
+
+
+def update_source_in_thread(args):
+    ps, force, from_snapshot, importer_kwargs = args
+    try:
+        return update_source(ps, force, from_snapshot, **importer_kwargs)
+    finally:
+        # Each thread has its own database connection, which would
+        # otherwise be left open:
+        connection.close()
+
+
 class Command(BaseCommand):
 
-    help = 'Update from source of Popolo JSON'
+    help = 'Update from one or more sources of Popolo JSON'
 
     def add_arguments(self, parser):
-        parser.add_argument(REQUIRED_ARG)
+        parser.add_argument(REQUIRED_ARG, nargs='*')
         parser.add_argument('--create', action='store_true')
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Update every source')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Import the source even if it is unchanged')
+        parser.add_argument(
+            '--jobs', type=int, default=1,
+            help='The number of sources to update at once')
+        parser.add_argument(
+            '--fetch-jobs', type=int, default=0,
+            help='Fetch this many sources at once, importing each in '
+            'turn as it arrives')
+        parser.add_argument(
+            '--timeout', type=float,
+            help='The timeout in seconds for fetching a source')
+        parser.add_argument(
+            '--retries', type=int, default=3,
+            help='How many times to retry fetching a source (with '
+            '--fetch-jobs)')
+        parser.add_argument(
+            '--snapshot-dir',
+            help='Save a compressed snapshot of each source fetched in '
+            'this directory (by default, POPOLO_SOURCES_SNAPSHOT_DIR)')
+        parser.add_argument(
+            '--from-snapshot', action='store_true',
+            help='Import each source from its latest snapshot, without '
+            'fetching it')
+        parser.add_argument(
+            '--plan', action='store_true',
+            help='Print what updating each source would change, without '
+            'changing anything')
+        parser.add_argument(
+            '--workers', type=int,
+            help='Import the collections of each source in this many '
+            'threads, each with its own database connection')
+        parser.add_argument(
+            '--checkpoint-every', type=int,
+            help='Commit the import every this many objects, saving '
+            'its progress, so that if it is interrupted the next '
+            'update of the same content carries on from there')
+        parser.add_argument(
+            '--collections',
+            help='Only update these collections (comma-separated, from '
+            'area, organization, post, person and membership)')
+        parser.add_argument(
+            '--stats', action='store_true',
+            help='Print the time and queries taken by each phase of the '
+            'import, and counts of the objects affected')
+
+    def get_sources(self, source_args, create):
+        sources = []
+        for source_arg in source_args:
+            try:
+                ps = get_source(source_arg)
+                if create:
+                    msg = "You specified --create, but that source already exists"
+                    raise CommandError(msg)
+            except PopoloSource.DoesNotExist:
+                if create:
+                    ps = create_source(source_arg)
+                    print("Created a source for that URL: {0}".format(ps.id))
+                else:
+                    print("That source could not be found.")
+                    if PopoloSource.objects.exists():
+                        print("Did you mean one of the following?")
+                        for existing_source in PopoloSource.objects.order_by('pk'):
+                            print('{0.id}: {0.url}'.format(existing_source))
+                    raise CommandError('Source not found')
+            if ps not in sources:
+                sources.append(ps)
+        return sources
 
     def handle(self, *args, **options):
-        source_arg = options[REQUIRED_ARG]
-        create = options['create']
-        try:
-            ps = get_source(source_arg)
-            if create:
-                msg = "You specified --create, but that source already exists"
+        source_args = options[REQUIRED_ARG]
+        if options['all']:
+            if source_args or options['create']:
+                msg = "You can't specify sources or --create with --all"
                 raise CommandError(msg)
-        except PopoloSource.DoesNotExist:
-            if create:
-                ps = create_source(source_arg)
-                print("Created a source for that URL: {0}".format(ps.id))
+            sources = list(PopoloSource.objects.order_by('pk'))
+        elif source_args:
+            sources = self.get_sources(source_args, options['create'])
+        else:
+            raise CommandError(
+                "You must specify at least one {0}, or --all".format(
+                    REQUIRED_ARG))
+        if options['jobs'] < 1:
+            raise CommandError("--jobs must be at least 1")
+        if options['fetch_jobs'] and options['jobs'] > 1:
+            raise CommandError("You can't use both --jobs and --fetch-jobs")
+        if options['checkpoint_every'] and options['collections']:
+            raise CommandError(
+                "You can't use both --checkpoint-every and --collections")
+        if options['checkpoint_every'] and options['workers']:
+            raise CommandError(
+                "You can't use both --checkpoint-every and --workers")
+        force = options['force']
+        importer_kwargs = {}
+        if options['timeout'] is not None:
+            importer_kwargs['timeout'] = options['timeout']
+        if options['workers']:
+            importer_kwargs['workers'] = options['workers']
+        if options['stats']:
+            importer_kwargs['count_queries'] = True
+        if options['checkpoint_every']:
+            importer_kwargs['checkpoint'] = True
+            importer_kwargs['commit_every'] = options['checkpoint_every']
+        if options['collections']:
+            collections = [
+                c.strip() for c in options['collections'].split(',')]
+            unknown = [c for c in collections if c not in NEW_COLLECTIONS]
+            if unknown:
+                raise CommandError(
+                    "Unknown collections: {0}".format(', '.join(unknown)))
+            importer_kwargs['collections'] = collections
+        if options['snapshot_dir'] or \
+                getattr(settings, 'POPOLO_SOURCES_SNAPSHOT_DIR', None):
+            importer_kwargs['snapshot_store'] = SnapshotStore(
+                options['snapshot_dir'])
+        elif options['from_snapshot']:
+            raise CommandError(
+                "--from-snapshot needs --snapshot-dir or "
+                "POPOLO_SOURCES_SNAPSHOT_DIR")
+        if options['from_snapshot'] and options['fetch_jobs']:
+            raise CommandError(
+                "You can't use both --from-snapshot and --fetch-jobs")
+        if options['plan']:
+            return self.plan_sources(
+                sources, options['from_snapshot'], importer_kwargs)
+        for ps in sources:
+            print("Attempting to import from {0}".format(repr(ps)))
+        reports = {}
+
+        def collect_report(sender, popolo_source, report, **kwargs):
+            reports[popolo_source.id] = report
+
+        if options['stats']:
+            import_finished.connect(collect_report, weak=False)
+        try:
+            results = self.update_sources(
+                sources, force, options, importer_kwargs)
+        finally:
+            import_finished.disconnect(collect_report)
+        for ps, result in zip(sources, results):
+            if result == 'unchanged':
+                print("{0}: the source is unchanged since the last import, "
+                      "so it was skipped (use --force to import it "
+                      "anyway)".format(repr(ps)))
             else:
-                print("That source could not be found.")
-                if PopoloSource.objects.exists():
-                    print("Did you mean one of the following?")
-                    for existing_source in PopoloSource.objects.order_by('pk'):
-                        print('{0.id}: {0.url}'.format(existing_source))
-                raise CommandError('Source not found')
-        print("Attempting to import from {0}".format(repr(ps)))
-        importer = PopoloSourceImporter(ps)
-        importer.update_from_source()
+                print("{0}: {1}".format(repr(ps), result))
+        for ps in sources:
+            if ps.id in reports:
+                print(reports[ps.id].format())
+        failures = results.count('failed')
+        if failures:
+            raise CommandError(
+                "{0} of {1} sources failed to update".format(
+                    failures, len(sources)))
+
+    def plan_sources(self, sources, from_snapshot, importer_kwargs):
+        failures = 0
+        for ps in sources:
+            try:
+                importer = PopoloSourceImporter(ps, **importer_kwargs)
+                print(importer.plan(from_snapshot=from_snapshot).format())
+            except Exception:
+                report_failure(ps, traceback.format_exc())
+                failures += 1
+        if failures:
+            raise CommandError(
+                "{0} of {1} sources failed to be planned".format(
+                    failures, len(sources)))
+
+    def update_sources(self, sources, force, options, importer_kwargs):
+        if options['fetch_jobs']:
+            return update_sources_with_concurrent_fetches(
+                sources, options['fetch_jobs'], force,
+                retries=options['retries'], **importer_kwargs)
+        from_snapshot = options['from_snapshot']
+        if options['jobs'] == 1 or len(sources) < 2:
+            return [
+                update_source(ps, force, from_snapshot, **importer_kwargs)
+                for ps in sources]
+        else:
+            pool = ThreadPool(min(options['jobs'], len(sources)))
+            try:
+                return pool.map(
+                    update_source_in_thread,
+                    [(ps, force, from_snapshot, importer_kwargs)
+                     for ps in sources])
+            finally:
+                pool.close()
+                pool.join()
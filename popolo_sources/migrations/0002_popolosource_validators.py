@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='popolosource',
+            name='content_digest',
+            field=models.CharField(max_length=64, blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='popolosource',
+            name='etag',
+            field=models.CharField(max_length=255, blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='popolosource',
+            name='last_modified',
+            field=models.CharField(max_length=255, blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def remove_duplicate_links(apps, schema_editor):
+    # Before the unique constraint is added, remove any duplicate
+    # links, keeping one that isn't marked as deleted if possible.
+    LinkToPopoloSource = apps.get_model('popolo_sources', 'LinkToPopoloSource')
+    duplicates = LinkToPopoloSource.objects.values(
+        'popolo_source', 'content_type', 'object_id').annotate(
+            count=models.Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        links = LinkToPopoloSource.objects.filter(
+            popolo_source=duplicate['popolo_source'],
+            content_type=duplicate['content_type'],
+            object_id=duplicate['object_id'],
+        ).order_by('deleted_from_source', 'id')
+        link_to_keep = links[0]
+        links.exclude(pk=link_to_keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0002_popolosource_validators'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_links, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='linktopopolosource',
+            unique_together=set([('popolo_source', 'content_type', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='linktopopolosource',
+            index_together=set([('popolo_source', 'content_type', 'deleted_from_source')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0003_linktopopolosource_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='linktopopolosource',
+            name='content_hash',
+            field=models.CharField(max_length=64, blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0004_linktopopolosource_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='popolosource',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
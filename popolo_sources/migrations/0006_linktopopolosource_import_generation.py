@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0005_popolosource_locked_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='linktopopolosource',
+            name='import_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0006_linktopopolosource_import_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('content_digest', models.CharField(max_length=64)),
+                ('import_generation', models.PositiveIntegerField()),
+                ('collection', models.CharField(max_length=32, blank=True, default='')),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('popolo_source', models.OneToOneField(related_name='import_checkpoint', to='popolo_sources.PopoloSource')),
+            ],
+        ),
+    ]
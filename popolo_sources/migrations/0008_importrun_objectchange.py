@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('popolo_sources', '0007_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('content_digest', models.CharField(max_length=64, blank=True, default='')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('succeeded', models.BooleanField(default=False)),
+                ('popolo_source', models.ForeignKey(related_name='import_runs', to='popolo_sources.PopoloSource')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ObjectChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('change', models.CharField(max_length=16, choices=[('created', 'Created'), ('updated', 'Updated'), ('disappeared', 'Disappeared'), ('reappeared', 'Reappeared')])),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('import_run', models.ForeignKey(related_name='changes', to='popolo_sources.ImportRun')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_deleted_at(apps, schema_editor):
+    # It's not known when links that were already deleted were marked
+    # as deleted, so their retention period starts now:
+    LinkToPopoloSource = apps.get_model('popolo_sources', 'LinkToPopoloSource')
+    LinkToPopoloSource.objects.filter(deleted_from_source=True).update(
+        deleted_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0008_importrun_objectchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='linktopopolosource',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+        migrations.RunPython(set_deleted_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('popolo_sources', '0009_linktopopolosource_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='popolosource',
+            name='failed_updates',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='popolosource',
+            name='next_update_at',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='popolosource',
+            name='unchanged_updates',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='popolosource',
+            name='update_interval',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,6 +1,10 @@
 from __future__ import unicode_literals
 
+from datetime import timedelta
+
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
@@ -8,14 +12,153 @@ from django.contrib.contenttypes.models import ContentType
 
 class PopoloSource(models.Model):
     url = models.URLField(max_length=255)
+    # The validators and digest of the last successfully imported
+    # response, so that unchanged sources can be skipped:
+    etag = models.CharField(max_length=255, blank=True, default='')
+    last_modified = models.CharField(max_length=255, blank=True, default='')
+    content_digest = models.CharField(max_length=64, blank=True, default='')
+    # Set while the source is being updated, so that it's never
+    # updated twice at once; see acquire_lock.
+    locked_until = models.DateTimeField(null=True, blank=True)
+    # How often, in seconds, the popolo_sources_scheduler command
+    # should update the source (if it's None, as it is by default,
+    # the scheduler leaves it alone), and when it's next due. The counts of consecutive
+    # updates that found the source unchanged or failed make the
+    # scheduler back off; see popolo_sources.scheduling.
+    update_interval = models.PositiveIntegerField(null=True, blank=True)
+    next_update_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    unchanged_updates = models.PositiveIntegerField(default=0)
+    failed_updates = models.PositiveIntegerField(default=0)
 
     def __repr__(self):
         fmt = str("PopoloSource(id={0.id}, url='{0.url}')")
         return fmt.format(self)
 
+    def acquire_lock(self, duration=timedelta(hours=12)):
+        """Try to lock this source for updating, returning True if locked
+
+        The lock is taken with a single conditional UPDATE, so only
+        one process or thread can hold it at a time. In case the
+        holder dies without calling release_lock, the lock expires
+        after duration."""
+        now = timezone.now()
+        locked_until = now + duration
+        acquired = PopoloSource.objects.filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+            pk=self.pk,
+        ).update(locked_until=locked_until)
+        if acquired:
+            self.locked_until = locked_until
+        return bool(acquired)
+
+    def release_lock(self):
+        PopoloSource.objects.filter(pk=self.pk).update(locked_until=None)
+        self.locked_until = None
+
+
+class ImportCheckpoint(models.Model):
+    # How far a checkpointed import of a source has got, so that it
+    # can be resumed. It's saved as each chunk is committed and
+    # deleted when the import finishes. position is the number of
+    # objects (including inline areas) that had been imported from
+    # the content with that digest, and collection is the collection
+    # of the last of them.
+    popolo_source = models.OneToOneField(
+        PopoloSource, related_name='import_checkpoint')
+    content_digest = models.CharField(max_length=64)
+    import_generation = models.PositiveIntegerField()
+    collection = models.CharField(max_length=32, blank=True, default='')
+    position = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __repr__(self):
+        fmt = str(
+            "ImportCheckpoint(popolo_source_id={0.popolo_source_id}, "
+            "collection='{0.collection}', position={0.position})")
+        return fmt.format(self)
+
+
+class ImportRun(models.Model):
+    # One update of a source that recorded its changes; see
+    # popolo_sources.changes. finished_at is set when the update
+    # finishes, whether or not it succeeded.
+    popolo_source = models.ForeignKey(PopoloSource, related_name='import_runs')
+    content_digest = models.CharField(max_length=64, blank=True, default='')
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    succeeded = models.BooleanField(default=False)
+
+    def __repr__(self):
+        fmt = str(
+            "ImportRun(id={0.id}, popolo_source_id={0.popolo_source_id})")
+        return fmt.format(self)
+
+
+class ObjectChange(models.Model):
+    # An entry in the append-only log of the objects that were
+    # created, updated, disappeared or reappeared in an ImportRun.
+    CHANGES = (
+        ('created', 'Created'),
+        ('updated', 'Updated'),
+        ('disappeared', 'Disappeared'),
+        ('reappeared', 'Reappeared'),
+    )
+    import_run = models.ForeignKey(ImportRun, related_name='changes')
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    popolo_object = GenericForeignKey('content_type', 'object_id')
+    change = models.CharField(max_length=16, choices=CHANGES)
+
+    def __repr__(self):
+        fmt = str(
+            "ObjectChange(import_run_id={0.import_run_id}, "
+            "change='{0.change}', content_type_id={0.content_type_id}, "
+            "object_id={0.object_id})")
+        return fmt.format(self)
+
+
+class LinkToPopoloSourceQuerySet(models.QuerySet):
+
+    def live_objects(self, popolo_source, model):
+        """Return a queryset of the model's objects live in popolo_source
+
+        The objects are filtered with a subquery on the links, so the
+        result can be filtered, paginated and prefetched like any
+        other queryset."""
+        content_type = ContentType.objects.get_for_model(model)
+        object_ids = self.filter(
+            popolo_source=popolo_source,
+            content_type=content_type,
+            deleted_from_source=False).values('object_id')
+        return model.objects.filter(pk__in=object_ids)
+
+    def sources_for(self, popolo_object, include_deleted=False):
+        """Return a queryset of the sources that popolo_object came from
+
+        Unless include_deleted is True, sources the object has since
+        disappeared from are left out."""
+        links = self.filter(
+            content_type=ContentType.objects.get_for_model(popolo_object),
+            object_id=popolo_object.pk)
+        if not include_deleted:
+            links = links.filter(deleted_from_source=False)
+        return PopoloSource.objects.filter(
+            pk__in=links.values('popolo_source'))
+
+    def with_popolo_objects(self):
+        """Prefetch popolo_object with one query per content type
+
+        Otherwise, reading popolo_object on each link does a query."""
+        return self.prefetch_related('popolo_object')
+
 
 class LinkToPopoloSource(models.Model):
     deleted_from_source = models.BooleanField(default=False)
+    # When the object was last marked as deleted from the source (it's
+    # cleared if the object reappears), so that links that have been
+    # deleted for a long time can be purged; see
+    # popolo_sources.cleanup.
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)
     # Fields needed for the generic foreign key to a django-popolo
     # model.
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -23,3 +166,21 @@ class LinkToPopoloSource(models.Model):
     popolo_object = GenericForeignKey('content_type', 'object_id')
     # Now the source that this object was created from (or is associated with):
     popolo_source = models.ForeignKey(PopoloSource)
+    # A hash of the object's Popolo JSON when it was last imported
+    # from the source:
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # The generation of the last import that checked whether this
+    # object is still in the source, if it was imported with
+    # set_based_deletions:
+    import_generation = models.PositiveIntegerField(default=0)
+
+    objects = LinkToPopoloSourceQuerySet.as_manager()
+
+    class Meta:
+        # Almost every query on this table is for one source and
+        # content type, by object ID or by whether the object has
+        # been deleted from the source:
+        unique_together = ('popolo_source', 'content_type', 'object_id')
+        index_together = [
+            ('popolo_source', 'content_type', 'deleted_from_source'),
+        ]
@@ -0,0 +1,219 @@
+"""Importing a single large source with several workers at once
+
+import_in_parallel splits the Popolo JSON by collection, splits each
+collection into shards by ID range, and imports the shards in a pool
+of threads, each with its own database connection. A collection is
+only started once the collections it refers to have finished, so
+that the references can be found in the database:
+
+    areas and persons -> organizations -> posts -> memberships
+
+Areas and organizations are each imported as a single shard, since
+their parents are set after all of them have been imported. Inline
+areas are imported with the other areas, and inline memberships with
+the other memberships. Each shard is imported by its own
+PopoloSourceImporter, and the objects they saw and their counts are
+merged afterwards, so that objects that are missing from the source
+can be marked as deleted in the usual way.
+"""
+
+from collections import OrderedDict
+import threading
+import traceback
+
+from django.db import connection
+from django.utils import six
+from django.utils.six.moves import queue
+
+from popolo_sources.importer import (
+    COLLECTION_KEYS, CurrentObjectsTracker, generate_membership_id)
+from popolo_sources.reports import ImportReport
+
+
+# The collections that objects in each collection can refer to:
+DEPENDENCIES = OrderedDict([
+    ('area', ()),
+    ('person', ()),
+    ('organization', ('area',)),
+    ('post', ('area', 'organization')),
+    ('membership', ('area', 'organization', 'post', 'person')),
+])
+
+UNSHARDED = ('area', 'organization')
+
+
+def _popolo_id(object_data):
+    return six.text_type(object_data['id'])
+
+
+def shard_by_id(objects, shards):
+    """Split a list of Popolo JSON objects into contiguous ID ranges
+
+    There are at most shards lists of about the same size, and
+    objects with the same ID are always in the same one."""
+    objects = sorted(objects, key=_popolo_id)
+    size = max(1, -(-len(objects) // shards))
+    result = []
+    shard = []
+    for object_data in objects:
+        if len(shard) >= size and \
+                _popolo_id(object_data) != _popolo_id(shard[-1]):
+            result.append(shard)
+            shard = []
+        shard.append(object_data)
+    if shard:
+        result.append(shard)
+    return result
+
+
+def split_by_collection(data):
+    """Return a dict mapping each collection to a list of its objects
+
+    Inline memberships are moved from persons to the memberships, and
+    inline areas are added to the areas (the last version of each
+    area is kept, as it would be in a serial import). Memberships
+    without IDs are given them. The data itself isn't modified."""
+    areas = OrderedDict()
+    for area_data in data.get('areas', []):
+        areas[_popolo_id(area_data)] = area_data
+    persons = []
+    memberships = list(data.get('memberships', []))
+    for person_data in data.get('persons', []):
+        if 'memberships' in person_data:
+            person_data = dict(person_data)
+            memberships += person_data.pop('memberships')
+        persons.append(person_data)
+    for i, membership_data in enumerate(memberships):
+        if 'id' not in membership_data:
+            membership_data = dict(membership_data)
+            membership_data['id'] = generate_membership_id(membership_data)
+            memberships[i] = membership_data
+    by_collection = {
+        'organization': list(data.get('organizations', [])),
+        'post': list(data.get('posts', [])),
+        'person': persons,
+        'membership': memberships,
+    }
+    for collection in ('organization', 'post', 'membership'):
+        for object_data in by_collection[collection]:
+            area_data = object_data.get('area')
+            if area_data:
+                areas[_popolo_id(area_data)] = area_data
+    by_collection['area'] = list(areas.values())
+    return by_collection
+
+
+def _import_shard(importer, collection, shard, events, generation, observers):
+    worker = importer.make_worker_importer(collection, observers)
+    tracker = CurrentObjectsTracker()
+    report = ImportReport(importer.popolo_source)
+    worker.add_observer(tracker)
+    worker.add_observer(report)
+    worker.link_creator.generation = generation
+    worker.import_from_export_json_data(
+        {COLLECTION_KEYS[collection]: shard, 'events': events})
+    for reappeared_collection, count in worker.link_creator.reappeared.items():
+        report.count(reappeared_collection, 'reappeared', count)
+    return tracker, report
+
+
+def _import_worker(tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        collection = task[1]
+        try:
+            results.put((collection, _import_shard(*task), None))
+        except Exception:
+            results.put((collection, None, traceback.format_exc()))
+        finally:
+            # Each thread has its own database connection, which would
+            # otherwise be left open:
+            connection.close()
+
+
+def import_in_parallel(importer, data, workers, generation=None,
+                       observers=()):
+    """Import data for importer's source with up to workers threads
+
+    The collections are those that importer updates, and each shard
+    is imported by importer.make_worker_importer. If generation is
+    given, the links to every object seen are stamped with it.
+    observers are also notified of every object, from the worker
+    threads, so they must be thread-safe.
+
+    This returns a CurrentObjectsTracker of the objects seen and an
+    ImportReport with their counts. If any shard fails, the shards
+    already running are finished but no more are started, and an
+    exception is raised."""
+    by_collection = split_by_collection(data)
+    events = list(data.get('events', []))
+    shards = {}
+    for collection in DEPENDENCIES:
+        if collection not in importer.tracked_collections:
+            continue
+        objects = by_collection[collection]
+        if collection in UNSHARDED:
+            shards[collection] = [objects] if objects else []
+        else:
+            shards[collection] = shard_by_id(objects, workers)
+    remaining = {
+        collection: len(collection_shards)
+        for collection, collection_shards in shards.items()}
+    started = set()
+    tasks = queue.Queue()
+    results = queue.Queue()
+
+    def start_ready_collections():
+        # Start every collection whose dependencies have finished,
+        # returning the number of shards started. DEPENDENCIES is in
+        # order, so a collection with no shards is finished in time
+        # for those that depend on it.
+        count = 0
+        for collection, dependencies in DEPENDENCIES.items():
+            if collection not in shards or collection in started:
+                continue
+            if any(remaining.get(d) for d in dependencies):
+                continue
+            started.add(collection)
+            for shard in shards[collection]:
+                tasks.put(
+                    (importer, collection, shard, events, generation,
+                     observers))
+                count += 1
+        return count
+
+    threads = [
+        threading.Thread(target=_import_worker, args=(tasks, results))
+        for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    tracker = CurrentObjectsTracker()
+    report = ImportReport(importer.popolo_source)
+    errors = []
+    try:
+        running = start_ready_collections()
+        while running:
+            collection, result, error = results.get()
+            running -= 1
+            remaining[collection] -= 1
+            if error is not None:
+                errors.append(error)
+                continue
+            shard_tracker, shard_report = result
+            tracker.merge(shard_tracker)
+            report.add_counts(shard_report)
+            if not errors:
+                running += start_ready_collections()
+    finally:
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise Exception(
+            "Importing {0} in parallel failed:\n{1}".format(
+                repr(importer.popolo_source), errors[0]))
+    return tracker, report
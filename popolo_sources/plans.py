@@ -0,0 +1,181 @@
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.utils import six
+
+from popolo.importers.popolo_json import NEW_COLLECTIONS
+from popolo_sources.importer import (
+    CollectionsSubset, generate_membership_id, popolo_content_hash)
+from popolo_sources.models import LinkToPopoloSource
+
+
+CHANGES = ('created', 'updated', 'unchanged', 'reappeared', 'deleted')
+
+
+class ImportPlan(object):
+
+    """What an update from a source would change, without making it
+
+    For each collection, changes[collection][change] is a list of
+    the Popolo JSON IDs of the objects that would be created,
+    updated, left unchanged, reappear or be marked as deleted. A plan
+    is true if anything would change."""
+
+    def __init__(self, popolo_source):
+        self.popolo_source = popolo_source
+        self.changes = defaultdict(lambda: {change: [] for change in CHANGES})
+
+    def __bool__(self):
+        return any(
+            changes[change]
+            for changes in self.changes.values()
+            for change in CHANGES if change != 'unchanged')
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        fmt = str('ImportPlan(popolo_source={0})')
+        return fmt.format(repr(self.popolo_source))
+
+    def add(self, collection, change, popolo_id):
+        self.changes[collection][change].append(popolo_id)
+
+    def as_dict(self):
+        return {
+            collection: {
+                change: list(popolo_ids)
+                for change, popolo_ids in changes.items()}
+            for collection, changes in self.changes.items()}
+
+    def format(self):
+        """Return a summary of the plan as human-readable text"""
+        lines = ['{0}: {1}'.format(
+            repr(self.popolo_source),
+            'would be changed' if self else 'would not be changed')]
+        lines.append('  {0:<14}'.format('collection') + ''.join(
+            ' {0:>11}'.format(c) for c in CHANGES))
+        for collection in NEW_COLLECTIONS:
+            if collection not in self.changes:
+                continue
+            changes = self.changes[collection]
+            lines.append('  {0:<14}'.format(collection) + ''.join(
+                ' {0:>11}'.format(len(changes[c])) for c in CHANGES))
+        return '\n'.join(lines)
+
+
+class ImportPlanner(object):
+
+    """Works out the ImportPlan for importing some data from a source
+
+    The current state of the source is loaded with one query per
+    collection for the objects' Popolo JSON IDs, and one for the
+    links, and then the data is compared with it in memory. Nothing
+    is written to the database. If the importer only updates some
+    collections, only objects in those can be planned as deleted."""
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.popolo_source = importer.popolo_source
+        self.collection_to_content_type = \
+            importer.link_creator.collection_to_content_type
+        self.content_type_id_to_collection = {
+            content_type.id: collection
+            for collection, content_type
+            in self.collection_to_content_type.items()}
+
+    def load(self):
+        # A mapping from each collection to a dict mapping Popolo IDs
+        # to object IDs, and the reverse:
+        self.popolo_id_to_object_id = {}
+        self.object_id_to_popolo_id = {}
+        for collection in NEW_COLLECTIONS:
+            pairs = list(self.importer.get_source_identifiers(collection))
+            self.popolo_id_to_object_id[collection] = dict(pairs)
+            self.object_id_to_popolo_id[collection] = {
+                object_id: popolo_id for popolo_id, object_id in pairs}
+        self.links = {
+            (content_type_id, object_id): (deleted, content_hash)
+            for content_type_id, object_id, deleted, content_hash
+            in LinkToPopoloSource.objects.filter(
+                popolo_source=self.popolo_source).values_list(
+                    'content_type_id', 'object_id',
+                    'deleted_from_source', 'content_hash')
+        }
+
+    def plan(self, data):
+        self.load()
+        plan = ImportPlan(self.popolo_source)
+        seen = defaultdict(set)
+        tracked_collections = self.importer.tracked_collections
+        if self.importer.collections is not None:
+            data = CollectionsSubset(data, self.importer.collections)
+        events = {
+            event_data['id']: event_data
+            for event_data in data.get('events', [])}
+
+        def add(collection, popolo_data):
+            # The IDs are stored as text, but may be numbers in the
+            # Popolo JSON:
+            popolo_id = six.text_type(popolo_data['id'])
+            if popolo_id in seen[collection]:
+                return
+            seen[collection].add(popolo_id)
+            object_id = self.popolo_id_to_object_id[collection].get(
+                popolo_id)
+            if object_id is None:
+                plan.add(collection, 'created', popolo_id)
+                return
+            content_type = self.collection_to_content_type[collection]
+            deleted, content_hash = self.links[(content_type.id, object_id)]
+            if deleted:
+                change = 'reappeared'
+            elif content_hash == popolo_content_hash(popolo_data, events):
+                change = 'unchanged'
+            else:
+                change = 'updated'
+            plan.add(collection, change, popolo_id)
+
+        def add_inline_area(object_data):
+            area_data = object_data.get('area')
+            if area_data:
+                add('area', area_data)
+
+        # This goes through the data in the same way as
+        # PopoloJSONImporter.import_from_export_json_data, but without
+        # modifying it:
+        for area_data in data.get('areas', []):
+            add('area', area_data)
+        for org_data in data.get('organizations', []):
+            add_inline_area(org_data)
+            add('organization', org_data)
+        for post_data in data.get('posts', []):
+            add_inline_area(post_data)
+            add('post', post_data)
+        inline_memberships = []
+        for person_data in data.get('persons', []):
+            if 'memberships' in person_data:
+                person_data = dict(person_data)
+                inline_memberships += person_data.pop('memberships')
+            add('person', person_data)
+        for membership_data in \
+                data.get('memberships', []) + inline_memberships:
+            add_inline_area(membership_data)
+            if not membership_data.get('id'):
+                membership_data = dict(membership_data)
+                membership_data['id'] = generate_membership_id(
+                    membership_data)
+            add('membership', membership_data)
+
+        # Finally, anything live in the source that wasn't seen would
+        # be marked as deleted:
+        for (content_type_id, object_id), (deleted, _) in self.links.items():
+            if deleted:
+                continue
+            collection = self.content_type_id_to_collection[content_type_id]
+            if collection not in tracked_collections:
+                continue
+            popolo_id = self.object_id_to_popolo_id[collection].get(object_id)
+            if popolo_id not in seen[collection]:
+                plan.add(collection, 'deleted', popolo_id)
+        return plan
@@ -0,0 +1,171 @@
+from __future__ import unicode_literals
+
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+COUNTS = ('created', 'updated', 'unchanged', 'disappeared', 'reappeared')
+
+
+class QueryCounter(object):
+
+    """A stand-in for a connection's queries_log that counts queries
+
+    Any queries are passed on to the original log, so that this
+    doesn't interfere with DEBUG logging of queries."""
+
+    def __init__(self, queries_log):
+        self.queries_log = queries_log
+        self.count = 0
+
+    def append(self, query):
+        self.count += 1
+        self.queries_log.append(query)
+
+    def clear(self):
+        self.queries_log.clear()
+
+    def __iter__(self):
+        return iter(self.queries_log)
+
+    def __len__(self):
+        return len(self.queries_log)
+
+
+class ImportReport(object):
+
+    """A record of what happened during one update of a PopoloSource
+
+    This has the wall time and number of database queries for each
+    phase of the update, and per collection counts of objects that
+    were created, updated, unchanged, disappeared or reappeared. It's
+    also an observer, so it can count objects as they're imported.
+
+    Counting queries means every query goes through Django's debug
+    cursor, which has a cost, so it's only done if count_queries is
+    True; otherwise the queries of each phase are None.
+
+    A report is true if the source was updated, and false if the
+    update was skipped, in which case skipped_reason says why. If an
+    interrupted import was resumed, resumed_from is the position it
+    carried on from."""
+
+    def __init__(self, popolo_source, using=DEFAULT_DB_ALIAS,
+                 count_queries=False):
+        self.popolo_source = popolo_source
+        self.using = using
+        self.count_queries = count_queries
+        self.updated = False
+        self.skipped_reason = None
+        self.resumed_from = None
+        self.phases = OrderedDict()
+        self.collections = defaultdict(lambda: dict.fromkeys(COUNTS, 0))
+        self.query_counter = None
+
+    def __bool__(self):
+        return self.updated
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        fmt = str('ImportReport(popolo_source={0}, updated={1})')
+        return fmt.format(repr(self.popolo_source), self.updated)
+
+    @contextmanager
+    def counting_queries(self):
+        """Count queries on this thread's connection while in this block
+
+        This does nothing unless the report was made with
+        count_queries."""
+        if not self.count_queries:
+            yield
+            return
+        connection = connections[self.using]
+        original_queries_log = connection.queries_log
+        original_force_debug_cursor = connection.force_debug_cursor
+        self.query_counter = QueryCounter(original_queries_log)
+        connection.queries_log = self.query_counter
+        connection.force_debug_cursor = True
+        try:
+            yield
+        finally:
+            connection.queries_log = original_queries_log
+            connection.force_debug_cursor = original_force_debug_cursor
+            self.query_counter = None
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time and queries in this block to the named phase"""
+        counter = self.query_counter
+        queries_before = counter.count if counter else 0
+        start = default_timer()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(
+                name, {'wall_time': 0.0,
+                       'queries': 0 if self.count_queries else None})
+            phase['wall_time'] += default_timer() - start
+            if counter:
+                phase['queries'] += counter.count - queries_before
+
+    def count(self, collection, what, n=1):
+        self.collections[collection][what] += n
+
+    def add_counts(self, other):
+        """Add the counts of objects from another report to this one"""
+        for collection, counts in other.collections.items():
+            for what, n in counts.items():
+                self.count(collection, what, n)
+
+    def notify(self, collection, django_object, created, popolo_data):
+        self.count(collection, 'created' if created else 'updated')
+
+    def notify_unchanged(self, collection, django_object, popolo_data):
+        self.count(collection, 'unchanged')
+
+    def notify_deleted(self, collection, django_object):
+        pass
+
+    def as_dict(self):
+        return {
+            'popolo_source': self.popolo_source.id,
+            'updated': self.updated,
+            'skipped_reason': self.skipped_reason,
+            'resumed_from': self.resumed_from,
+            'phases': OrderedDict(
+                (name, dict(phase)) for name, phase in self.phases.items()),
+            'collections': {
+                collection: dict(counts)
+                for collection, counts in self.collections.items()},
+        }
+
+    def format(self):
+        """Return the report as human-readable text"""
+        if self.updated and self.resumed_from:
+            status = 'updated (resumed from position {0})'.format(
+                self.resumed_from)
+        elif self.updated:
+            status = 'updated'
+        else:
+            status = 'skipped ({0})'.format(self.skipped_reason)
+        lines = ['{0}: {1}'.format(repr(self.popolo_source), status)]
+        if self.phases:
+            lines.append('  {0:<30} {1:>9} {2:>9}'.format(
+                'phase', 'time', 'queries'))
+            for name, phase in self.phases.items():
+                queries = phase['queries']
+                lines.append('  {0:<30} {1:>8.3f}s {2:>9}'.format(
+                    name, phase['wall_time'],
+                    '-' if queries is None else queries))
+        if self.collections:
+            lines.append('  {0:<14}'.format('collection') + ''.join(
+                ' {0:>11}'.format(c) for c in COUNTS))
+            for collection in sorted(self.collections):
+                counts = self.collections[collection]
+                lines.append('  {0:<14}'.format(collection) + ''.join(
+                    ' {0:>11}'.format(counts[c]) for c in COUNTS))
+        return '\n'.join(lines)
@@ -0,0 +1,94 @@
+"""Working out when each source should next be updated
+
+Each PopoloSource has an update_interval, in seconds, and the
+popolo_sources_scheduler command updates the sources whose
+next_update_at has passed. After each update, record_update_result
+schedules the next one. Sources that keep turning out to be
+unchanged, or keep failing, are updated less and less often, up to
+MAX_BACKOFF times their interval, and each interval is randomly
+lengthened or shortened by up to JITTER of itself so that sources
+added at the same time don't stay in step.
+"""
+
+from datetime import timedelta
+import random
+
+from django.db.models import Q
+from django.utils import timezone
+
+from popolo_sources.models import PopoloSource
+
+
+# The interval is multiplied by this for each consecutive update that
+# found the source unchanged:
+UNCHANGED_BACKOFF = 1.5
+# ... and by this for each consecutive update that failed:
+FAILURE_BACKOFF = 2
+MAX_BACKOFF = 16
+JITTER = 0.1
+
+
+def next_interval(popolo_source):
+    """Return the number of seconds to wait before updating the source again"""
+    # The counts are capped (the backoff is at its maximum long before
+    # then) so that the powers can't overflow:
+    backoff = min(
+        MAX_BACKOFF,
+        UNCHANGED_BACKOFF ** min(popolo_source.unchanged_updates, 64) *
+        FAILURE_BACKOFF ** min(popolo_source.failed_updates, 64))
+    jitter = 1 + JITTER * (2 * random.random() - 1)
+    return popolo_source.update_interval * backoff * jitter
+
+
+def record_update_result(popolo_source, result):
+    """Update the source's backoff counts and schedule its next update
+
+    result is the short description of the result that
+    popolo_sources_update's functions return: 'updated', 'unchanged',
+    'failed', or the message for a source that was already being
+    updated (which leaves the counts as they were)."""
+    if result == 'updated':
+        popolo_source.unchanged_updates = 0
+        popolo_source.failed_updates = 0
+    elif result == 'unchanged':
+        popolo_source.unchanged_updates += 1
+        popolo_source.failed_updates = 0
+    elif result == 'failed':
+        popolo_source.failed_updates += 1
+    popolo_source.next_update_at = timezone.now() + timedelta(
+        seconds=next_interval(popolo_source))
+    # Only these fields are saved, so that nothing the import changed
+    # is overwritten:
+    PopoloSource.objects.filter(pk=popolo_source.pk).update(
+        unchanged_updates=popolo_source.unchanged_updates,
+        failed_updates=popolo_source.failed_updates,
+        next_update_at=popolo_source.next_update_at)
+
+
+def scheduled_sources():
+    return PopoloSource.objects.filter(update_interval__isnull=False)
+
+
+def due_sources(now=None):
+    """Return a queryset of the scheduled sources due to be updated by now
+
+    Those that have never been scheduled are due straight away."""
+    if now is None:
+        now = timezone.now()
+    return scheduled_sources().filter(
+        Q(next_update_at__isnull=True) | Q(next_update_at__lte=now),
+    ).order_by('next_update_at', 'pk')
+
+
+def seconds_until_next_due(maximum):
+    """Return how long to wait until a scheduled source is due, up to maximum"""
+    sources = scheduled_sources()
+    # A source that has never been scheduled is due now:
+    if sources.filter(next_update_at__isnull=True).exists():
+        return 0
+    next_update_at = sources.order_by('next_update_at').values_list(
+        'next_update_at', flat=True).first()
+    if next_update_at is None:
+        return maximum
+    seconds = (next_update_at - timezone.now()).total_seconds()
+    return min(maximum, max(0, seconds))
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+
+# Sent at the end of every PopoloSourceImporter.update_from_source
+# (including ones that were skipped because the source hadn't
+# changed) with the ImportReport for that update.
+import_finished = Signal(providing_args=['popolo_source', 'report'])
@@ -0,0 +1,145 @@
+"""Compressed copies of fetched sources, kept on disk for replaying
+
+If a PopoloSourceImporter is given a SnapshotStore, every response it
+fetches is saved, gzipped, as:
+
+    <directory>/<PopoloSource ID>/<SHA-256 of the content>.json.gz
+
+and update_from_snapshot can then re-import a source from one of
+those files without any network access. Only the most recent
+snapshots are kept; see SnapshotStore for the limits.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import gzip
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+
+SUFFIX = '.json.gz'
+
+
+class SnapshotNotFound(Exception):
+    pass
+
+
+class Snapshot(namedtuple('Snapshot', ['path', 'content_digest', 'mtime', 'size'])):
+
+    def open(self):
+        """Return the uncompressed snapshot as a binary file object"""
+        return gzip.GzipFile(self.path, 'rb')
+
+
+class SnapshotStore(object):
+
+    """A directory of gzipped snapshots of each source's content
+
+    After each snapshot is saved, the oldest are removed so that
+    there are no more than max_per_source for each source, none older
+    than max_age (a timedelta) and no more than max_total_size bytes
+    across all sources. Any of those can be None for no limit. The
+    directory defaults to the POPOLO_SOURCES_SNAPSHOT_DIR setting."""
+
+    def __init__(self, directory=None, max_per_source=3, max_age=None,
+                 max_total_size=None):
+        if directory is None:
+            directory = getattr(settings, 'POPOLO_SOURCES_SNAPSHOT_DIR', None)
+        if not directory:
+            msg = "No snapshot directory was given, and " \
+                "POPOLO_SOURCES_SNAPSHOT_DIR isn't set"
+            raise Exception(msg)
+        self.directory = directory
+        self.max_per_source = max_per_source
+        self.max_age = max_age
+        self.max_total_size = max_total_size
+
+    def source_directory(self, popolo_source):
+        return os.path.join(self.directory, str(popolo_source.id))
+
+    def path(self, popolo_source, content_digest):
+        return os.path.join(
+            self.source_directory(popolo_source), content_digest + SUFFIX)
+
+    def save(self, popolo_source, content_digest, f):
+        """Save the content of the binary file object f as a snapshot
+
+        If there's already a snapshot with that digest, it's just
+        marked as the most recent."""
+        path = self.path(popolo_source, content_digest)
+        if os.path.exists(path):
+            os.utime(path, None)
+        else:
+            source_directory = self.source_directory(popolo_source)
+            if not os.path.isdir(source_directory):
+                os.makedirs(source_directory)
+            # Write to a temporary file and rename it, so a partly
+            # written snapshot is never read:
+            with tempfile.NamedTemporaryFile(
+                    dir=source_directory, delete=False) as ntf:
+                with gzip.GzipFile(fileobj=ntf, mode='wb') as gzf:
+                    shutil.copyfileobj(f, gzf)
+            os.rename(ntf.name, path)
+        self.evict()
+
+    def snapshots(self, popolo_source):
+        """Return the snapshots of popolo_source, most recent first"""
+        return self._snapshots_in(self.source_directory(popolo_source))
+
+    def _snapshots_in(self, source_directory):
+        if not os.path.isdir(source_directory):
+            return []
+        result = []
+        for filename in os.listdir(source_directory):
+            if not filename.endswith(SUFFIX):
+                continue
+            path = os.path.join(source_directory, filename)
+            stat = os.stat(path)
+            result.append(Snapshot(
+                path, filename[:-len(SUFFIX)],
+                datetime.fromtimestamp(stat.st_mtime), stat.st_size))
+        result.sort(key=lambda s: s.mtime, reverse=True)
+        return result
+
+    def get(self, popolo_source, content_digest=None):
+        """Return the snapshot with that digest, or else the latest one"""
+        for snapshot in self.snapshots(popolo_source):
+            if content_digest in (None, snapshot.content_digest):
+                return snapshot
+        if content_digest is None:
+            msg = "There are no snapshots of {0}"
+        else:
+            msg = "There's no snapshot of {0} with digest {1}"
+        raise SnapshotNotFound(msg.format(repr(popolo_source), content_digest))
+
+    def evict(self):
+        """Remove snapshots beyond the retention limits"""
+        if not os.path.isdir(self.directory):
+            return
+        kept = []
+        oldest_allowed = None
+        if self.max_age is not None:
+            oldest_allowed = datetime.now() - self.max_age
+        for source_id in os.listdir(self.directory):
+            snapshots = self._snapshots_in(
+                os.path.join(self.directory, source_id))
+            for i, snapshot in enumerate(snapshots):
+                too_many = self.max_per_source is not None and \
+                    i >= self.max_per_source
+                too_old = oldest_allowed is not None and \
+                    snapshot.mtime < oldest_allowed
+                if too_many or too_old:
+                    os.remove(snapshot.path)
+                else:
+                    kept.append(snapshot)
+        if self.max_total_size is not None:
+            kept.sort(key=lambda s: s.mtime, reverse=True)
+            total_size = 0
+            for i, snapshot in enumerate(kept):
+                total_size += snapshot.size
+                # The most recent snapshot is always kept:
+                if i > 0 and total_size > self.max_total_size:
+                    os.remove(snapshot.path)
@@ -0,0 +1,94 @@
+"""Incremental parsing of Popolo JSON for sources too big to load at once
+
+The response body is written to a temporary file as it's downloaded,
+and then each top-level collection is parsed from that file one
+object at a time when the importer asks for it. This means that the
+raw body, its decoded text and the complete tree of Python objects
+never have to be held in memory together, and collections can be
+read in whatever order the importer needs them, regardless of their
+order in the file.
+
+This needs the optional ijson package, which you can install with:
+
+    pip install multiple-django-popolo-sources[streaming]
+"""
+
+import hashlib
+import itertools
+import tempfile
+
+from popolo_sources.files import decompress_chunks
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def check_streaming_available():
+    if ijson is None:
+        msg = "Streaming imports need the ijson package; install it with: " \
+            "pip install multiple-django-popolo-sources[streaming]"
+        raise ImportError(msg)
+
+
+def spool_response(response, chunk_size=64 * 1024):
+    """Copy a streamed response body to a temporary file
+
+    If the body is compressed, it's decompressed as it's copied. This
+    returns the file, positioned at the start, and the SHA-256 hex
+    digest of the (decompressed) body."""
+    f = tempfile.TemporaryFile()
+    digest = hashlib.sha256()
+    for chunk in decompress_chunks(response.iter_content(chunk_size)):
+        digest.update(chunk)
+        f.write(chunk)
+    f.seek(0)
+    return f, digest.hexdigest()
+
+
+class StreamedCollection(object):
+
+    """A top-level collection in a Popolo JSON file, parsed lazily
+
+    Each time this is iterated over, the file is parsed again from
+    the start and the objects in the collection are yielded one at a
+    time. Since every iteration shares the same file, you can't
+    iterate over two collections from the same file at once."""
+
+    def __init__(self, f, collection):
+        self.f = f
+        self.collection = collection
+
+    def __iter__(self):
+        self.f.seek(0)
+        prefix = '{0}.item'.format(self.collection)
+        return ijson.items(self.f, prefix, use_float=True)
+
+    # PopoloJSONImporter concatenates the top-level memberships with
+    # those found inline in persons, so support that without making
+    # a list:
+
+    def __add__(self, other):
+        return itertools.chain(self, other)
+
+    def __radd__(self, other):
+        return itertools.chain(other, self)
+
+
+class StreamedPopoloData(object):
+
+    """A dict-like view of the collections in a Popolo JSON file
+
+    This can be passed to import_from_export_json_data in place of
+    the decoded JSON. A collection missing from the file behaves as
+    if it were empty."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def get(self, collection, default=None):
+        return StreamedCollection(self.f, collection)
+
+    def __getitem__(self, collection):
+        return StreamedCollection(self.f, collection)
@@ -0,0 +1,67 @@
+from mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from popolo.models import Person
+from popolo_sources.cache import live_object_ids
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import LinkToPopoloSource, PopoloSource
+
+from .test_importer import fake_requests_get
+
+
+@patch('popolo_sources.importer.requests.get', side_effect=fake_requests_get)
+class LiveObjectIdCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        live_object_ids.reset_counters()
+        self.popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        self.importer = PopoloSourceImporter(self.popolo_source)
+        with patch('popolo_sources.importer.requests.get',
+                   side_effect=fake_requests_get):
+            self.importer.update_from_source()
+
+    def test_read_through(self, fake_get):
+        people = list(Person.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(live_object_ids.get_ids(self.popolo_source, Person)),
+                [p.id for p in people])
+        with self.assertNumQueries(0):
+            self.assertTrue(
+                live_object_ids.contains(self.popolo_source, people[0]))
+        self.assertEqual(live_object_ids.misses, 1)
+        self.assertEqual(live_object_ids.hits, 1)
+        other_person = Person.objects.create(name='Carol')
+        self.assertFalse(
+            live_object_ids.contains(self.popolo_source, other_person))
+        self.assertEqual(
+            list(live_object_ids.filter_queryset(
+                Person.objects.order_by('pk'), self.popolo_source)),
+            people)
+
+    def test_invalidated_by_update(self, fake_get):
+        self.assertEqual(
+            len(live_object_ids.get_ids(self.popolo_source, Person)), 2)
+        self.popolo_source.url = 'http://example.com/single-person.json'
+        self.popolo_source.save()
+        self.importer.update_from_source()
+        self.assertEqual(
+            list(live_object_ids.get_ids(self.popolo_source, Person)),
+            [Person.objects.get(name='Alice').id])
+        self.assertEqual(live_object_ids.misses, 2)
+
+    def test_filter_queryset_with_many_objects(self, fake_get):
+        people = [Person.objects.create(name=str(i)) for i in range(400)]
+        LinkToPopoloSource.objects.bulk_create(
+            LinkToPopoloSource(
+                popolo_object=p, popolo_source=self.popolo_source)
+            for p in people)
+        live_object_ids.invalidate(self.popolo_source)
+        self.assertEqual(
+            live_object_ids.filter_queryset(
+                Person.objects.all(), self.popolo_source).count(),
+            402)
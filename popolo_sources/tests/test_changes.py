@@ -0,0 +1,172 @@
+from datetime import timedelta
+
+from mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from popolo.models import Person
+from popolo_sources.changes import (
+    changes_in_run, changes_since, prune_changes, readable_runs)
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import ImportRun, ObjectChange, PopoloSource
+
+from .test_importer import capture_output, fake_requests_get
+
+
+def summarize(changes):
+    return [
+        (change.change, change.content_type.model,
+         change.popolo_object.name)
+        for change in changes]
+
+
+@patch('popolo_sources.importer.requests.get', side_effect=fake_requests_get)
+class ChangeLogTests(TestCase):
+
+    def update(self, url, **kwargs):
+        self.popolo_source.url = url
+        self.popolo_source.save()
+        importer = PopoloSourceImporter(
+            self.popolo_source, record_changes=True, **kwargs)
+        importer.update_from_source()
+        return ImportRun.objects.latest('pk')
+
+    def setUp(self):
+        self.popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+
+    def test_changes_recorded(self, fake_get):
+        run = self.update('http://example.com/two-people.json')
+        self.assertTrue(run.succeeded)
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual(
+            run.content_digest, self.popolo_source.content_digest)
+        self.assertEqual(
+            summarize(changes_in_run(run)),
+            [('created', 'person', 'Alice'), ('created', 'person', 'Bob')])
+        # Alice is the same as before, so she isn't recorded:
+        run = self.update('http://example.com/single-person.json')
+        self.assertEqual(
+            summarize(changes_in_run(run)),
+            [('disappeared', 'person', 'Bob')])
+        run = self.update('http://example.com/two-people-one-changed.json')
+        self.assertEqual(
+            summarize(changes_in_run(run)),
+            [('reappeared', 'person', 'Robert')])
+
+    def test_reappeared_after_links_flushed(self, fake_get):
+        self.update('http://example.com/two-people.json')
+        self.update('http://example.com/single-person.json')
+        # Bob's link is written before the change log is told about
+        # him, if the chunk ends with him:
+        run = self.update(
+            'http://example.com/two-people-one-changed.json',
+            link_chunk_size=1)
+        self.assertEqual(
+            summarize(changes_in_run(run)),
+            [('reappeared', 'person', 'Robert')])
+
+    def test_changes_recorded_with_set_based_deletions(self, fake_get):
+        self.update(
+            'http://example.com/two-people.json', set_based_deletions=True,
+            skip_unchanged=True)
+        run = self.update(
+            'http://example.com/single-person.json',
+            set_based_deletions=True, skip_unchanged=True)
+        self.assertEqual(
+            summarize(changes_in_run(run)),
+            [('disappeared', 'person', 'Bob')])
+
+    def test_not_recorded_by_default(self, fake_get):
+        PopoloSourceImporter(self.popolo_source).update_from_source()
+        self.assertFalse(ImportRun.objects.exists())
+        self.assertFalse(ObjectChange.objects.exists())
+
+    def test_failed_run_finished(self, fake_get):
+        importer = PopoloSourceImporter(
+            self.popolo_source, record_changes=True, commit_every=1)
+        with patch.object(
+                importer, 'update_person', side_effect=ValueError):
+            with capture_output(), self.assertRaises(ValueError):
+                importer.update_from_source()
+        run = ImportRun.objects.get()
+        self.assertFalse(run.succeeded)
+        self.assertIsNotNone(run.finished_at)
+
+    def test_changes_since(self, fake_get):
+        first_run = self.update('http://example.com/two-people.json')
+        second_run = self.update('http://example.com/single-person.json')
+        self.assertEqual(
+            [c.import_run_id for c in changes_since()],
+            [first_run.id, first_run.id, second_run.id])
+        # Two queries for the runs, and one for each batch of changes:
+        with self.assertNumQueries(4):
+            changes = list(changes_since(first_run.id, batch_size=1))
+        self.assertEqual([c.change for c in changes], ['disappeared'])
+        self.assertEqual(
+            list(changes_since(first_run.id, PopoloSource.objects.create(
+                url='http://example.com/other.json'))),
+            [])
+
+    def test_readable_runs_stop_at_run_in_progress(self, fake_get):
+        first_run = self.update('http://example.com/two-people.json')
+        in_progress = ImportRun.objects.create(
+            popolo_source=self.popolo_source)
+        self.update('http://example.com/single-person.json')
+        self.assertEqual(list(readable_runs()), [first_run])
+        # Unless it's been abandoned:
+        in_progress.started_at -= timedelta(days=1)
+        in_progress.save()
+        self.assertEqual(len(readable_runs()), 2)
+
+    def test_prune_changes(self, fake_get):
+        old_run = self.update('http://example.com/two-people.json')
+        old_run.finished_at -= timedelta(days=30)
+        old_run.save()
+        new_run = self.update('http://example.com/single-person.json')
+        deleted = prune_changes(
+            timezone.now() - timedelta(days=7), batch_size=1)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(list(ImportRun.objects.all()), [new_run])
+        self.assertEqual(ObjectChange.objects.count(), 1)
+
+    def test_prune_abandoned_runs(self, fake_get):
+        abandoned_run = self.update('http://example.com/two-people.json')
+        abandoned_run.finished_at = None
+        abandoned_run.started_at -= timedelta(days=30)
+        abandoned_run.save()
+        in_progress = ImportRun.objects.create(
+            popolo_source=self.popolo_source)
+        deleted = prune_changes(timezone.now() - timedelta(days=7))
+        self.assertEqual(deleted, 2)
+        self.assertEqual(list(ImportRun.objects.all()), [in_progress])
+
+    def test_changes_command(self, fake_get):
+        run = self.update('http://example.com/two-people.json')
+        bob = Person.objects.get(name='Bob')
+        with capture_output() as (out, err):
+            call_command('popolo_sources_changes', '--since', '0')
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(
+            lines[1],
+            '{0}\t{1}\tcreated\tpopolo.person\t{2}'.format(
+                run.id, self.popolo_source.id, bob.id))
+        self.assertEqual(
+            err.getvalue(),
+            'Read the changes up to import run {0}\n'.format(run.id))
+        with capture_output() as (out, err):
+            call_command('popolo_sources_changes', '--since', str(run.id))
+        self.assertEqual(out.getvalue(), '')
+        self.assertIn(str(run.id), err.getvalue())
+
+    def test_prune_changes_command(self, fake_get):
+        run = self.update('http://example.com/two-people.json')
+        run.finished_at -= timedelta(days=30)
+        run.save()
+        with capture_output() as (out, err):
+            call_command('popolo_sources_prune_changes', '--days', '7')
+        self.assertEqual(out.getvalue(), 'Deleted 2 changes\n')
+        self.assertFalse(ImportRun.objects.exists())
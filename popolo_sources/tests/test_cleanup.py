@@ -0,0 +1,131 @@
+from datetime import timedelta
+
+from mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from popolo.models import Membership, Person
+from popolo_sources.cleanup import purge_deleted_links
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import LinkToPopoloSource, PopoloSource
+
+from .test_importer import capture_output, fake_requests_get
+
+
+@patch('popolo_sources.importer.requests.get', side_effect=fake_requests_get)
+class PurgeDeletedLinksTests(TestCase):
+
+    def update(self, popolo_source, url, **kwargs):
+        popolo_source.url = url
+        popolo_source.save()
+        PopoloSourceImporter(popolo_source, **kwargs).update_from_source()
+
+    def age_deleted_links(self, days=30):
+        for link in LinkToPopoloSource.objects.filter(
+                deleted_from_source=True):
+            link.deleted_at -= timedelta(days=days)
+            link.save()
+
+    def setUp(self):
+        self.popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        self.week_ago = timezone.now() - timedelta(days=7)
+
+    def test_deleted_at(self, fake_get):
+        for kwargs in ({}, {'set_based_deletions': True}):
+            self.update(
+                self.popolo_source, 'http://example.com/two-people.json',
+                **kwargs)
+            self.assertFalse(LinkToPopoloSource.objects.filter(
+                deleted_at__isnull=False).exists())
+            self.update(
+                self.popolo_source, 'http://example.com/single-person.json',
+                **kwargs)
+            deleted_link = LinkToPopoloSource.objects.get(
+                deleted_at__isnull=False)
+            self.assertEqual(deleted_link.popolo_object.name, 'Bob')
+
+    def test_purge(self, fake_get):
+        self.update(self.popolo_source, 'http://example.com/two-people.json')
+        self.update(
+            self.popolo_source, 'http://example.com/single-person.json')
+        # Bob hasn't been deleted for long enough yet:
+        self.assertEqual(purge_deleted_links(self.week_ago), (0, 0))
+        self.age_deleted_links()
+        self.assertEqual(purge_deleted_links(self.week_ago), (1, 0))
+        self.assertEqual(LinkToPopoloSource.objects.count(), 1)
+        self.assertEqual(Person.objects.count(), 2)
+
+    def test_orphans_linked_from_other_sources_kept(self, fake_get):
+        self.update(self.popolo_source, 'http://example.com/two-people.json')
+        self.update(
+            self.popolo_source, 'http://example.com/single-person.json')
+        self.age_deleted_links()
+        bob_link = LinkToPopoloSource.objects.get(deleted_from_source=True)
+        LinkToPopoloSource.objects.create(
+            popolo_source=PopoloSource.objects.create(
+                url='http://example.com/other.json'),
+            content_type=bob_link.content_type,
+            object_id=bob_link.object_id)
+        self.assertEqual(
+            purge_deleted_links(self.week_ago, delete_orphans=True), (1, 0))
+        self.assertEqual(Person.objects.count(), 2)
+
+    def test_orphans_with_linked_objects_kept(self, fake_get):
+        self.update(
+            self.popolo_source, 'http://example.com/more-collections.json')
+        alice = Person.objects.get()
+        LinkToPopoloSource.objects.filter(
+            content_type__model='person', object_id=alice.id).update(
+            deleted_from_source=True,
+            deleted_at=timezone.now() - timedelta(days=30))
+        # Deleting Alice would delete her membership, which is still in
+        # the source:
+        self.assertEqual(
+            purge_deleted_links(self.week_ago, delete_orphans=True), (1, 0))
+        self.assertTrue(Person.objects.exists())
+        self.assertTrue(Membership.objects.exists())
+
+    def test_locked_source_skipped(self, fake_get):
+        self.update(self.popolo_source, 'http://example.com/two-people.json')
+        self.update(
+            self.popolo_source, 'http://example.com/single-person.json')
+        self.age_deleted_links()
+        # An import of the source is running:
+        self.assertTrue(self.popolo_source.acquire_lock())
+        self.assertEqual(
+            purge_deleted_links(self.week_ago, delete_orphans=True), (0, 0))
+        self.assertEqual(Person.objects.count(), 2)
+        self.popolo_source.release_lock()
+        self.assertEqual(purge_deleted_links(self.week_ago), (1, 0))
+        self.popolo_source.refresh_from_db()
+        self.assertIsNone(self.popolo_source.locked_until)
+
+    def test_max_rate(self, fake_get):
+        self.update(
+            self.popolo_source, 'http://example.com/more-collections.json')
+        self.update(
+            self.popolo_source, 'http://example.com/single-person.json')
+        self.age_deleted_links()
+        with patch('popolo_sources.cleanup.time.sleep') as sleep:
+            self.assertEqual(
+                purge_deleted_links(self.week_ago, batch_size=1, max_rate=1),
+                (4, 0))
+        self.assertEqual(sleep.call_count, 4)
+        self.assertGreater(sleep.call_args[0][0], 3)
+
+    def test_purge_command(self, fake_get):
+        self.update(self.popolo_source, 'http://example.com/two-people.json')
+        self.update(
+            self.popolo_source, 'http://example.com/single-person.json')
+        self.age_deleted_links()
+        with capture_output() as (out, err):
+            call_command(
+                'popolo_sources_purge_deleted', '--days', '7',
+                '--delete-orphans')
+        self.assertEqual(
+            out.getvalue(), 'Deleted 1 links\nDeleted 1 orphaned objects\n')
+        self.assertEqual(
+            [p.name for p in Person.objects.all()], ['Alice'])
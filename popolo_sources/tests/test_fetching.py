@@ -0,0 +1,101 @@
+from mock import Mock, patch
+
+from django.test import TestCase
+
+from popolo.models import Person
+from popolo_sources.fetching import (
+    make_session, update_with_concurrent_fetches)
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import PopoloSource
+
+from .test_importer import fake_requests_get
+
+
+class MakeSessionTests(TestCase):
+
+    def test_retries_configured(self):
+        session = make_session(pool_size=3, retries=5, backoff_factor=2)
+        adapter = session.get_adapter('https://example.com/')
+        self.assertEqual(adapter.max_retries.total, 5)
+        self.assertEqual(adapter.max_retries.backoff_factor, 2)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+
+
+class ConcurrentFetchTests(TestCase):
+
+    def make_importers(self, *urls, **kwargs):
+        session = Mock()
+        session.get.side_effect = fake_requests_get
+        return [
+            PopoloSourceImporter(
+                PopoloSource.objects.create(url=url),
+                session=session,
+                timeout=10,
+                **kwargs)
+            for url in urls]
+
+    def test_update_several_sources(self):
+        importers = self.make_importers(
+            'http://example.com/single-person.json',
+            'http://example.com/same-person-different-source.json',
+            'http://example.com/more-collections.json')
+        results = list(update_with_concurrent_fetches(importers, 2))
+        self.assertEqual(
+            sorted(r.importer.popolo_source.url for r in results),
+            sorted(i.popolo_source.url for i in importers))
+        self.assertTrue(all(r.updated for r in results))
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual(Person.objects.count(), 3)
+        session = importers[0].session
+        self.assertEqual(session.get.call_count, 3)
+        self.assertEqual(session.get.call_args[1]['timeout'], 10)
+
+    def test_unchanged_sources(self):
+        importers = self.make_importers(
+            'http://example.com/single-person.json',
+            'http://example.com/two-people.json')
+        list(update_with_concurrent_fetches(importers))
+        results = list(update_with_concurrent_fetches(importers))
+        self.assertEqual([r.updated for r in results], [False, False])
+
+    def test_failure_does_not_stop_other_sources(self):
+        importers = self.make_importers(
+            'http://example.com/does-not-exist.json',
+            'http://example.com/two-people.json')
+        results = {
+            r.importer.popolo_source.url: r
+            for r in update_with_concurrent_fetches(importers, 2)}
+        failed = results['http://example.com/does-not-exist.json']
+        self.assertIsNone(failed.updated)
+        self.assertIn("hasn't been faked", failed.error)
+        self.assertTrue(results['http://example.com/two-people.json'].updated)
+        self.assertEqual(Person.objects.count(), 2)
+
+    def test_import_failure_reported(self):
+        importers = self.make_importers('http://example.com/two-people.json')
+        with patch.object(
+                importers[0], 'update_from_data', side_effect=ValueError('Oops')):
+            results = list(update_with_concurrent_fetches(importers))
+        self.assertIn('ValueError: Oops', results[0].error)
+
+    def test_stopping_early_closes_fetched_sources(self):
+        importers = self.make_importers(
+            'http://example.com/single-person.json',
+            'http://example.com/two-people.json',
+            'http://example.com/more-collections.json')
+        fetched = []
+        for importer in importers:
+            original_fetch = importer.fetch
+
+            def fetch(force=False, original_fetch=original_fetch):
+                result = Mock(wraps=original_fetch(force=force))
+                result.data = result._mock_wraps.data
+                fetched.append(result)
+                return result
+            importer.fetch = fetch
+        results = update_with_concurrent_fetches(importers, 3, queue_size=1)
+        next(results)
+        results.close()
+        self.assertEqual(len(fetched), 3)
+        for f in fetched:
+            f.close.assert_called_once_with()
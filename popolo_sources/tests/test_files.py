@@ -0,0 +1,108 @@
+import bz2
+import gzip
+import io
+from os.path import dirname, join
+import shutil
+import tempfile
+from unittest import skipUnless
+
+from django.test import TestCase
+
+from popolo.models import Person
+from popolo_sources import streaming
+from popolo_sources.files import decompress_chunks, lzma
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import PopoloSource
+
+
+FIXTURE = join(dirname(__file__), 'fixtures', 'two-people.json')
+
+
+def read_fixture():
+    with open(FIXTURE, 'rb') as f:
+        return f.read()
+
+
+def gzip_compress(content):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(content)
+    return out.getvalue()
+
+
+def chunked(content, chunk_size=7):
+    return [content[i:i + chunk_size]
+            for i in range(0, len(content), chunk_size)]
+
+
+class DecompressionTests(TestCase):
+
+    def assertDecompresses(self, compressed, expected):
+        self.assertEqual(
+            b''.join(decompress_chunks(chunked(compressed))), expected)
+
+    def test_uncompressed(self):
+        self.assertDecompresses(b'{"persons": []}', b'{"persons": []}')
+        self.assertDecompresses(b'{}', b'{}')
+
+    def test_gzip(self):
+        content = read_fixture()
+        self.assertDecompresses(gzip_compress(content), content)
+
+    def test_bz2(self):
+        content = read_fixture()
+        self.assertDecompresses(bz2.compress(content), content)
+
+    @skipUnless(lzma, 'lzma is only in Python 3')
+    def test_xz(self):
+        content = read_fixture()
+        self.assertDecompresses(lzma.compress(content), content)
+
+
+class LocalFileSourceTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_source(self, filename, content):
+        path = join(self.directory, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return PopoloSource.objects.create(url='file://' + path)
+
+    def test_import_local_file(self):
+        popolo_source = self.make_source('two-people.json', read_fixture())
+        importer = PopoloSourceImporter(popolo_source)
+        self.assertTrue(importer.update_from_source())
+        self.assertEqual(Person.objects.count(), 2)
+        # The file hasn't changed, so it's not even read again:
+        report = importer.update_from_source()
+        self.assertEqual(report.skipped_reason, 'not modified')
+
+    def test_import_compressed_local_file(self):
+        content = read_fixture()
+        popolo_source = self.make_source(
+            'two-people.json.gz', gzip_compress(content))
+        importer = PopoloSourceImporter(popolo_source)
+        importer.update_from_source()
+        self.assertEqual(Person.objects.count(), 2)
+        # The digest is of the decompressed content:
+        uncompressed_source = self.make_source('two-people.json', content)
+        PopoloSourceImporter(uncompressed_source).update_from_source()
+        uncompressed_source.refresh_from_db()
+        self.assertEqual(
+            popolo_source.content_digest, uncompressed_source.content_digest)
+
+    @skipUnless(streaming.ijson, 'Streaming needs ijson')
+    def test_streaming_local_files(self):
+        content = read_fixture()
+        for filename, file_content in (
+                ('two-people.json', content),
+                ('two-people.json.bz2', bz2.compress(content))):
+            popolo_source = self.make_source(filename, file_content)
+            importer = PopoloSourceImporter(popolo_source, streaming=True)
+            self.assertTrue(importer.update_from_source())
+        self.assertEqual(Person.objects.count(), 4)
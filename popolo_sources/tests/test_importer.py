@@ -1,24 +1,44 @@
+from array import array
 from contextlib import contextmanager
 import json
-from mock import patch, Mock
+from mock import ANY, patch, Mock
 from os.path import dirname, exists, join
 import sys
+from unittest import skipUnless
 
 from django.utils import six
 from django.utils.six.moves.urllib.parse import urlsplit
 
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.db import connection, IntegrityError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
-from popolo.models import Person
-from popolo_sources.models import PopoloSource, LinkToPopoloSource
-from popolo_sources.importer import PopoloSourceImporter
+from popolo.models import Area, Membership, Person, Post
+from popolo.importers.popolo_json import PopoloJSONImporter
+from popolo_sources.models import (
+    ImportCheckpoint, PopoloSource, LinkToPopoloSource)
+from popolo_sources.importer import (
+    CurrentObjectsTracker, PopoloSourceImporter, popolo_content_hash)
+from popolo_sources import streaming
+from popolo_sources.signals import import_finished
 
 
 class FakeResponse(object):
 
-    def __init__(self, response_data):
+    def __init__(self, response_data, status_code=200, headers=None):
         self.response_data = response_data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    @property
+    def content(self):
+        return self.response_data.encode('utf-8')
+
+    def iter_content(self, chunk_size=1):
+        content = self.content
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
 
     def json(self):
         return json.loads(self.response_data)
@@ -212,3 +232,713 @@ class PopoloSourceTests(TestCase):
         self.assertEqual(observer.notify_deleted.call_count, 1)
         observer.notify_deleted.assert_called_once_with(
             'person', Person.objects.get(name='Bob'))
+
+    def test_area_referenced_before_links_flushed(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(popolo_source)
+        importer.update_from_source()
+        post = Post.objects.get()
+        self.assertEqual(post.area, Area.objects.get())
+
+    def test_links_flushed_in_chunks(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(popolo_source, link_chunk_size=2)
+        importer.update_from_source()
+        self.assertEqual(5, LinkToPopoloSource.objects.filter(
+            deleted_from_source=False).count())
+        # Importing again shouldn't create any duplicate links:
+        importer.update_from_source(force=True)
+        self.assertEqual(5, LinkToPopoloSource.objects.count())
+
+    def test_unchanged_links_not_rewritten(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        importer.update_from_source()
+        with patch.object(LinkToPopoloSource.objects, 'bulk_create') as bc:
+            importer.update_from_source(force=True)
+        bc.assert_not_called()
+
+    def test_preloaded_identifiers_import_twice(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(
+            popolo_source, preload_identifiers=True)
+        importer.update_from_source()
+        importer.update_from_source(force=True)
+        self.assertEqual(Person.objects.count(), 1)
+        self.assertEqual(Post.objects.get().area, Area.objects.get())
+        self.assertEqual(5, LinkToPopoloSource.objects.count())
+
+    def test_preloaded_identifiers_not_queried_per_object(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, preload_identifiers=True)
+        importer.update_from_source()
+        with patch.object(
+                importer, 'get_source_objects_with_identifiers',
+                wraps=importer.get_source_objects_with_identifiers) as q:
+            importer.update_from_source(force=True)
+        # That should be one query for each collection, regardless of
+        # the number of people in the source:
+        self.assertEqual(q.call_count, 5)
+        for call_args in q.call_args_list:
+            self.assertEqual(len(call_args[0]), 1)
+
+    def test_preloaded_multiple_identifiers_found(self, faked_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/single-person.json')
+        for name in ('Alice', 'Bob'):
+            person = Person.objects.create(name=name)
+            person.identifiers.create(scheme='popit-person', identifier='a1b2')
+            LinkToPopoloSource.objects.create(
+                popolo_object=person, popolo_source=popolo_source)
+        importer = PopoloSourceImporter(
+            popolo_source, preload_identifiers=True)
+        with capture_output():
+            with self.assertRaisesRegexp(
+                    Person.MultipleObjectsReturned,
+                    r"^Unexpectedly found more than 1 objects matching PopoloSource object, collection 'person' and ID 'a1b2' - found 2 instead.$"):
+                importer.update_from_source()
+
+    def test_unchanged_content_skipped(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        self.assertTrue(importer.update_from_source())
+        popolo_source.refresh_from_db()
+        self.assertEqual(len(popolo_source.content_digest), 64)
+        with patch.object(importer, 'import_from_export_json_data') as i:
+            self.assertFalse(importer.update_from_source())
+        i.assert_not_called()
+
+    def test_unchanged_content_forced(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        importer.update_from_source()
+        with patch.object(importer, 'import_from_export_json_data') as i:
+            self.assertTrue(importer.update_from_source(force=True))
+        self.assertEqual(i.call_count, 1)
+
+    def test_conditional_request_not_modified(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        fake_get.side_effect = lambda url, **kwargs: FakeResponse(
+            fake_requests_get(url).response_data,
+            headers={
+                'ETag': '"abc"',
+                'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+            })
+        importer.update_from_source()
+        popolo_source.refresh_from_db()
+        self.assertEqual(popolo_source.etag, '"abc"')
+        fake_get.side_effect = lambda url, **kwargs: FakeResponse(
+            '', status_code=304)
+        self.assertFalse(importer.update_from_source())
+        fake_get.assert_called_with(
+            'http://example.com/two-people.json',
+            headers={
+                'If-None-Match': '"abc"',
+                'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+            },
+            stream=False,
+            timeout=None)
+        self.assertEqual(Person.objects.count(), 2)
+
+    def test_failed_import_does_not_record_digest(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        with patch.object(
+                importer, 'import_from_export_json_data',
+                side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                importer.update_from_source()
+        popolo_source.refresh_from_db()
+        self.assertEqual(popolo_source.content_digest, '')
+
+    @skipUnless(streaming.ijson, 'ijson is not installed')
+    def test_streaming_import(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(popolo_source, streaming=True)
+        self.assertTrue(importer.update_from_source())
+        self.assertEqual(fake_get.call_args[1]['stream'], True)
+        self.assertEqual(Person.objects.get().name, 'Alice')
+        self.assertEqual(Post.objects.get().area, Area.objects.get())
+        links_cts = LinkToPopoloSource.objects.values_list(
+            'content_type__model', flat=True)
+        self.assertEqual(
+            sorted(links_cts),
+            ['area', 'membership', 'organization', 'person', 'post'])
+        # The digest should be the same as for a non-streaming import:
+        popolo_source.refresh_from_db()
+        self.assertFalse(PopoloSourceImporter(popolo_source).update_from_source())
+
+    @skipUnless(streaming.ijson, 'ijson is not installed')
+    def test_streaming_import_with_deletion(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, streaming=True)
+        importer.update_from_source()
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        importer.update_from_source()
+        deleted_person = LinkToPopoloSource.objects.get(deleted_from_source=True)
+        self.assertEqual(deleted_person.popolo_object.name, 'Bob')
+
+    def test_streaming_needs_ijson(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        with patch.object(streaming, 'ijson', None):
+            with self.assertRaisesRegexp(ImportError, r'ijson'):
+                PopoloSourceImporter(popolo_source, streaming=True)
+
+    def failing_update_person(self, importer, name_to_fail_on):
+        original_update_person = importer.update_person
+
+        def update_person(person_data):
+            if person_data['name'] == name_to_fail_on:
+                raise ValueError("Failing on purpose")
+            return original_update_person(person_data)
+        return patch.object(importer, 'update_person', update_person)
+
+    def test_atomic_import_rolled_back_on_failure(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, atomic=True)
+        with self.failing_update_person(importer, 'Bob'):
+            with capture_output(), self.assertRaises(ValueError):
+                importer.update_from_source()
+        self.assertEqual(Person.objects.count(), 0)
+        self.assertEqual(LinkToPopoloSource.objects.count(), 0)
+
+    def test_chunked_import_keeps_completed_chunks(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, commit_every=1)
+        with self.failing_update_person(importer, 'Bob'):
+            with capture_output(), self.assertRaises(ValueError):
+                importer.update_from_source()
+        # Alice's chunk was completed, and her link written with it:
+        self.assertEqual(Person.objects.get().name, 'Alice')
+        self.assertEqual(LinkToPopoloSource.objects.count(), 1)
+        popolo_source.refresh_from_db()
+        self.assertEqual(popolo_source.content_digest, '')
+        # And the next attempt should complete the import:
+        importer.update_from_source()
+        self.assertEqual(Person.objects.count(), 2)
+        self.assertEqual(LinkToPopoloSource.objects.count(), 2)
+
+    def test_failed_import_does_not_mark_deletions(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, commit_every=1)
+        importer.update_from_source()
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        with self.failing_update_person(importer, 'Alice'):
+            with capture_output(), self.assertRaises(ValueError):
+                importer.update_from_source()
+        self.assertFalse(LinkToPopoloSource.objects.filter(
+            deleted_from_source=True).exists())
+
+    def test_content_hash_stored_on_links(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        importer.update_from_source()
+        link = LinkToPopoloSource.objects.get(
+            object_id=Person.objects.get(name='Alice').id)
+        self.assertEqual(
+            link.content_hash,
+            popolo_content_hash({'id': 'a1b2', 'name': 'Alice'}))
+
+    def test_unchanged_objects_skipped(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, skip_unchanged=True)
+        importer.update_from_source()
+        observer = Mock(spec=['notify', 'notify_deleted', 'notify_unchanged'])
+        importer.add_observer(observer)
+        popolo_source.url = 'http://example.com/two-people-one-changed.json'
+        popolo_source.save()
+        importer.update_from_source()
+        alice = Person.objects.get(name='Alice')
+        robert = Person.objects.get(name='Robert')
+        observer.notify.assert_called_once_with(
+            'person', robert, False, {'id': 'b1c2', 'name': 'Robert'})
+        observer.notify_unchanged.assert_called_once_with(
+            'person', alice, {'id': 'a1b2', 'name': 'Alice'})
+        observer.notify_deleted.assert_not_called()
+        self.assertFalse(LinkToPopoloSource.objects.filter(
+            deleted_from_source=True).exists())
+        self.assertEqual(
+            LinkToPopoloSource.objects.get(object_id=robert.id).content_hash,
+            popolo_content_hash({'id': 'b1c2', 'name': 'Robert'}))
+
+    def test_unchanged_objects_not_skipped_when_forced(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, skip_unchanged=True)
+        importer.update_from_source()
+        observer = Mock(spec=['notify', 'notify_deleted', 'notify_unchanged'])
+        importer.add_observer(observer)
+        importer.update_from_source(force=True)
+        self.assertEqual(observer.notify.call_count, 2)
+        observer.notify_unchanged.assert_not_called()
+
+    def test_unchanged_reappearing_object_not_skipped(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, skip_unchanged=True)
+        importer.update_from_source()
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        importer.update_from_source()
+        popolo_source.url = 'http://example.com/two-people.json'
+        popolo_source.save()
+        importer.update_from_source()
+        self.assertFalse(LinkToPopoloSource.objects.filter(
+            deleted_from_source=True).exists())
+
+    def test_unchanged_memberships_without_ids_skipped(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(popolo_source, skip_unchanged=True)
+        importer.update_from_source()
+        observer = Mock(spec=['notify', 'notify_deleted', 'notify_unchanged'])
+        importer.add_observer(observer)
+        importer.skipping_unchanged = True
+        with open(join(dirname(__file__), 'fixtures', 'more-collections.json')) as f:
+            importer.import_from_export_json_data(json.load(f))
+        observer.notify.assert_not_called()
+        self.assertEqual(
+            sorted(c[0][0] for c in observer.notify_unchanged.call_args_list),
+            ['area', 'membership', 'organization', 'person', 'post'])
+
+    def test_membership_with_changed_legislative_period_updated(
+            self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/legislative-period.json')
+        importer = PopoloSourceImporter(popolo_source, skip_unchanged=True)
+        importer.update_from_source()
+        self.assertEqual(Membership.objects.get().end_date, '2017-05-03')
+        # Only the event has changed, but the membership's end date
+        # comes from it:
+        popolo_source.url = 'http://example.com/legislative-period-changed.json'
+        popolo_source.save()
+        importer.update_from_source()
+        self.assertEqual(Membership.objects.get().end_date, '2017-06-08')
+
+    def test_objects_looked_up_once(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, skip_unchanged=True)
+        with patch.object(
+                importer, 'get_source_objects_with_identifiers',
+                wraps=importer.get_source_objects_with_identifiers) as lookup:
+            importer.update_from_source()
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_import_report(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, count_queries=True)
+        report = importer.update_from_source()
+        self.assertTrue(report)
+        self.assertEqual(report.collections['person']['created'], 2)
+        self.assertEqual(
+            list(report.phases),
+            ['fetch', 'decode', 'get_existing_objects', 'import',
+             'mark_as_deleted', 'notify_observers_of_deletions',
+             'record_fetched_source'])
+        self.assertGreater(report.phases['import']['queries'], 0)
+        self.assertEqual(report.phases['fetch']['queries'], 0)
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        report = importer.update_from_source()
+        self.assertEqual(report.collections['person']['updated'], 1)
+        self.assertEqual(report.collections['person']['disappeared'], 1)
+        popolo_source.url = 'http://example.com/two-people.json'
+        popolo_source.save()
+        report = importer.update_from_source(force=True)
+        self.assertEqual(report.collections['person']['reappeared'], 1)
+        self.assertIn('person', report.format())
+
+    def test_skipped_import_report(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        importer.update_from_source()
+        report = importer.update_from_source()
+        self.assertFalse(report)
+        self.assertEqual(report.skipped_reason, 'content unchanged')
+        self.assertNotIn('import', report.phases)
+
+    def test_import_finished_signal(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        receiver = Mock()
+        import_finished.connect(receiver)
+        try:
+            report = importer.update_from_source()
+        finally:
+            import_finished.disconnect(receiver)
+        receiver.assert_called_once_with(
+            signal=import_finished,
+            sender=PopoloSourceImporter,
+            popolo_source=popolo_source,
+            report=report)
+
+    def test_set_based_deletions(self, fake_get):
+        observer = Mock(spec=['notify', 'notify_deleted'])
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, set_based_deletions=True)
+        importer.add_observer(observer)
+        importer.update_from_source()
+        self.assertEqual(
+            set(LinkToPopoloSource.objects.values_list(
+                'import_generation', flat=True)),
+            {1})
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        with patch.object(importer, 'get_existing_objects') as geo:
+            report = importer.update_from_source()
+        geo.assert_not_called()
+        self.assertEqual(report.collections['person']['disappeared'], 1)
+        deleted_link = LinkToPopoloSource.objects.get(
+            deleted_from_source=True)
+        self.assertEqual(deleted_link.popolo_object.name, 'Bob')
+        observer.notify_deleted.assert_called_once_with(
+            'person', Person.objects.get(name='Bob'))
+        # Bob should come back, and nothing is deleted again:
+        popolo_source.url = 'http://example.com/two-people.json'
+        popolo_source.save()
+        report = importer.update_from_source(force=True)
+        self.assertEqual(report.collections['person']['reappeared'], 1)
+        self.assertEqual(report.collections['person']['disappeared'], 0)
+        self.assertFalse(LinkToPopoloSource.objects.filter(
+            deleted_from_source=True).exists())
+        self.assertEqual(observer.notify_deleted.call_count, 1)
+
+    def test_set_based_deletions_with_unchanged_objects(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, set_based_deletions=True, skip_unchanged=True,
+            link_chunk_size=1)
+        importer.update_from_source()
+        popolo_source.url = 'http://example.com/two-people-one-changed.json'
+        popolo_source.save()
+        report = importer.update_from_source()
+        self.assertEqual(report.collections['person']['unchanged'], 1)
+        self.assertEqual(report.collections['person']['disappeared'], 0)
+        self.assertEqual(
+            set(LinkToPopoloSource.objects.values_list(
+                'deleted_from_source', 'import_generation')),
+            {(False, 2)})
+
+    def test_deletions_batched(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/single-person.json')
+        people = [Person.objects.create(name=str(i)) for i in range(700)]
+        LinkToPopoloSource.objects.bulk_create(
+            LinkToPopoloSource(popolo_object=p, popolo_source=popolo_source)
+            for p in people)
+        importer = PopoloSourceImporter(popolo_source)
+        report = importer.update_from_source()
+        self.assertEqual(report.collections['person']['disappeared'], 700)
+        self.assertEqual(
+            LinkToPopoloSource.objects.filter(
+                deleted_from_source=True).count(),
+            700)
+
+    def test_queries_not_counted_by_default(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        with patch('popolo_sources.reports.QueryCounter') as query_counter:
+            report = importer.update_from_source()
+        query_counter.assert_not_called()
+        self.assertIsNone(report.phases['import']['queries'])
+        self.assertIn(
+            'import', [l.split()[0] for l in report.format().splitlines()])
+
+    def test_batch_observer(self, fake_get):
+        observer = Mock(spec=['notify_batch', 'notify_deleted_batch'])
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        importer.add_batch_observer(observer)
+        importer.update_from_source()
+        observer.notify_batch.assert_called_once_with('person', [
+            (Person.objects.get(name='Alice'), True, ANY),
+            (Person.objects.get(name='Bob'), True, ANY),
+        ])
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        importer.update_from_source()
+        self.assertEqual(observer.notify_batch.call_count, 2)
+        observer.notify_deleted_batch.assert_called_once_with(
+            'person', [Person.objects.get(name='Bob')])
+
+    def test_batch_observer_batch_size(self, fake_get):
+        observer = Mock(spec=['notify_batch', 'notify_deleted_batch'])
+        per_object_observer = Mock(spec=['notify', 'notify_deleted'])
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, observer_batch_size=1, set_based_deletions=True)
+        importer.add_batch_observer(observer)
+        importer.add_observer(per_object_observer)
+        importer.update_from_source()
+        self.assertEqual(
+            [c[0][1][0][0].name for c in observer.notify_batch.call_args_list],
+            ['Alice', 'Bob'])
+        self.assertEqual(per_object_observer.notify.call_count, 2)
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        importer.update_from_source()
+        observer.notify_deleted_batch.assert_called_once_with(
+            'person', [Person.objects.get(name='Bob')])
+        per_object_observer.notify_deleted.assert_called_once_with(
+            'person', Person.objects.get(name='Bob'))
+
+    def test_plan(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source)
+        plan = importer.plan()
+        self.assertTrue(plan)
+        self.assertEqual(
+            sorted(plan.changes['person']['created']), ['a1b2', 'b1c2'])
+        importer.update_from_source()
+        self.assertFalse(importer.plan())
+        popolo_source.url = 'http://example.com/two-people-one-changed.json'
+        popolo_source.save()
+        with CaptureQueriesContext(connection) as queries:
+            plan = importer.plan()
+        self.assertLessEqual(len(queries), 6)
+        for query in queries:
+            self.assertNotRegexpMatches(
+                query['sql'].upper(), r'\b(INSERT|UPDATE|DELETE)\b')
+        self.assertEqual(plan.changes['person']['updated'], ['b1c2'])
+        self.assertEqual(plan.changes['person']['unchanged'], ['a1b2'])
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        plan = importer.plan()
+        self.assertEqual(plan.changes['person']['deleted'], ['b1c2'])
+        self.assertIn('person', plan.format())
+
+    def test_plan_unchanged_collections(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(popolo_source)
+        importer.update_from_source()
+        plan = importer.plan()
+        self.assertFalse(plan)
+        self.assertEqual(
+            sorted(c for c, changes in plan.changes.items()
+                   if changes['unchanged']),
+            ['area', 'membership', 'organization', 'person', 'post'])
+
+    def test_collections_subset(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(
+            popolo_source,
+            collections=['area', 'organization', 'post', 'person'])
+        importer.update_from_source()
+        self.assertFalse(Membership.objects.exists())
+        # Now just the memberships, which refer to objects imported
+        # before:
+        importer = PopoloSourceImporter(
+            popolo_source, collections=['membership'])
+        report = importer.update_from_source()
+        self.assertEqual(report.collections['membership']['created'], 1)
+        self.assertEqual(report.collections['person']['unchanged'], 0)
+        # Only the links of the memberships were loaded:
+        self.assertEqual(
+            list(importer.link_creator.existing_links),
+            [ContentType.objects.get_for_model(Membership).id])
+        membership = Membership.objects.get()
+        self.assertEqual(membership.person.name, 'Alice')
+        self.assertEqual(membership.post.role, 'Member of Parliament')
+        # Only memberships can be marked as deleted:
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        report = importer.update_from_source()
+        self.assertEqual(report.collections['membership']['disappeared'], 1)
+        self.assertEqual(
+            set(LinkToPopoloSource.objects.filter(
+                deleted_from_source=True).values_list(
+                    'content_type__model', flat=True)),
+            {'membership'})
+        plan = importer.plan()
+        self.assertEqual(list(plan.changes), [])
+
+    def test_collections_subset_not_recorded(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        PopoloSourceImporter(
+            popolo_source, collections=['person']).update_from_source()
+        popolo_source.refresh_from_db()
+        self.assertEqual(popolo_source.content_digest, '')
+        report = PopoloSourceImporter(popolo_source).update_from_source()
+        self.assertTrue(report)
+
+    def test_collections_subset_inline_areas(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/inline-areas-and-memberships.json')
+        PopoloSourceImporter(popolo_source).update_from_source()
+        for kwargs in ({}, {'set_based_deletions': True}):
+            importer = PopoloSourceImporter(
+                popolo_source, collections=['area'], **kwargs)
+            self.assertFalse(importer.plan().changes['area']['deleted'])
+            report = importer.update_from_source()
+            self.assertEqual(report.collections['area']['updated'], 1)
+            self.assertEqual(report.collections['area']['disappeared'], 0)
+            self.assertFalse(LinkToPopoloSource.objects.filter(
+                deleted_from_source=True).exists())
+
+    def test_collections_subset_without_inline_memberships(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/inline-areas-and-memberships.json')
+        report = PopoloSourceImporter(
+            popolo_source, collections=['person']).update_from_source()
+        self.assertEqual(report.collections['person']['created'], 1)
+        self.assertFalse(Membership.objects.exists())
+        self.assertEqual(
+            list(LinkToPopoloSource.objects.values_list(
+                'content_type__model', flat=True)),
+            ['person'])
+
+    def test_unknown_collection_subset(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/single-person.json')
+        with self.assertRaisesRegexp(
+                Exception, r"Unknown collection 'people'"):
+            PopoloSourceImporter(popolo_source, collections=['people'])
+
+    def interrupted_update(self, importer, name_to_fail_on):
+        with self.failing_update_person(importer, name_to_fail_on):
+            with capture_output(), self.assertRaises(ValueError):
+                importer.update_from_source()
+
+    def test_checkpoint_needs_commit_every(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        with self.assertRaisesRegexp(Exception, r'commit_every'):
+            PopoloSourceImporter(popolo_source, checkpoint=True)
+
+    def test_checkpointed_import_resumed(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, checkpoint=True, commit_every=1)
+        self.interrupted_update(importer, 'Bob')
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual(checkpoint.collection, 'person')
+        self.assertEqual(checkpoint.position, 1)
+        self.assertEqual(checkpoint.import_generation, 1)
+        self.assertEqual(
+            list(Person.objects.values_list('name', flat=True)), ['Alice'])
+        # Alice shouldn't be imported again:
+        with patch.object(
+                PopoloJSONImporter, 'update_person',
+                side_effect=PopoloJSONImporter.update_person,
+                autospec=True) as update_person:
+            report = importer.update_from_source()
+        self.assertEqual(update_person.call_count, 1)
+        self.assertEqual(report.resumed_from, 1)
+        self.assertIn('resumed from position 1', report.format())
+        self.assertEqual(report.collections['person']['created'], 1)
+        self.assertFalse(ImportCheckpoint.objects.exists())
+        self.assertEqual(
+            set(LinkToPopoloSource.objects.values_list(
+                'import_generation', 'deleted_from_source')),
+            {(1, False)})
+
+    def test_resumed_import_marks_deletions(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, checkpoint=True, commit_every=1)
+        importer.update_from_source()
+        # Bob has gone from this one, and the import fails after
+        # Alice, the area, organization and post have been imported:
+        popolo_source.url = 'http://example.com/more-collections.json'
+        popolo_source.save()
+        self.interrupted_update(importer, 'Alice')
+        self.assertFalse(LinkToPopoloSource.objects.filter(
+            deleted_from_source=True).exists())
+        self.assertEqual(ImportCheckpoint.objects.get().position, 3)
+        report = importer.update_from_source()
+        self.assertEqual(report.resumed_from, 3)
+        self.assertEqual(report.collections['person']['disappeared'], 1)
+        self.assertEqual(report.collections['membership']['created'], 1)
+        deleted_link = LinkToPopoloSource.objects.get(
+            deleted_from_source=True)
+        self.assertEqual(deleted_link.popolo_object.name, 'Bob')
+
+    def test_checkpoint_for_other_content_discarded(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, checkpoint=True, commit_every=1)
+        self.interrupted_update(importer, 'Bob')
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        report = importer.update_from_source()
+        self.assertIsNone(report.resumed_from)
+        self.assertEqual(report.collections['person']['updated'], 1)
+        self.assertFalse(ImportCheckpoint.objects.exists())
+        self.assertEqual(
+            set(LinkToPopoloSource.objects.values_list(
+                'import_generation', flat=True)),
+            {2})
+
+
+@patch('popolo_sources.importer.requests.get', side_effect=fake_requests_get)
+class ChunkCommitTests(TransactionTestCase):
+
+    def test_failed_final_flush_closes_transaction(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(popolo_source, commit_every=10)
+        with patch.object(
+                LinkToPopoloSource.objects, 'bulk_create',
+                side_effect=IntegrityError("Failing on purpose")):
+            with capture_output(), self.assertRaises(IntegrityError):
+                importer.update_from_source()
+        self.assertFalse(connection.in_atomic_block)
+        # The chunk was rolled back, and the next import works:
+        self.assertFalse(Person.objects.exists())
+        importer.update_from_source()
+        self.assertEqual(LinkToPopoloSource.objects.count(), 2)
+
+
+class CurrentObjectsTrackerTests(TestCase):
+
+    def test_unseen(self):
+        tracker = CurrentObjectsTracker()
+        for object_id in (7, 3, 3, 12, 1):
+            tracker.notify('person', Mock(id=object_id), False, {})
+        tracker.notify_unchanged('person', Mock(id=5), {})
+        tracker.notify('post', Mock(id=2), True, {})
+        self.assertEqual(
+            list(tracker.unseen('person', array(str('L'), range(1, 15)))),
+            [2, 4, 6, 8, 9, 10, 11, 13, 14])
+        self.assertEqual(
+            list(tracker.unseen('area', array(str('L'), [4, 9]))), [4, 9])
+        self.assertEqual(
+            list(tracker.unseen('post', array(str('L'), [2]))), [])
@@ -1,7 +1,13 @@
+import re
+from unittest import skipUnless
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, IntegrityError, transaction
 from django.test import TestCase
 
-from popolo.models import Person
+from popolo.models import Area, Person
 from popolo_sources.models import PopoloSource, LinkToPopoloSource
+from popolo_sources.importer import PopoloSourceImporter
 
 
 class LinkToPopoloSourceTests(TestCase):
@@ -14,3 +20,115 @@ class LinkToPopoloSourceTests(TestCase):
             popolo_source=popolo_source,
             popolo_object=person,
         )
+
+    def test_duplicate_link_not_allowed(self):
+        person = Person.objects.create(name='Joe Bloggs')
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/popolo.json')
+        LinkToPopoloSource.objects.create(
+            popolo_source=popolo_source,
+            popolo_object=person,
+        )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LinkToPopoloSource.objects.create(
+                popolo_source=popolo_source,
+                popolo_object=person,
+                deleted_from_source=True,
+            )
+
+    def test_live_objects(self):
+        alice, bob, carol = [
+            Person.objects.create(name=name)
+            for name in ('Alice', 'Bob', 'Carol')]
+        source_a = PopoloSource.objects.create(url='http://example.com/a.json')
+        source_b = PopoloSource.objects.create(url='http://example.com/b.json')
+        LinkToPopoloSource.objects.create(
+            popolo_source=source_a, popolo_object=alice)
+        LinkToPopoloSource.objects.create(
+            popolo_source=source_a, popolo_object=bob,
+            deleted_from_source=True)
+        LinkToPopoloSource.objects.create(
+            popolo_source=source_b, popolo_object=carol)
+        LinkToPopoloSource.objects.create(
+            popolo_source=source_b, popolo_object=bob)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(LinkToPopoloSource.objects.live_objects(
+                    source_a, Person).order_by('name')),
+                [alice])
+        self.assertEqual(
+            list(LinkToPopoloSource.objects.live_objects(
+                source_b, Person).filter(name__startswith='C')),
+            [carol])
+        self.assertEqual(
+            list(LinkToPopoloSource.objects.sources_for(bob)), [source_b])
+        self.assertEqual(
+            list(LinkToPopoloSource.objects.sources_for(
+                bob, include_deleted=True).order_by('pk')),
+            [source_a, source_b])
+
+    def test_with_popolo_objects(self):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/popolo.json')
+        for i in range(3):
+            LinkToPopoloSource.objects.create(
+                popolo_source=popolo_source,
+                popolo_object=Person.objects.create(name=str(i)))
+            LinkToPopoloSource.objects.create(
+                popolo_source=popolo_source,
+                popolo_object=Area.objects.create(name=str(i)))
+        ContentType.objects.get_for_models(Person, Area)
+        with self.assertNumQueries(3):
+            names = [
+                link.popolo_object.name
+                for link in LinkToPopoloSource.objects.filter(
+                    popolo_source=popolo_source).with_popolo_objects()]
+        self.assertEqual(sorted(names), sorted(['0', '1', '2'] * 2))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are SQLite-specific')
+class LinkToPopoloSourceQueryPlanTests(TestCase):
+
+    def setUp(self):
+        self.popolo_source = PopoloSource.objects.create(
+            url='http://example.com/popolo.json')
+        self.content_type = ContentType.objects.get(
+            app_label='popolo', model='person')
+
+    def get_query_plan(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, plan, columns):
+        conditions = r' AND '.join(c + r'=\?' for c in columns)
+        pattern = r'USING (COVERING )?INDEX \S+ \({0}\)'.format(conditions)
+        self.assertTrue(
+            any(re.search(pattern, detail) for detail in plan),
+            'No index on {0} used in: {1}'.format(columns, plan))
+
+    def test_links_by_deleted_from_source(self):
+        qs = LinkToPopoloSource.objects.filter(
+            popolo_source=self.popolo_source,
+            content_type=self.content_type,
+            deleted_from_source=True).values_list('object_id', flat=True)
+        plan = self.get_query_plan(*qs.query.sql_with_params())
+        self.assertUsesIndex(
+            plan,
+            ['popolo_source_id', 'content_type_id', 'deleted_from_source'])
+
+    def test_links_by_object_id(self):
+        qs = LinkToPopoloSource.objects.filter(
+            popolo_source=self.popolo_source,
+            content_type=self.content_type,
+            object_id__in=[1, 2, 3])
+        plan = self.get_query_plan(*qs.query.sql_with_params())
+        self.assertUsesIndex(
+            plan, ['popolo_source_id', 'content_type_id', 'object_id'])
+
+    def test_existing_object_lookup(self):
+        importer = PopoloSourceImporter(self.popolo_source)
+        raw_qs = importer.get_source_objects_with_identifiers('person', 'a1b2')
+        plan = self.get_query_plan(raw_qs.raw_query, raw_qs.params)
+        self.assertUsesIndex(
+            plan, ['popolo_source_id', 'content_type_id', 'object_id'])
@@ -0,0 +1,188 @@
+import threading
+
+from mock import Mock, patch
+
+from django.test import TestCase, TransactionTestCase
+
+from popolo.models import Membership, Organization, Person, Post
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import (
+    LinkToPopoloSource, ObjectChange, PopoloSource)
+from popolo_sources.parallel import (
+    _import_shard, shard_by_id, split_by_collection)
+
+from .test_importer import capture_output, fake_requests_get
+
+
+class ShardingTests(TestCase):
+
+    def test_shard_by_id(self):
+        objects = [{'id': i} for i in (5, 3, 1, 4, 2)]
+        shards = shard_by_id(objects, 2)
+        self.assertEqual(
+            [[o['id'] for o in shard] for shard in shards],
+            [[1, 2, 3], [4, 5]])
+
+    def test_same_id_in_same_shard(self):
+        objects = [{'id': 'a'}, {'id': 'b'}, {'id': 'b'}, {'id': 'c'}]
+        shards = shard_by_id(objects, 4)
+        self.assertEqual(
+            [[o['id'] for o in shard] for shard in shards],
+            [['a'], ['b', 'b'], ['c']])
+
+    def test_worker_index_only_has_its_collection(self):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, workers=2, preload_identifiers=True)
+        worker = importer.make_worker_importer('person')
+        worker.identifier_index.load()
+        self.assertEqual(
+            list(worker.identifier_index.collection_to_index), ['person'])
+        self.assertFalse(worker.identifier_index.covers('organization'))
+
+    def test_split_by_collection(self):
+        data = {
+            'areas': [{'id': 'a1', 'name': 'Old'}],
+            'organizations': [{'id': 'o1', 'area': {'id': 'a1', 'name': 'New'}}],
+            'persons': [{
+                'id': 'p1',
+                'memberships': [{'person_id': 'p1', 'organization_id': 'o1'}],
+            }],
+            'memberships': [{'id': 'm1', 'person_id': 'p1'}],
+        }
+        by_collection = split_by_collection(data)
+        self.assertEqual(by_collection['area'], [{'id': 'a1', 'name': 'New'}])
+        self.assertEqual(by_collection['person'], [{'id': 'p1'}])
+        self.assertEqual(
+            [m['id'] for m in by_collection['membership']],
+            ['m1', 'missing_o1_missing_missing_missing_p1'])
+        # The data itself is left alone:
+        self.assertIn('memberships', data['persons'][0])
+        self.assertNotIn('id', data['persons'][0]['memberships'][0])
+
+
+@patch('popolo_sources.importer.requests.get', side_effect=fake_requests_get)
+class ParallelImportTests(TransactionTestCase):
+
+    # Each worker has its own database connection, so these can't run
+    # inside a transaction. SQLite can't have several connections
+    # writing at once, so with more than one worker the shards are
+    # imported one at a time (though still in separate threads).
+
+    def test_parallel_import(self, fake_get):
+        observer = Mock(spec=['notify', 'notify_deleted'])
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(popolo_source, workers=1)
+        importer.add_observer(observer)
+        report = importer.update_from_source()
+        for collection in (
+                'area', 'organization', 'post', 'person', 'membership'):
+            self.assertEqual(report.collections[collection]['created'], 1)
+        self.assertEqual(observer.notify.call_count, 5)
+        membership = Membership.objects.get()
+        self.assertEqual(membership.person.name, 'Alice')
+        self.assertEqual(membership.organization.name, 'House of Commons')
+        self.assertEqual(membership.post, Post.objects.get())
+        self.assertEqual(
+            Post.objects.get().area.name, 'Dulwich and West Norwood')
+        self.assertEqual(LinkToPopoloSource.objects.count(), 5)
+        # Now everything but Alice has gone, and Bob has arrived:
+        popolo_source.url = 'http://example.com/two-people.json'
+        popolo_source.save()
+        report = importer.update_from_source()
+        self.assertEqual(report.collections['person']['created'], 1)
+        self.assertEqual(report.collections['person']['updated'], 1)
+        for collection in ('area', 'organization', 'post', 'membership'):
+            self.assertEqual(
+                report.collections[collection]['disappeared'], 1)
+        self.assertEqual(
+            LinkToPopoloSource.objects.filter(
+                deleted_from_source=False).count(),
+            2)
+        self.assertEqual(observer.notify_deleted.call_count, 4)
+
+    def test_several_workers(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, workers=2, preload_identifiers=True)
+        shard_sizes = []
+
+        def sharder(objects, shards):
+            result = shard_by_id(objects, shards)
+            shard_sizes.append([len(shard) for shard in result])
+            return result
+
+        lock = threading.Lock()
+
+        def import_shard(*args):
+            with lock:
+                return _import_shard(*args)
+
+        with patch('popolo_sources.parallel.shard_by_id', sharder), \
+                patch('popolo_sources.parallel._import_shard', import_shard):
+            report = importer.update_from_source()
+        # The two people were imported in separate shards:
+        self.assertIn([1, 1], shard_sizes)
+        self.assertEqual(report.collections['person']['created'], 2)
+        popolo_source.url = 'http://example.com/two-people-one-changed.json'
+        popolo_source.save()
+        with patch('popolo_sources.parallel._import_shard', import_shard):
+            report = importer.update_from_source()
+        self.assertEqual(report.collections['person']['updated'], 2)
+        self.assertEqual(
+            sorted(Person.objects.values_list('name', flat=True)),
+            ['Alice', 'Robert'])
+        self.assertEqual(LinkToPopoloSource.objects.count(), 2)
+
+    def test_parallel_import_set_based_deletions(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, workers=1, set_based_deletions=True)
+        importer.update_from_source()
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        report = importer.update_from_source()
+        self.assertEqual(report.collections['person']['disappeared'], 1)
+        deleted_link = LinkToPopoloSource.objects.get(
+            deleted_from_source=True)
+        self.assertEqual(deleted_link.popolo_object.name, 'Bob')
+
+    def test_failed_shard(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(popolo_source, workers=1)
+        with patch.object(
+                PopoloSourceImporter, 'update_organization',
+                side_effect=ValueError("Failing on purpose")):
+            with capture_output(), self.assertRaisesRegexp(
+                    Exception, r'Failing on purpose'):
+                importer.update_from_source()
+        # Nothing that depends on organizations was started:
+        self.assertFalse(Organization.objects.exists())
+        self.assertFalse(Post.objects.exists())
+        self.assertFalse(Membership.objects.exists())
+        self.assertFalse(LinkToPopoloSource.objects.filter(
+            deleted_from_source=True).exists())
+
+    def test_workers_not_atomic(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        with self.assertRaisesRegexp(Exception, r'atomic'):
+            PopoloSourceImporter(popolo_source, workers=2, atomic=True)
+
+    def test_parallel_import_records_changes(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        importer = PopoloSourceImporter(
+            popolo_source, workers=1, record_changes=True)
+        importer.update_from_source()
+        self.assertEqual(
+            sorted(ObjectChange.objects.values_list(
+                'content_type__model', 'change')),
+            [('area', 'created'), ('membership', 'created'),
+             ('organization', 'created'), ('person', 'created'),
+             ('post', 'created')])
@@ -0,0 +1,198 @@
+from datetime import timedelta
+import os
+import signal
+import threading
+
+from mock import Mock, patch
+
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+
+from popolo.models import Person
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.management.commands.popolo_sources_update import (
+    LOCKED, update_sources_with_concurrent_fetches)
+from popolo_sources.models import PopoloSource
+from popolo_sources.scheduling import (
+    due_sources, next_interval, record_update_result, seconds_until_next_due)
+
+from .test_importer import capture_output, fake_requests_get
+
+
+class SchedulingTests(TestCase):
+
+    def setUp(self):
+        self.popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json', update_interval=100)
+
+    @patch('popolo_sources.scheduling.random.random', return_value=0.5)
+    def test_backoff(self, fake_random):
+        self.assertEqual(next_interval(self.popolo_source), 100)
+        self.popolo_source.unchanged_updates = 2
+        self.assertEqual(next_interval(self.popolo_source), 225)
+        self.popolo_source.failed_updates = 1
+        self.assertEqual(next_interval(self.popolo_source), 450)
+        self.popolo_source.failed_updates = 1000
+        self.assertEqual(next_interval(self.popolo_source), 1600)
+
+    def test_jitter(self):
+        with patch('popolo_sources.scheduling.random.random', return_value=0):
+            self.assertAlmostEqual(next_interval(self.popolo_source), 90)
+        with patch('popolo_sources.scheduling.random.random', return_value=1):
+            self.assertAlmostEqual(next_interval(self.popolo_source), 110)
+
+    def test_record_update_result(self):
+        record_update_result(self.popolo_source, 'unchanged')
+        record_update_result(self.popolo_source, 'failed')
+        self.popolo_source.refresh_from_db()
+        self.assertEqual(self.popolo_source.unchanged_updates, 1)
+        self.assertEqual(self.popolo_source.failed_updates, 1)
+        self.assertGreater(self.popolo_source.next_update_at, timezone.now())
+        record_update_result(self.popolo_source, 'updated')
+        self.popolo_source.refresh_from_db()
+        self.assertEqual(self.popolo_source.unchanged_updates, 0)
+        self.assertEqual(self.popolo_source.failed_updates, 0)
+
+    def test_due_sources(self):
+        # Sources aren't scheduled by default:
+        PopoloSource.objects.create(url='http://example.com/unscheduled.json')
+        later = PopoloSource.objects.create(
+            url='http://example.com/later.json', update_interval=100,
+            next_update_at=timezone.now() + timedelta(minutes=5))
+        self.assertEqual(list(due_sources()), [self.popolo_source])
+        self.assertEqual(seconds_until_next_due(60), 0)
+        record_update_result(self.popolo_source, 'updated')
+        self.assertEqual(list(due_sources()), [])
+        self.assertEqual(seconds_until_next_due(60), 60)
+        self.assertLess(seconds_until_next_due(600), 300)
+        self.assertEqual(
+            list(due_sources(timezone.now() + timedelta(hours=2))),
+            [self.popolo_source, later])
+
+    def test_stop_before_importing(self):
+        sources = [
+            self.popolo_source,
+            PopoloSource.objects.create(
+                url='http://example.com/single-person.json')]
+        session = Mock()
+        session.get.side_effect = fake_requests_get
+        stop = threading.Event()
+        stop.set()
+        results = update_sources_with_concurrent_fetches(
+            sources, 1, session=session, stop=stop)
+        self.assertEqual(results, [None, None])
+        self.assertFalse(Person.objects.exists())
+        self.assertFalse(PopoloSource.objects.filter(
+            locked_until__isnull=False).exists())
+
+    def test_each_source_locked_while_imported(self):
+        second = PopoloSource.objects.create(
+            url='http://example.com/single-person.json')
+        being_updated = PopoloSource.objects.create(
+            url='http://example.com/more-collections.json')
+        self.assertTrue(being_updated.acquire_lock())
+        locked_during_imports = []
+        update_from_fetched = PopoloSourceImporter.update_from_fetched
+
+        def record_locks(importer, fetched, force=False):
+            locked_during_imports.append(list(PopoloSource.objects.filter(
+                locked_until__isnull=False).order_by('pk')))
+            return update_from_fetched(importer, fetched, force=force)
+
+        session = Mock()
+        session.get.side_effect = fake_requests_get
+        with patch.object(
+                PopoloSourceImporter, 'update_from_fetched', record_locks):
+            results = update_sources_with_concurrent_fetches(
+                [self.popolo_source, second, being_updated], 1,
+                session=session)
+        self.assertEqual(results, ['updated', 'updated', LOCKED])
+        self.assertEqual(
+            locked_during_imports,
+            [[self.popolo_source, being_updated], [second, being_updated]])
+        # Only the locks that were taken here are released:
+        self.assertEqual(
+            list(PopoloSource.objects.filter(locked_until__isnull=False)),
+            [being_updated])
+
+    def test_locks_released_if_importer_fails(self):
+        session = Mock()
+        with self.assertRaises(Exception):
+            update_sources_with_concurrent_fetches(
+                [self.popolo_source], 1, session=session, checkpoint=True)
+        self.popolo_source.refresh_from_db()
+        self.assertIsNone(self.popolo_source.locked_until)
+
+
+class SchedulerCommandTests(TestCase):
+
+    def run_scheduler(self):
+        session = Mock()
+        session.get.side_effect = fake_requests_get
+        with patch(
+                'popolo_sources.management.commands.'
+                'popolo_sources_scheduler.make_session',
+                return_value=session):
+            with capture_output() as (out, err):
+                call_command('popolo_sources_scheduler', '--once')
+        return out.getvalue()
+
+    def test_update_due_sources(self):
+        due = PopoloSource.objects.create(
+            url='http://example.com/two-people.json', update_interval=3600)
+        not_due = PopoloSource.objects.create(
+            url='http://example.com/single-person.json', update_interval=3600,
+            next_update_at=timezone.now() + timedelta(minutes=5))
+        out = self.run_scheduler()
+        self.assertIn('{0}: updated, next update at'.format(repr(due)), out)
+        self.assertNotIn(repr(not_due), out)
+        self.assertEqual(Person.objects.count(), 2)
+        due.refresh_from_db()
+        self.assertGreater(
+            due.next_update_at, timezone.now() + timedelta(minutes=50))
+        # Nothing is due now:
+        self.assertEqual(self.run_scheduler(), '')
+        due.next_update_at = timezone.now()
+        due.save()
+        self.assertIn(
+            '{0}: unchanged'.format(repr(due)), self.run_scheduler())
+        due.refresh_from_db()
+        self.assertEqual(due.unchanged_updates, 1)
+
+    def test_database_error_retried(self):
+        calls = []
+
+        def fail_once(now):
+            calls.append(now)
+            if len(calls) == 1:
+                raise OperationalError("the database has gone away")
+            return PopoloSource.objects.none()
+
+        def stop_scheduler(maximum):
+            os.kill(os.getpid(), signal.SIGTERM)
+            return 0
+
+        scheduler = 'popolo_sources.management.commands.' \
+            'popolo_sources_scheduler.'
+        with patch(scheduler + 'due_sources', side_effect=fail_once), \
+                patch(scheduler + 'seconds_until_next_due',
+                      side_effect=stop_scheduler), \
+                patch(scheduler + 'make_session'):
+            with capture_output() as (out, err):
+                call_command(
+                    'popolo_sources_scheduler', '--poll-interval', '0')
+        self.assertEqual(len(calls), 2)
+        self.assertIn('the database has gone away', err.getvalue())
+        self.assertIn('Stopping', err.getvalue())
+
+    def test_failing_source_backs_off(self):
+        failing = PopoloSource.objects.create(
+            url='http://example.com/does-not-exist.json', update_interval=3600)
+        self.assertIn(
+            '{0}: failed'.format(repr(failing)), self.run_scheduler())
+        failing.refresh_from_db()
+        self.assertEqual(failing.failed_updates, 1)
+        self.assertGreater(
+            failing.next_update_at, timezone.now() + timedelta(minutes=100))
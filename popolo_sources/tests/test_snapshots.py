@@ -0,0 +1,151 @@
+from datetime import timedelta
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from mock import patch
+
+from django.test import TestCase
+
+from popolo.models import Person
+from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.models import PopoloSource
+from popolo_sources.snapshots import SnapshotNotFound, SnapshotStore
+
+from .test_importer import capture_output, fake_requests_get
+
+
+class SnapshotStoreTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mtime = time.time() - 100
+        self.popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, store, content_digest, content=b'{}'):
+        store.save(self.popolo_source, content_digest, io.BytesIO(content))
+        # Make sure each snapshot is a second later than the last one,
+        # and all of them are more than ten seconds old:
+        self.mtime += 1
+        path = store.path(self.popolo_source, content_digest)
+        os.utime(path, (self.mtime, self.mtime))
+
+    def test_save_and_get(self):
+        store = SnapshotStore(self.directory)
+        with self.assertRaises(SnapshotNotFound):
+            store.get(self.popolo_source)
+        store.save(self.popolo_source, 'abc', io.BytesIO(b'{"persons": []}'))
+        snapshot = store.get(self.popolo_source)
+        self.assertEqual(snapshot.content_digest, 'abc')
+        self.assertTrue(snapshot.path.endswith('abc.json.gz'))
+        with snapshot.open() as f:
+            self.assertEqual(f.read(), b'{"persons": []}')
+        with self.assertRaises(SnapshotNotFound):
+            store.get(self.popolo_source, 'def')
+
+    def test_max_per_source(self):
+        store = SnapshotStore(self.directory, max_per_source=2)
+        for digest in ('a', 'b', 'c'):
+            self.save(store, digest)
+        self.assertEqual(
+            [s.content_digest for s in store.snapshots(self.popolo_source)],
+            ['c', 'b'])
+
+    def test_max_total_size_and_age(self):
+        store = SnapshotStore(self.directory, max_per_source=None)
+        for digest in ('a', 'b'):
+            self.save(store, digest, b'x' * 100)
+        size = store.get(self.popolo_source).size
+        store.max_total_size = size
+        store.evict()
+        self.assertEqual(
+            [s.content_digest for s in store.snapshots(self.popolo_source)],
+            ['b'])
+        store.max_age = timedelta(seconds=10)
+        store.evict()
+        # Unlike max_total_size, max_age can remove every snapshot:
+        self.assertEqual(store.snapshots(self.popolo_source), [])
+
+
+@patch('popolo_sources.importer.requests.get', side_effect=fake_requests_get)
+class SnapshotImportTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = SnapshotStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay_without_network(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, snapshot_store=self.store)
+        importer.update_from_source()
+        snapshot = self.store.get(popolo_source)
+        self.assertEqual(
+            snapshot.content_digest, popolo_source.content_digest)
+        Person.objects.filter(name='Bob').update(name='Robert')
+        fake_get.side_effect = Exception("There should be no network access")
+        report = importer.update_from_snapshot()
+        self.assertTrue(report)
+        self.assertTrue(Person.objects.filter(name='Bob').exists())
+
+    def test_streaming_replay(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, snapshot_store=self.store, streaming=True)
+        importer.update_from_source()
+        Person.objects.all().delete()
+        importer.update_from_snapshot(
+            popolo_source.content_digest, force=True)
+        self.assertEqual(Person.objects.count(), 2)
+
+    def test_replay_clears_validators(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, snapshot_store=self.store)
+        importer.update_from_source()
+        popolo_source.etag = '"abc"'
+        popolo_source.save()
+        importer.update_from_snapshot()
+        popolo_source.refresh_from_db()
+        self.assertEqual(popolo_source.etag, '')
+
+    def test_resume_from_snapshot(self, fake_get):
+        popolo_source = PopoloSource.objects.create(
+            url='http://example.com/two-people.json')
+        importer = PopoloSourceImporter(
+            popolo_source, snapshot_store=self.store, checkpoint=True,
+            commit_every=1)
+        original_update_person = importer.update_person
+
+        def update_person(person_data):
+            if person_data['name'] == 'Bob':
+                raise ValueError("Failing on purpose")
+            return original_update_person(person_data)
+
+        with patch.object(importer, 'update_person', update_person):
+            with capture_output(), self.assertRaises(ValueError):
+                importer.update_from_source()
+        # Even though the source has changed, the import carries on
+        # with the snapshot of the content it started with:
+        popolo_source.url = 'http://example.com/single-person.json'
+        popolo_source.save()
+        fake_get.side_effect = Exception("There should be no network access")
+        report = importer.resume()
+        self.assertEqual(report.resumed_from, 1)
+        self.assertEqual(
+            sorted(Person.objects.values_list('name', flat=True)),
+            ['Alice', 'Bob'])
+        with self.assertRaisesRegexp(Exception, r'no interrupted import'):
+            importer.resume()
@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from django.test import TestCase
 
 from popolo_sources.models import PopoloSource
@@ -14,3 +16,16 @@ class PopoloSourceTests(TestCase):
             repr(ps),
             "PopoloSource(id={0}, url='http://example.com/popolo.json')".format(ps.id)
         )
+
+    def test_lock(self):
+        ps = PopoloSource.objects.create(url='http://example.com/popolo.json')
+        self.assertTrue(ps.acquire_lock())
+        same_ps = PopoloSource.objects.get(pk=ps.pk)
+        self.assertFalse(same_ps.acquire_lock())
+        ps.release_lock()
+        self.assertTrue(same_ps.acquire_lock())
+
+    def test_expired_lock(self):
+        ps = PopoloSource.objects.create(url='http://example.com/popolo.json')
+        self.assertTrue(ps.acquire_lock(duration=timedelta(seconds=-1)))
+        self.assertTrue(ps.acquire_lock())
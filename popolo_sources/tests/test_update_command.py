@@ -1,5 +1,6 @@
 from contextlib import contextmanager
-from mock import patch
+from mock import Mock, patch
+import requests
 import sys
 
 from django.core.management import call_command, CommandError
@@ -8,6 +9,9 @@ from django.utils import six
 
 from popolo_sources.models import PopoloSource
 from popolo_sources.importer import PopoloSourceImporter
+from popolo_sources.plans import ImportPlan
+from popolo_sources.reports import ImportReport
+from popolo_sources.signals import import_finished
 
 
 @contextmanager
@@ -33,14 +37,16 @@ class UpdateCommandTests(TestCase):
         with capture_output():
             call_command('popolo_sources_update', 'http://example.com/foo.json')
         mock_importer.assert_called_once_with(ps)
-        mock_importer.return_value.update_from_source.assert_called_once_with()
+        mock_importer.return_value.update_from_source.assert_called_once_with(
+            force=False)
 
     def test_update_source_from_id(self, mock_importer):
         ps = PopoloSource.objects.create(url='http://example.com/foo.json')
         with capture_output():
             call_command('popolo_sources_update', str(ps.id))
         mock_importer.assert_called_once_with(ps)
-        mock_importer.return_value.update_from_source.assert_called_once_with()
+        mock_importer.return_value.update_from_source.assert_called_once_with(
+            force=False)
 
     def test_update_source_id_does_not_exist(self, mock_importer):
         with self.assertRaisesRegexp(CommandError, r'^Source not found$'):
@@ -91,6 +97,15 @@ class UpdateCommandTests(TestCase):
         ps = PopoloSource.objects.get()
         self.assertEqual(ps.url, 'http://example.com/foo.json')
 
+    def test_create_a_local_file_source(self, mock_importer):
+        with capture_output():
+            call_command(
+                'popolo_sources_update',
+                '--create',
+                'file:///srv/exports/popolo.json.xz')
+        ps = PopoloSource.objects.get()
+        self.assertEqual(ps.url, 'file:///srv/exports/popolo.json.xz')
+
     def test_other_sources_suggested(self, mock_importer):
         existing_sources = [
             PopoloSource.objects.create(url='http://example.com/foo.json'),
@@ -105,3 +120,240 @@ class UpdateCommandTests(TestCase):
              'Did you mean one of the following?',
              '{0.id}: {0.url}'.format(existing_sources[0]),
              '{0.id}: {0.url}'.format(existing_sources[1])])
+
+    def test_update_source_forced(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with capture_output():
+            call_command(
+                'popolo_sources_update', '--force', str(ps.id))
+        mock_importer.return_value.update_from_source.assert_called_once_with(
+            force=True)
+
+    def test_update_source_unchanged(self, mock_importer):
+        mock_importer.return_value.update_from_source.return_value = False
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with capture_output() as (out, err):
+            call_command('popolo_sources_update', str(ps.id))
+        self.assertIn(
+            'the source is unchanged since the last import',
+            out.getvalue())
+
+    def test_update_from_snapshot(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with capture_output() as (out, err):
+            call_command(
+                'popolo_sources_update', '--from-snapshot',
+                '--snapshot-dir', '/tmp/snapshots', str(ps.id))
+        mock_importer.return_value.update_from_snapshot.assert_called_once_with(
+            force=False)
+        mock_importer.return_value.update_from_source.assert_not_called()
+        self.assertEqual(
+            mock_importer.call_args[1]['snapshot_store'].directory,
+            '/tmp/snapshots')
+
+    def test_update_from_snapshot_needs_directory(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with self.assertRaisesRegexp(CommandError, r'--snapshot-dir'):
+            call_command(
+                'popolo_sources_update', '--from-snapshot', str(ps.id))
+
+    def test_plan(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        plan = ImportPlan(ps)
+        plan.add('person', 'created', 'a1b2')
+        mock_importer.return_value.plan.return_value = plan
+        with capture_output() as (out, err):
+            call_command('popolo_sources_update', '--plan', str(ps.id))
+        mock_importer.return_value.plan.assert_called_once_with(
+            from_snapshot=False)
+        mock_importer.return_value.update_from_source.assert_not_called()
+        self.assertIn('would be changed', out.getvalue())
+        self.assertRegexpMatches(out.getvalue(), r'person +1 +0')
+
+    def test_update_with_workers(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with capture_output() as (out, err):
+            call_command(
+                'popolo_sources_update', '--workers', '4', str(ps.id))
+        self.assertEqual(mock_importer.call_args[1]['workers'], 4)
+
+    def test_workers_with_checkpoints(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with self.assertRaisesRegexp(
+                CommandError,
+                r"^You can't use both --checkpoint-every and --workers"):
+            call_command(
+                'popolo_sources_update', '--workers', '4',
+                '--checkpoint-every', '1000', str(ps.id))
+        mock_importer.assert_not_called()
+        ps.refresh_from_db()
+        self.assertIsNone(ps.locked_until)
+
+    def test_update_with_checkpoints(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with capture_output() as (out, err):
+            call_command(
+                'popolo_sources_update', '--checkpoint-every', '1000',
+                str(ps.id))
+        self.assertTrue(mock_importer.call_args[1]['checkpoint'])
+        self.assertEqual(mock_importer.call_args[1]['commit_every'], 1000)
+
+    def test_checkpoints_with_collections(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with self.assertRaisesRegexp(
+                CommandError,
+                r"^You can't use both --checkpoint-every and --collections"):
+            call_command(
+                'popolo_sources_update', '--checkpoint-every', '1000',
+                '--collections', 'person', str(ps.id))
+        mock_importer.assert_not_called()
+        ps.refresh_from_db()
+        self.assertIsNone(ps.locked_until)
+
+    def test_update_collections(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with capture_output() as (out, err):
+            call_command(
+                'popolo_sources_update', '--collections',
+                'person, membership', str(ps.id))
+        self.assertEqual(
+            mock_importer.call_args[1]['collections'],
+            ['person', 'membership'])
+
+    def test_update_unknown_collections(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        with self.assertRaisesRegexp(
+                CommandError, r'^Unknown collections: people$'):
+            call_command(
+                'popolo_sources_update', '--collections', 'people',
+                str(ps.id))
+
+    def test_update_source_stats(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+
+        def update_from_source(force=False):
+            report = ImportReport(ps, count_queries=True)
+            report.updated = True
+            with report.counting_queries(), report.phase('import'):
+                report.count('person', 'created', 3)
+            import_finished.send(
+                sender=PopoloSourceImporter, popolo_source=ps, report=report)
+            return report
+
+        mock_importer.return_value.update_from_source.side_effect = \
+            update_from_source
+        with capture_output() as (out, err):
+            call_command('popolo_sources_update', '--stats', str(ps.id))
+        output = out.getvalue()
+        self.assertIn('{0}: updated\n  phase'.format(repr(ps)), output)
+        self.assertRegexpMatches(output, r'import +\d+\.\d+s +0')
+        self.assertRegexpMatches(output, r'person +3 +0')
+        self.assertTrue(mock_importer.call_args[1]['count_queries'])
+        self.assertFalse(import_finished.has_listeners(PopoloSourceImporter))
+
+    def test_update_multiple_sources(self, mock_importer):
+        sources = [
+            PopoloSource.objects.create(url='http://example.com/foo.json'),
+            PopoloSource.objects.create(url='http://example.com/bar.json'),
+        ]
+        with capture_output() as (out, err):
+            call_command(
+                'popolo_sources_update',
+                str(sources[0].id), 'http://example.com/bar.json')
+        self.assertEqual(
+            [c[0][0] for c in mock_importer.call_args_list], sources)
+        self.assertIn(
+            "{0}: updated".format(repr(sources[1])), out.getvalue())
+
+    def test_update_all_sources(self, mock_importer):
+        sources = [
+            PopoloSource.objects.create(url='http://example.com/foo.json'),
+            PopoloSource.objects.create(url='http://example.com/bar.json'),
+        ]
+        with capture_output():
+            call_command('popolo_sources_update', '--all')
+        self.assertEqual(
+            [c[0][0] for c in mock_importer.call_args_list], sources)
+
+    def test_no_sources_specified(self, mock_importer):
+        with self.assertRaisesRegexp(
+                CommandError, r'^You must specify at least one'):
+            call_command('popolo_sources_update')
+
+    def test_one_failure_does_not_stop_others(self, mock_importer):
+        sources = [
+            PopoloSource.objects.create(url='http://example.com/foo.json'),
+            PopoloSource.objects.create(url='http://example.com/bar.json'),
+        ]
+        mock_importer.return_value.update_from_source.side_effect = [
+            Exception('Something went wrong'), True]
+        with capture_output() as (out, err):
+            with self.assertRaisesRegexp(
+                    CommandError, r'^1 of 2 sources failed to update$'):
+                call_command('popolo_sources_update', '--all')
+        self.assertEqual(
+            mock_importer.return_value.update_from_source.call_count, 2)
+        self.assertIn('Something went wrong', err.getvalue())
+        self.assertIn(
+            "{0}: failed".format(repr(sources[0])), out.getvalue())
+        self.assertIn(
+            "{0}: updated".format(repr(sources[1])), out.getvalue())
+        # Both locks should have been released:
+        self.assertFalse(PopoloSource.objects.filter(
+            locked_until__isnull=False).exists())
+
+    def test_locked_source_skipped(self, mock_importer):
+        ps = PopoloSource.objects.create(url='http://example.com/foo.json')
+        self.assertTrue(ps.acquire_lock())
+        with capture_output() as (out, err):
+            call_command('popolo_sources_update', str(ps.id))
+        mock_importer.assert_not_called()
+        self.assertIn('already being updated', out.getvalue())
+
+    def test_update_with_multiple_jobs(self, mock_importer):
+        sources = [
+            PopoloSource.objects.create(url='http://example.com/foo.json'),
+            PopoloSource.objects.create(url='http://example.com/bar.json'),
+            PopoloSource.objects.create(url='http://example.com/baz.json'),
+        ]
+        with patch(
+                'popolo_sources.management.commands.'
+                'popolo_sources_update.update_source',
+                side_effect=['updated', 'unchanged', 'updated']) as us:
+            with capture_output() as (out, err):
+                call_command('popolo_sources_update', '--all', '--jobs', '2')
+        self.assertEqual(
+            sorted(c[0][0].id for c in us.call_args_list),
+            [ps.id for ps in sources])
+        self.assertEqual(
+            len([l for l in out.getvalue().splitlines()
+                 if l.startswith('PopoloSource(')]),
+            3)
+
+    def test_update_with_concurrent_fetches(self, mock_importer):
+        sources = [
+            PopoloSource.objects.create(url='http://example.com/foo.json'),
+            PopoloSource.objects.create(url='http://example.com/bar.json'),
+        ]
+        mock_importer.side_effect = lambda ps, **kwargs: Mock(
+            popolo_source=ps, **{'update_from_fetched.return_value': True})
+        with capture_output() as (out, err):
+            call_command(
+                'popolo_sources_update', '--all', '--fetch-jobs', '2',
+                '--timeout', '5')
+        self.assertEqual(
+            [c[0][0] for c in mock_importer.call_args_list], sources)
+        kwargs = mock_importer.call_args[1]
+        self.assertEqual(kwargs['timeout'], 5)
+        self.assertIsInstance(kwargs['session'], requests.Session)
+        for ps in sources:
+            self.assertIn("{0}: updated".format(repr(ps)), out.getvalue())
+        self.assertFalse(PopoloSource.objects.filter(
+            locked_until__isnull=False).exists())
+
+    def test_jobs_and_fetch_jobs_exclusive(self, mock_importer):
+        with self.assertRaisesRegexp(
+                CommandError, r"^You can't use both --jobs and --fetch-jobs"):
+            call_command(
+                'popolo_sources_update', '--all', '--jobs', '2',
+                '--fetch-jobs', '2')
@@ -20,8 +20,12 @@ setup(
         'requests',
     ],
     extras_require={
+        'streaming': [
+            'ijson>=3.1',
+        ],
         'test': [
             'coverage',
+            'ijson>=3.1',
             'mock',
         ],
     }